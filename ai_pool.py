@@ -0,0 +1,172 @@
+"""Bounded worker pool for AI calls with adaptive rate limiting.
+
+Gemini answers in whatever order it likes, so results are handed back in
+input order. The engine assigns counter numbers as it consumes them, which
+keeps ai_smart numbering deterministic and gap-free.
+"""
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import metrics
+
+
+class CancelledError(Exception):
+    """Raised inside a worker when the batch was cancelled"""
+
+
+def is_rate_limit_error(error):
+    """True for 429 / quota / resource-exhausted style errors"""
+    if type(error).__name__ in ('ResourceExhausted', 'TooManyRequests'):
+        return True
+    if getattr(error, 'code', None) == 429:
+        return True
+    text = str(error).lower()
+    return '429' in text or 'quota' in text or 'rate limit' in text or 'resource exhausted' in text
+
+
+class TokenBucket:
+    """Token bucket that slows down on throttling and recovers on success.
+
+    The refill rate is cut in half on every rate-limit error and creeps back
+    up by a small step after each successful call (AIMD), never going above
+    the configured rate.
+    """
+
+    def __init__(self, rate, capacity=None, min_rate=0.05):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.min_rate = min_rate
+        self.capacity = float(capacity or max(1.0, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, cancel_event=None):
+        """Block until a token is available; False if cancelled first"""
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if cancel_event is not None:
+                if cancel_event.wait(wait):
+                    return False
+            else:
+                time.sleep(wait)
+
+    def on_throttle(self):
+        with self.lock:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+
+def call_with_retry(fn, limiter=None, max_retries=4, base_delay=1.0, max_delay=30.0,
+                    cancel_event=None):
+    """Call fn() under the limiter, retrying with exponential backoff and jitter"""
+    attempt = 0
+    while True:
+        if cancel_event is not None and cancel_event.is_set():
+            raise CancelledError()
+        if limiter is not None and not limiter.acquire(cancel_event):
+            raise CancelledError()
+        try:
+            result = fn()
+        except Exception as e:
+            throttled = is_rate_limit_error(e)
+            metrics.count('model.rate_limited' if throttled else 'model.failures')
+            if throttled and limiter is not None:
+                limiter.on_throttle()
+            # e.g. a misconfigured backend: failing again won't help
+            if attempt >= max_retries or not getattr(e, 'retryable', True):
+                raise
+            delay = min(max_delay, base_delay * (2 ** attempt))
+            delay = delay * (0.5 + random.random() / 2)
+            attempt += 1
+            metrics.count('model.retries')
+            print(f"⚠️ AI call failed ({str(e)[:60]}), retry {attempt}/{max_retries} in {delay:.1f}s")
+            if cancel_event is not None:
+                if cancel_event.wait(delay):
+                    raise CancelledError()
+            else:
+                time.sleep(delay)
+            continue
+        if limiter is not None:
+            limiter.on_success()
+        return result
+
+
+def chunked(items, size):
+    """Yield lists of up to size items from any iterable, lazily"""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def ordered_map(fn, items, workers=4, cancel_event=None, window=None):
+    """Run fn(item) on a thread pool, yielding (item, result, error) in input order.
+
+    At most `window` calls are in flight, so items may be a lazy generator.
+    When cancel_event is set no new work is started, calls that have not
+    begun are dropped, and results that already finished are still yielded.
+    """
+    window = window or workers * 2
+    pending = deque()
+    items = iter(items)
+    exhausted = False
+
+    def cancelled():
+        return cancel_event is not None and cancel_event.is_set()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        try:
+            while True:
+                while not exhausted and len(pending) < window and not cancelled():
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    pending.append((item, pool.submit(fn, item)))
+
+                if not pending:
+                    break
+
+                if cancelled():
+                    # Keep what already finished, in order, and drop the rest
+                    for item, future in pending:
+                        if not future.cancel() and future.done() and future.exception() is None:
+                            yield item, future.result(), None
+                    pending.clear()
+                    break
+
+                item, future = pending.popleft()
+                try:
+                    result, error = future.result(), None
+                except CancelledError:
+                    continue
+                except Exception as e:
+                    result, error = None, e
+                yield item, result, error
+        finally:
+            for _, future in pending:
+                future.cancel()
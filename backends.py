@@ -0,0 +1,262 @@
+"""Vision backends: what turns a prompt plus images into a reply.
+
+gemini   Google Gemini over the network (the default)
+local    a Python function on this machine, e.g. a small captioning model,
+         named 'module:function' and called as function(image, prompt)
+         with a PIL image; it returns the reply text
+replay   replies recorded earlier, for deterministic load tests
+
+Any backend but replay can be recorded: every request's hash, reply and
+latency is appended to a JSONL file, which replay then serves. A request
+is identified by its text and image bytes, so replaying the same files
+with the same upload and batch settings finds every reply. Each line also
+notes the recorded backend's capabilities, and replay takes them over, so
+a local recording is replayed one image per request as it was made. Replay waits
+the recorded latency (times speed, 0 for none), so a load test sees the
+real service's timing without its cost or variance.
+
+Capabilities tell the engine how to drive a backend: whether several
+images can share one request (batching), whether calls may overlap
+(concurrent) and the longest image edge it takes (max_edge, 0 = any).
+
+Every backend times its own calls; latency_summary() reports them, so
+backends can be compared on the same files.
+"""
+import hashlib
+import importlib
+import io
+import json
+import os
+import threading
+import time
+
+from metrics import Histogram, metrics
+
+BACKENDS = ('gemini', 'local', 'replay')
+
+
+class BackendError(RuntimeError):
+    """A backend that can't work as configured; retrying won't help"""
+    retryable = False
+
+
+class ReplayMiss(BackendError):
+    pass
+
+
+class Capabilities:
+    __slots__ = ('batching', 'concurrent', 'max_edge')
+
+    def __init__(self, batching=True, concurrent=True, max_edge=0):
+        self.batching = batching
+        self.concurrent = concurrent
+        self.max_edge = max_edge
+
+
+def request_key(contents, json_reply=False):
+    """Stable hash of a request: its text parts and image bytes, in order"""
+    digest = hashlib.sha256(b'json' if json_reply else b'text')
+    for part in contents:
+        if isinstance(part, str):
+            digest.update(b'\0t' + part.encode('utf-8'))
+        elif isinstance(part, dict):
+            digest.update(b'\0i' + part['mime_type'].encode('ascii') + b'\0' + part['data'])
+        else:
+            # A PIL image, sent without preprocessing
+            digest.update(b'\0p' + f"{part.mode}{part.size}".encode('ascii') + part.tobytes())
+    return digest.hexdigest()
+
+
+class VisionBackend:
+    """Base class: subclasses set name and capabilities and implement _generate"""
+    name = 'backend'
+    # Part of the AI name cache key, so names from different models don't mix
+    cache_scope = ''
+
+    def __init__(self, capabilities):
+        self.capabilities = capabilities
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    @property
+    def description(self):
+        return self.name
+
+    def reset_stats(self):
+        self.latency = Histogram()
+        self.images = 0
+        self.errors = 0
+
+    def generate(self, contents, image_count, json_reply=False):
+        """Reply text for a request; raises on errors, which the caller may retry"""
+        start = time.perf_counter()
+        try:
+            text = self._generate(contents, json_reply)
+        except Exception:
+            with self.lock:
+                self.errors += 1
+            raise
+        seconds = time.perf_counter() - start
+        with self.lock:
+            self.latency.add(seconds)
+            self.images += image_count
+        metrics.observe(f"backend.{self.name}", seconds)
+        return text
+
+    def _generate(self, contents, json_reply):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def latency_summary(self):
+        """One line, e.g. 'gemini: 12 calls for 90 images, p50 1.20s, p99 2.41s, 0.16s per image, 0 errors'"""
+        with self.lock:
+            latency = self.latency
+            if not latency.count:
+                return f"{self.description}: no calls ({self.errors} errors)"
+            text = (f"{self.description}: {latency.count} calls for {self.images} images, "
+                    f"p50 {latency.percentile(50):.2f}s, p99 {latency.percentile(99):.2f}s")
+            if self.images:
+                text += f", {latency.total / self.images:.2f}s per image"
+            return text + f", {self.errors} errors"
+
+
+class ModelBackend(VisionBackend):
+    """Any object with generate_content(contents, **kwargs), like a genai model or a test stub"""
+
+    def __init__(self, model, name='model', capabilities=None):
+        super().__init__(capabilities or Capabilities())
+        self.model = model
+        self.name = name
+
+    def _generate(self, contents, json_reply):
+        kwargs = {'generation_config': {'response_mime_type': 'application/json'}} if json_reply else {}
+        return self.model.generate_content(contents, **kwargs).text
+
+
+class GeminiBackend(ModelBackend):
+    def __init__(self, genai, model_name, api_key, default_model=None):
+        genai.configure(api_key=api_key)
+        super().__init__(genai.GenerativeModel(model_name), name='gemini')
+        self.model_name = model_name
+        # Names cached before backends existed came from the default model
+        self.cache_scope = '' if model_name == default_model else f"gemini:{model_name}"
+
+    @property
+    def description(self):
+        return f"Gemini ({self.model_name})"
+
+
+class LocalBackend(VisionBackend):
+    """A function on this machine; one CPU slot, so calls run one at a time"""
+    name = 'local'
+
+    def __init__(self, spec, max_edge=0):
+        super().__init__(Capabilities(batching=False, concurrent=False, max_edge=max_edge))
+        module_name, _, function_name = (spec or '').partition(':')
+        if not module_name or not function_name:
+            raise BackendError("local_model must be 'module:function'")
+        try:
+            self.function = getattr(importlib.import_module(module_name), function_name)
+        except (ImportError, AttributeError) as e:
+            raise BackendError(f"can't load {spec}: {e}") from None
+        self.spec = spec
+        self.cache_scope = f"local:{spec}"
+        self.slot = threading.Lock()
+
+    @property
+    def description(self):
+        return f"local ({self.spec})"
+
+    def _generate(self, contents, json_reply):
+        from PIL import Image
+
+        prompt = ''.join(part for part in contents if isinstance(part, str))
+        images = [part for part in contents if not isinstance(part, str)]
+        if len(images) != 1:
+            raise BackendError(f"the local backend names one image per call, got {len(images)}")
+        image = images[0]
+        if isinstance(image, dict):
+            image = Image.open(io.BytesIO(image['data']))
+        with self.slot:
+            return str(self.function(image, prompt))
+
+
+class RecordingBackend(VisionBackend):
+    """Passes requests to another backend and appends each reply to a JSONL file"""
+
+    def __init__(self, inner, path):
+        super().__init__(inner.capabilities)
+        self.inner = inner
+        self.name = inner.name
+        self.cache_scope = inner.cache_scope
+        self.path = path
+        folder = os.path.dirname(os.path.abspath(path))
+        os.makedirs(folder, exist_ok=True)
+        self.file = open(path, 'a', encoding='utf-8')
+        self.file_lock = threading.Lock()
+
+    @property
+    def description(self):
+        return f"{self.inner.description}, recording to {os.path.basename(self.path)}"
+
+    def _generate(self, contents, json_reply):
+        start = time.perf_counter()
+        text = self.inner._generate(contents, json_reply)
+        capabilities = self.inner.capabilities
+        line = json.dumps({'key': request_key(contents, json_reply), 'reply': text,
+                           'seconds': round(time.perf_counter() - start, 4), 'backend': self.inner.description,
+                           'batching': capabilities.batching, 'concurrent': capabilities.concurrent,
+                           'max_edge': capabilities.max_edge})
+        with self.file_lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+        return text
+
+    def close(self):
+        with self.file_lock:
+            self.file.close()
+        self.inner.close()
+
+
+class ReplayBackend(VisionBackend):
+    """Serves replies from a recording, after the latency they took then.
+
+    Takes the capabilities of the backend that made the recording (the
+    last one, if several appended to it); recordings from before they were
+    noted get the defaults.
+    """
+    name = 'replay'
+    cache_scope = 'replay'
+
+    def __init__(self, path, speed=1.0):
+        capabilities = Capabilities()
+        self.path = path
+        self.speed = speed
+        self.replies = {}
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.replies[entry['key']] = (entry['reply'], entry.get('seconds', 0.0))
+                        if 'batching' in entry:
+                            capabilities = Capabilities(bool(entry['batching']), bool(entry['concurrent']),
+                                                        int(entry['max_edge']))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            raise BackendError(f"can't read recording {path}: {e}") from None
+        super().__init__(capabilities)
+
+    @property
+    def description(self):
+        return f"replay ({os.path.basename(self.path)}, {len(self.replies)} replies)"
+
+    def _generate(self, contents, json_reply):
+        found = self.replies.get(request_key(contents, json_reply))
+        if found is None:
+            raise ReplayMiss("request not in the recording (different files or upload/batch settings?)")
+        text, seconds = found
+        if self.speed:
+            time.sleep(seconds * self.speed)
+        return text
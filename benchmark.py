@@ -0,0 +1,457 @@
+"""Reproducible performance benchmark for the sorting pipeline.
+
+Generates a synthetic screenshot corpus, swaps Gemini for a local stub with
+configurable latency and error rates, and times each stage:
+
+  startup    importing main.py in a fresh interpreter, checked against a budget
+  scan       listing the source folder (engine.scan)
+  thumbnail  decoding preview thumbnails (thumbs.decode_thumbnail on a pool)
+  sort       a manual category sort (engine.sort_files)
+  ai         an AI sort against the stub model (engine.ai_sort_files)
+
+Per stage it reports throughput, p50/p99 latency of the stage's unit of
+work, peak RSS and bytes written, and saves everything as JSON so two runs
+can be compared:
+
+  python benchmark.py --count 500 --output before.json
+  python benchmark.py --count 500 --output after.json --compare before.json
+
+The ai stage can instead replay a recording (main.py sort --ai --record,
+or --record here) of the same corpus, to load-test with a real backend's
+replies and latency but without its cost:
+
+  python benchmark.py --stages ai --corpus shots --replay gemini.jsonl --workers 8
+
+The startup stage fails the run (exit status 1) when importing main.py takes
+longer than --import-budget or pulls in a module that should load lazily.
+
+Nothing here touches the real config, journal or caches.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageDraw
+
+from metrics import metrics
+from transcode import OUTPUT_FORMATS
+
+try:
+    import resource
+except ImportError:     # Windows
+    resource = None
+
+STAGES = ('startup', 'scan', 'thumbnail', 'sort', 'ai')
+FORMATS = {'png': 'PNG', 'jpg': 'JPEG', 'webp': 'WEBP'}
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Modules that importing main.py must not load; they are imported on first use
+LAZY_MODULES = ('google.generativeai', 'numpy', 'argparse')
+
+STARTUP_SNIPPET = f"""
+import sys, time
+start = time.perf_counter()
+import main
+seconds = time.perf_counter() - start
+print(seconds, ','.join(name for name in {LAZY_MODULES!r} if name in sys.modules))
+"""
+
+
+# ---- synthetic corpus ----------------------------------------------------
+
+def draw_screenshot(args):
+    """Worker: write one fake UI screenshot (bars, bubbles, text lines)"""
+    path, width, height, fmt, seed = args
+    rng = random.Random(seed)
+    background = rng.choice([(250, 250, 250), (32, 33, 36), (255, 255, 255), (18, 18, 18)])
+    img = Image.new('RGB', (width, height), background)
+    draw = ImageDraw.Draw(img)
+    accent = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+    draw.rectangle([0, 0, width, height // 14], fill=accent)
+    ink = (20, 20, 20) if sum(background) > 384 else (230, 230, 230)
+    y = height // 10
+    while y < height - 60:
+        x = rng.choice([width // 20, width // 3])
+        box_w = rng.randint(width // 4, width // 2)
+        box_h = rng.randint(40, 140)
+        draw.rounded_rectangle([x, y, x + box_w, y + box_h], 12,
+                               fill=rng.choice([accent, (200, 200, 205), background]))
+        for line_y in range(y + 14, y + box_h - 10, 18):
+            draw.line([x + 12, line_y, x + rng.randint(box_w // 3, box_w - 12), line_y], fill=ink, width=3)
+        y += box_h + rng.randint(10, 40)
+    save_args = {'quality': 90} if fmt in ('JPEG', 'WEBP') else {}
+    img.save(path, fmt, **save_args)
+    return os.path.getsize(path)
+
+
+def make_corpus(folder, count, width, height, fmt, seed=0):
+    """Create (or reuse) count synthetic screenshots in folder"""
+    manifest_path = os.path.join(folder, 'corpus.json')
+    manifest = {'count': count, 'width': width, 'height': height, 'format': fmt, 'seed': seed}
+    try:
+        with open(manifest_path, 'r') as f:
+            if json.load(f) == manifest:
+                return
+    except (OSError, ValueError):
+        pass
+
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+    ext = 'jpg' if fmt == 'JPEG' else fmt.lower()
+    jobs = [(os.path.join(folder, f"Screenshot_{i:06d}.{ext}"), width, height, fmt, seed * 1000003 + i)
+            for i in range(count)]
+    with ProcessPoolExecutor() as pool:
+        list(pool.map(draw_screenshot, jobs, chunksize=8))
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+
+
+# ---- stub model ----------------------------------------------------------
+
+class StubResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class RateLimited(Exception):
+    code = 429
+
+
+class StubVisionModel:
+    """Stands in for GenerativeModel.generate_content"""
+
+    def __init__(self, latency=0.2, jitter=0.5, error_rate=0.0, rate_limit_rate=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def generate_content(self, contents, **kwargs):
+        with self.lock:
+            self.calls += 1
+            call = self.calls
+            roll = self.rng.random()
+            delay = self.latency * (1 + self.jitter * (self.rng.random() * 2 - 1))
+        time.sleep(max(0.0, delay))
+        if roll < self.rate_limit_rate:
+            raise RateLimited("429 Resource exhausted (stub)")
+        if roll < self.rate_limit_rate + self.error_rate:
+            raise RuntimeError("stub model error")
+
+        images = sum(1 for part in contents if not isinstance(part, str))
+        if images > 1:
+            return StubResponse(json.dumps([{'image': i + 1, 'filename': f"synthetic-capture-{call}-{i + 1}"}
+                                            for i in range(images)]))
+        return StubResponse(f"synthetic-capture-{call}")
+
+
+# ---- measurement ---------------------------------------------------------
+
+def peak_rss_mb():
+    """Peak resident set size of this process and its pool workers so far"""
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(max(own, children) / scale, 1)
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct / 100
+    lower = int(k)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (k - lower)
+
+
+def folder_bytes(folder):
+    total = 0
+    for root, _, files in os.walk(folder):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def stage_report(items, seconds, latencies, bytes_written=0, **extra):
+    report = {
+        'items': items,
+        'seconds': round(seconds, 4),
+        'throughput_per_s': round(items / seconds, 2) if seconds > 0 else None,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3) if latencies else None,
+        'peak_rss_mb': peak_rss_mb(),
+        'bytes_written': bytes_written,
+    }
+    report.update(extra)
+    return report
+
+
+def timed_method(obj, name, latencies):
+    """Wrap obj.name so every call's duration is appended to latencies"""
+    original = getattr(obj, name)
+
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return original(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+    setattr(obj, name, wrapper)
+
+
+def timed_decode(args):
+    from thumbs import decode_thumbnail
+
+    path, size = args
+    start = time.perf_counter()
+    decode_thumbnail(path, size)
+    return time.perf_counter() - start
+
+
+# ---- stages --------------------------------------------------------------
+
+def bench_startup(args):
+    latencies = []
+    eager = set()
+    # The first run only warms the bytecode and OS file caches
+    for _ in range(args.startup_runs + 1):
+        output = subprocess.run([sys.executable, '-c', STARTUP_SNIPPET], cwd=APP_DIR, check=True,
+                                capture_output=True, text=True).stdout
+        seconds, _, loaded = output.strip().splitlines()[-1].partition(' ')
+        latencies.append(float(seconds))
+        eager.update(name for name in loaded.split(',') if name)
+    latencies = latencies[1:]
+    return stage_report(len(latencies), sum(latencies), latencies, unit="one import of main.py",
+                        eager_imports=sorted(eager), budget_ms=args.import_budget)
+
+
+def bench_scan(engine, corpus, args):
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        t = time.perf_counter()
+        files = list(engine.scan(corpus))
+        latencies.append(time.perf_counter() - t)
+    seconds = time.perf_counter() - start
+    return stage_report(len(files) * args.repeat, seconds, latencies, unit="full folder listing")
+
+
+def bench_thumbnail(engine, corpus, args):
+    from thumbgrid import THUMB_SIZE
+
+    paths = [os.path.join(corpus, name) for name in engine.scan(corpus)]
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.thumb_workers) as pool:
+        latencies = list(pool.map(timed_decode, [(path, THUMB_SIZE) for path in paths], chunksize=4))
+    seconds = time.perf_counter() - start
+    return stage_report(len(paths), seconds, latencies, unit="one thumbnail decode")
+
+
+def bench_sort(engine, corpus, args, dest):
+    latencies = []
+    # Re-encoded files are placed by finish_output, which waits for the encode
+    timed_method(engine, 'finish_output' if engine.transcoder.active else 'transfer', latencies)
+    engine.transfer_settings['mode'] = args.mode
+    # Moving would empty the corpus for the stages after this one
+    work = corpus
+    if args.mode == 'move':
+        work = os.path.join(os.path.dirname(dest), 'move_source')
+        shutil.copytree(corpus, work)
+    filenames = list(engine.scan(work))
+    start = time.perf_counter()
+    results = list(engine.sort_files(work, dest, filenames, 'others'))
+    seconds = time.perf_counter() - start
+    failed = sum(not result.ok for result in results)
+    return stage_report(len(results), seconds, latencies, folder_bytes(os.path.join(dest, 'others')),
+                        failed=failed, mode=args.mode, unit="one file transfer",
+                        output=engine.transcoder.summary() if engine.transcoder.active else None)
+
+
+def bench_ai(engine, corpus, args, dest):
+    from backends import ModelBackend, RecordingBackend, ReplayBackend
+
+    if args.replay:
+        # A recording of this corpus: real replies at their real latency
+        backend = ReplayBackend(args.replay, speed=args.replay_speed)
+    else:
+        backend = ModelBackend(StubVisionModel(args.latency, args.jitter, args.error_rate, args.rate_limit_rate,
+                                               args.seed), name='stub')
+    if args.record:
+        backend = RecordingBackend(backend, args.record)
+    engine.backend = backend
+    engine.ai_settings.update(workers=args.workers, requests_per_minute=args.rpm,
+                              batch_size=args.batch_size, cache=False)
+    latencies = []
+    timed_method(engine, 'send_to_model', latencies)
+    filenames = list(engine.scan(corpus))
+    start = time.perf_counter()
+    results = list(engine.ai_sort_files(corpus, dest, filenames, prompt="Name this screenshot"))
+    seconds = time.perf_counter() - start
+    failed = sum(not result.ok for result in results)
+    return stage_report(len(results), seconds, latencies, folder_bytes(os.path.join(dest, 'ai_renamed')),
+                        failed=failed, model_calls=backend.latency.count, unit="one model request",
+                        upload=engine.upload_stats.summary(), backend=backend.latency_summary())
+
+
+# ---- driver --------------------------------------------------------------
+
+def run(args):
+    from engine import SortEngine
+
+    metrics.reset()
+    metrics.enable(trace=bool(args.trace))
+    results = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpu_count': os.cpu_count()},
+        'parameters': {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'trace')},
+        'stages': {},
+    }
+    stages = list(args.stages)
+    if 'startup' in stages:
+        # Measured first, before this process has warmed anything else up
+        print("⏱  startup...", file=sys.stderr)
+        results['stages']['startup'] = bench_startup(args)
+        stages.remove('startup')
+    if not stages:
+        return results
+
+    fmt = FORMATS[args.format]
+    corpus = args.corpus or os.path.join(tempfile.gettempdir(), 'sortshot-bench',
+                                         f"corpus-{args.count}-{args.width}x{args.height}-{args.format}")
+    start = time.perf_counter()
+    make_corpus(corpus, args.count, args.width, args.height, fmt, args.seed)
+    corpus_seconds = time.perf_counter() - start
+    results['corpus'] = {'path': corpus, 'bytes': folder_bytes(corpus), 'prepare_seconds': round(corpus_seconds, 3)}
+
+    work = tempfile.mkdtemp(prefix='sortshot-bench-')
+    engine = SortEngine(config_path=os.path.join(work, 'config.json'),
+                        journal_path=os.path.join(work, 'journal.db'))
+    engine.output_settings['format'] = args.output_format
+    try:
+        runners = {
+            'scan': lambda: bench_scan(engine, corpus, args),
+            'thumbnail': lambda: bench_thumbnail(engine, corpus, args),
+            'sort': lambda: bench_sort(engine, corpus, args, os.path.join(work, 'sorted')),
+            'ai': lambda: bench_ai(engine, corpus, args, os.path.join(work, 'sorted')),
+        }
+        for stage in stages:
+            print(f"⏱  {stage}...", file=sys.stderr)
+            # The pipeline's own progress prints would swamp the report
+            with contextlib.redirect_stdout(io.StringIO()):
+                results['stages'][stage] = runners[stage]()
+    finally:
+        engine.shutdown()
+        shutil.rmtree(work, ignore_errors=True)
+    results['metrics'] = metrics.snapshot()
+    if args.trace:
+        metrics.export_trace(args.trace)
+    return results
+
+
+def print_report(results, baseline=None):
+    print(f"{'stage':<10} {'items':>7} {'seconds':>9} {'per s':>9} {'p50 ms':>9} {'p99 ms':>9} "
+          f"{'RSS MB':>8} {'written MB':>11}")
+    for stage, report in results['stages'].items():
+        def cell(key, scale=1, digits=1):
+            value = report.get(key)
+            return '-' if value is None else f"{value / scale:.{digits}f}"
+        print(f"{stage:<10} {report['items']:>7} {cell('seconds', digits=3):>9} {cell('throughput_per_s'):>9} "
+              f"{cell('p50_ms', digits=2):>9} {cell('p99_ms', digits=2):>9} {cell('peak_rss_mb'):>8} "
+              f"{cell('bytes_written', 1e6):>11}")
+        old = (baseline or {}).get('stages', {}).get(stage)
+        if old and old.get('throughput_per_s') and report.get('throughput_per_s'):
+            change = report['throughput_per_s'] / old['throughput_per_s'] - 1
+            print(f"{'':<10} throughput {change:+.1%} vs baseline")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmark the screenshot sorting pipeline")
+    parser.add_argument('--count', type=int, default=200, help="Screenshots in the corpus")
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--format', choices=FORMATS, default='png')
+    parser.add_argument('--corpus', help="Corpus folder (default: a cached one in the temp dir)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stages', type=lambda s: [x for x in s.split(',') if x], default=list(STAGES),
+                        help=f"Comma separated subset of {','.join(STAGES)}")
+    parser.add_argument('--import-budget', type=float, default=250.0,
+                        help="Max median milliseconds to import main.py (startup stage)")
+    parser.add_argument('--startup-runs', type=int, default=5, help="Fresh interpreters to time")
+    parser.add_argument('--repeat', type=int, default=5, help="Scan repetitions")
+    parser.add_argument('--thumb-workers', type=int, default=max(1, (os.cpu_count() or 2) - 1))
+    parser.add_argument('--mode', default='copy', help="Transfer mode for the sort stage")
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS, default='keep',
+                        help="What the sort and ai stages write sorted files as")
+    parser.add_argument('--latency', type=float, default=0.2, help="Stub model seconds per call")
+    parser.add_argument('--jitter', type=float, default=0.5, help="Latency +/- fraction")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of calls that fail")
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help="Fraction of calls answered 429")
+    parser.add_argument('--replay', help="Serve the ai stage from a recording instead of the stub model")
+    parser.add_argument('--replay-speed', type=float, default=1.0,
+                        help="Recorded latency multiplier when replaying (0 = none)")
+    parser.add_argument('--record', help="Record the ai stage's requests and replies to this JSONL file")
+    parser.add_argument('--workers', type=int, default=4, help="Parallel model requests")
+    parser.add_argument('--rpm', type=int, default=6000, help="Requests per minute limit")
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--output', help="Write results JSON here")
+    parser.add_argument('--compare', help="Earlier results JSON to compare throughput with")
+    parser.add_argument('--trace', help="Also write a Chrome trace of the whole run here")
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    unknown = set(args.stages) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stage(s): {', '.join(sorted(unknown))}")
+
+    results = run(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+    print()
+    print(metrics.summary())
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    startup = results['stages'].get('startup')
+    if startup:
+        if startup['p50_ms'] > args.import_budget:
+            print(f"❌ Importing main.py took {startup['p50_ms']:.0f} ms, budget is {args.import_budget:.0f} ms")
+            return 1
+        if startup['eager_imports']:
+            print(f"❌ Importing main.py loaded {', '.join(startup['eager_imports'])}, which should load lazily")
+            return 1
+        print(f"✅ Startup within budget ({startup['p50_ms']:.0f} of {args.import_budget:.0f} ms)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
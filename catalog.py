@@ -0,0 +1,327 @@
+"""Metadata catalog of scanned images, and the query language over it.
+
+Every scan records each image's name, size, mtime, format and position in
+the scan order per source folder. Pixel dimensions are read from the image
+headers in the background afterwards, and perceptual hashes are copied in
+from the duplicate finder's cache when it has them. Rows whose size and mtime did not change keep what
+was already known, so re-loading a folder is cheap.
+
+A query is a list of terms that must all match:
+
+    format:png size>1M dims:1080x2400 age<7d
+    -name:*draft* in:2023/05 width>=1920 orientation:portrait
+
+Terms are field, operator (: = != > >= < <=) and value; a leading '-'
+negates a term and a bare word matches part of the name. format takes a
+comma separated list. Sizes take K/M/G, dates are YYYY-MM-DD (date:X is
+that whole day) and ages are a number of m/h/d/w. Queries become one SQL
+statement against indexed columns, so a few hundred thousand images are
+searched in milliseconds. Results are scan positions, which are exactly the
+thumbnail grid's indices, so selecting them needs no name lookups.
+"""
+import os
+import re
+import shlex
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from metrics import metrics
+from scanner import read_dimensions
+
+BATCH_SIZE = 500
+MMAP_SIZE = 256 * 1024 * 1024
+
+SIZE_UNITS = {'': 1, 'b': 1, 'k': 1024, 'kb': 1024, 'm': 1024 ** 2, 'mb': 1024 ** 2,
+              'g': 1024 ** 3, 'gb': 1024 ** 3}
+AGE_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
+FORMAT_ALIASES = {'jpg': 'jpeg', 'tif': 'tiff'}
+FIELD_ALIASES = {'w': 'width', 'h': 'height', 'type': 'format', 'ext': 'format',
+                 'modified': 'date', 'mtime': 'date', 'folder': 'in', 'dimensions': 'dims'}
+
+TERM = re.compile(r'^(-?)([a-z]+)(>=|<=|!=|>|<|=|:)(.*)$', re.IGNORECASE)
+COMPARISONS = {':': '=', '=': '=', '!=': '!=', '>': '>', '>=': '>=', '<': '<', '<=': '<='}
+
+
+class QueryError(ValueError):
+    pass
+
+
+def parse_size(text):
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)\s*([a-z]*)', text.strip().lower())
+    if not match or match.group(2) not in SIZE_UNITS:
+        raise QueryError(f"bad size {text!r} (e.g. 500K, 2M)")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+def parse_age(text):
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)([smhdw])', text.strip().lower())
+    if not match:
+        raise QueryError(f"bad age {text!r} (e.g. 12h, 7d, 2w)")
+    return float(match.group(1)) * AGE_UNITS[match.group(2)]
+
+
+def parse_day(text):
+    try:
+        return datetime.strptime(text, '%Y-%m-%d').timestamp()
+    except ValueError:
+        raise QueryError(f"bad date {text!r} (use YYYY-MM-DD)") from None
+
+
+def parse_int(text, what):
+    try:
+        return int(text)
+    except ValueError:
+        raise QueryError(f"bad {what} {text!r}") from None
+
+
+def glob_to_like(pattern):
+    """fnmatch-style glob as a LIKE pattern (escaped with backslash)"""
+    escaped = pattern.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return escaped.replace('*', '%').replace('?', '_').replace('/', os.sep.replace('\\', '\\\\'))
+
+
+def _range(column, op, low, high):
+    """Condition for column against the half-open interval [low, high)"""
+    if op == '=':
+        return f'({column} >= ? AND {column} < ?)', [low, high]
+    if op == '!=':
+        return f'({column} < ? OR {column} >= ?)', [low, high]
+    if op in ('>', '>='):
+        return f'{column} >= ?', [high if op == '>' else low]
+    return f'{column} < ?', [low if op == '<' else high]
+
+
+def compile_term(field, op, value, now):
+    """(sql, params) for one term"""
+    field = FIELD_ALIASES.get(field, field)
+    compare = COMPARISONS[op]
+    if field == 'name':
+        if compare not in ('=', '!='):
+            raise QueryError("name only takes : or !=")
+        # Like scan globs: the relative path or just the file name
+        pattern = glob_to_like(value if any(c in value for c in '*?') else f'*{value}*')
+        sql = "(name LIKE ? ESCAPE '\\' OR name LIKE ? ESCAPE '\\')"
+        params = [pattern, '%' + glob_to_like('/') + pattern]
+        return (f'NOT {sql}' if compare == '!=' else sql), params
+    if field == 'in':
+        if compare != '=':
+            raise QueryError("in only takes :")
+        return "name LIKE ? ESCAPE '\\'", [glob_to_like(value.rstrip('/') + '/*')]
+    if field == 'format':
+        if compare not in ('=', '!='):
+            raise QueryError("format only takes : or !=")
+        formats = [FORMAT_ALIASES.get(f, f) for f in value.lower().split(',') if f]
+        negate = 'NOT ' if compare == '!=' else ''
+        return f"format {negate}IN ({','.join('?' * len(formats))})", formats
+    if field == 'size':
+        return f'size {compare} ?', [parse_size(value)]
+    if field in ('width', 'height'):
+        return f'{field} {compare} ?', [parse_int(value, field)]
+    if field == 'dims':
+        width, _, height = value.lower().partition('x')
+        width, height = parse_int(width, 'width'), parse_int(height, 'height')
+        joiner = ' OR ' if compare == '!=' else ' AND '
+        return f'(width {compare} ?{joiner}height {compare} ?)', [width, height]
+    if field == 'orientation':
+        shapes = {'portrait': 'height > width', 'landscape': 'width > height', 'square': 'width = height'}
+        if compare != '=' or value.lower() not in shapes:
+            raise QueryError("orientation: portrait, landscape or square")
+        return f'({shapes[value.lower()]} AND width > 0)', []
+    if field == 'date':
+        start = parse_day(value)
+        return _range('mtime_ns', compare, int(start * 1e9), int((start + 86400) * 1e9))
+    if field == 'age':
+        # Older means a smaller mtime, so the comparison flips
+        flipped = {'>': '<', '>=': '<=', '<': '>', '<=': '>=', '=': '=', '!=': '!='}[compare]
+        if flipped in ('=', '!='):
+            raise QueryError("age takes < or > (e.g. age<7d)")
+        return f'mtime_ns {flipped} ?', [int((now - parse_age(value)) * 1e9)]
+    if field in ('dhash', 'phash'):
+        try:
+            number = int(value, 16)
+        except ValueError:
+            raise QueryError(f"bad {field} {value!r} (hex)") from None
+        if compare not in ('=', '!='):
+            raise QueryError(f"{field} only takes : or !=")
+        return f'{field} {compare} ?', [number - (1 << 64) if number >= 1 << 63 else number]
+    raise QueryError(f"unknown field {field!r}")
+
+
+def compile_query(text, now=None):
+    """(where clause, params) for a query string; raises QueryError"""
+    now = time.time() if now is None else now
+    try:
+        words = shlex.split(text)
+    except ValueError as e:
+        raise QueryError(str(e)) from None
+    clauses, params = [], []
+    for word in words:
+        match = TERM.match(word)
+        if match:
+            negate, field, op, value = match.groups()
+            if not value:
+                raise QueryError(f"missing value in {word!r}")
+            sql, args = compile_term(field.lower(), op, value, now)
+        else:
+            negate = '-' if word.startswith('-') and len(word) > 1 else ''
+            sql, args = compile_term('name', ':', word[len(negate):], now)
+        clauses.append(f'NOT {sql}' if negate else sql)
+        params.extend(args)
+    return ' AND '.join(clauses) or '1', params
+
+
+class Catalog:
+    """SQLite table of image metadata, one row per (source folder, name)"""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        # Broad queries visit rows all over the file; mapped pages beat the page cache
+        self.db.execute(f'PRAGMA mmap_size={MMAP_SIZE}')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS roots (
+                               id INTEGER PRIMARY KEY,
+                               path TEXT NOT NULL UNIQUE)''')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS images (
+                               root INTEGER NOT NULL,
+                               name TEXT NOT NULL,
+                               position INTEGER NOT NULL,
+                               size INTEGER NOT NULL,
+                               mtime_ns INTEGER NOT NULL,
+                               format TEXT NOT NULL,
+                               width INTEGER,
+                               height INTEGER,
+                               dhash INTEGER,
+                               phash INTEGER,
+                               scan_id INTEGER NOT NULL,
+                               PRIMARY KEY (root, name))''')
+        # Only the columns that narrow a query down well; the rest are filtered
+        for columns in ('size', 'mtime_ns', 'width, height'):
+            index = f"images_{columns.replace(', ', '_')}"
+            self.db.execute(f'CREATE INDEX IF NOT EXISTS {index} ON images (root, {columns})')
+        self.db.commit()
+        self.lock = threading.Lock()
+        self.root_ids = {}
+
+    def root_id(self, root):
+        """Integer id for a source folder, created on first use"""
+        root = os.path.abspath(root)
+        if root not in self.root_ids:
+            with self.lock:
+                self.db.execute('INSERT OR IGNORE INTO roots (path) VALUES (?)', (root,))
+                self.root_ids[root] = self.db.execute('SELECT id FROM roots WHERE path = ?', (root,)).fetchone()[0]
+                self.db.commit()
+        return self.root_ids[root]
+
+    def update(self, root, entries, scan_id, first_position):
+        """Upsert ScanEntry objects seen by scan scan_id, numbered from first_position.
+
+        Dimensions and hashes survive as long as size and mtime are unchanged.
+        """
+        root_id = self.root_id(root)
+        entries = list(entries)
+        if not entries:
+            return
+        with self.lock, metrics.timer('catalog.update', rows=len(entries)):
+            known = {}
+            for start in range(0, len(entries), BATCH_SIZE):
+                names = [entry.name for entry in entries[start:start + BATCH_SIZE]]
+                known.update((name, (size, mtime_ns)) for name, size, mtime_ns in self.db.execute(
+                    f'''SELECT name, size, mtime_ns FROM images
+                        WHERE root = ? AND name IN ({','.join('?' * len(names))})''', [root_id, *names]))
+            # Unchanged files only get their new position, which leaves every index
+            # alone; rewriting those (scattered) index pages is what makes a rescan slow
+            unchanged, changed = [], []
+            for position, entry in enumerate(entries, first_position):
+                if known.get(entry.name) == (entry.size, entry.mtime_ns):
+                    unchanged.append((position, scan_id, root_id, entry.name))
+                else:
+                    changed.append((root_id, entry.name, position, entry.size, entry.mtime_ns, entry.format, scan_id))
+            self.db.executemany('UPDATE images SET position = ?, scan_id = ? WHERE root = ? AND name = ?', unchanged)
+            self.db.executemany('''INSERT OR REPLACE INTO images (root, name, position, size, mtime_ns, format, scan_id)
+                                   VALUES (?, ?, ?, ?, ?, ?, ?)''', changed)
+            self.db.commit()
+
+    def prune(self, root, scan_id):
+        """Forget files a finished scan of root no longer saw"""
+        root_id = self.root_id(root)
+        with self.lock:
+            self.db.execute('DELETE FROM images WHERE root = ? AND scan_id != ?', (root_id, scan_id))
+            # Keeps the planner's statistics current, so a broad filter scans
+            # the table instead of walking an index that matches everything
+            self.db.execute('PRAGMA optimize')
+            self.db.commit()
+
+    def count(self, root):
+        root_id = self.root_id(root)
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM images WHERE root = ?', (root_id,)).fetchone()[0]
+
+    def fill_dimensions(self, root, workers=4, should_stop=None, progress=None):
+        """Read the header of every image with unknown dimensions.
+
+        progress(done, total) is called after each batch. Unreadable images
+        get 0x0 so they aren't retried until they change.
+        """
+        root_id = self.root_id(root)
+        with self.lock:
+            names = [name for name, in self.db.execute(
+                'SELECT name FROM images WHERE root = ? AND width IS NULL', (root_id,))]
+        if not names:
+            return 0
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='catalog') as pool:
+            for start in range(0, len(names), BATCH_SIZE):
+                if should_stop and should_stop():
+                    break
+                chunk = names[start:start + BATCH_SIZE]
+                with metrics.timer('catalog.dimensions', images=len(chunk)):
+                    sizes = pool.map(read_dimensions, [os.path.join(root, name) for name in chunk])
+                    rows = [(*(size or (0, 0)), root_id, name) for name, size in zip(chunk, sizes)]
+                with self.lock:
+                    self.db.executemany('UPDATE images SET width = ?, height = ? WHERE root = ? AND name = ?',
+                                        rows)
+                    self.db.commit()
+                if progress:
+                    progress(start + len(chunk), len(names))
+        return len(names)
+
+    def fill_hashes(self, root, hash_cache):
+        """Copy still-valid perceptual hashes from a dupes.HashCache"""
+        root_id = self.root_id(root)
+        with self.lock:
+            rows = self.db.execute('SELECT name, size, mtime_ns FROM images WHERE root = ? AND dhash IS NULL',
+                                   (root_id,)).fetchall()
+        stats = {os.path.join(root, name): (size, mtime_ns) for name, size, mtime_ns in rows}
+        found = hash_cache.get_many(stats)
+        updates = [(dhash, phash, root_id, os.path.relpath(path, root)) for path, (dhash, phash) in found.items()]
+        with self.lock:
+            self.db.executemany('UPDATE images SET dhash = ?, phash = ? WHERE root = ? AND name = ?', updates)
+            self.db.commit()
+        return len(updates)
+
+    def query(self, root, text, scan_id=None):
+        """Scan positions of the images under root matching a query string.
+
+        With scan_id, only rows that scan saw, so the positions are
+        guaranteed to line up with its results. Raises QueryError.
+        """
+        where, params = compile_query(text)
+        root_id = self.root_id(root)
+        if scan_id is not None:
+            where = f'scan_id = ? AND ({where})'
+            params = [scan_id, *params]
+        with self.lock, metrics.timer('catalog.query', query=text):
+            try:
+                rows = self.db.execute(f'SELECT position FROM images WHERE root = ? AND ({where})',
+                                       [root_id, *params])
+                return [position for position, in rows]
+            except sqlite3.OperationalError as e:
+                raise QueryError(str(e)) from None
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,209 @@
+"""Offline screenshot classifier trained on the user's own sorting history.
+
+Features come from a 64x64 copy of each image: shape, color histograms,
+saturation/brightness, edge and text density, and how much of the picture
+is taken by its dominant UI colors. A small softmax regression maps them
+to categories. Only predictions above a confidence threshold are trusted;
+everything else still goes to Gemini.
+
+Needs NumPy; without it the classifier is simply never used.
+"""
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from PIL import Image
+
+from metrics import metrics
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+SAMPLE_SIZE = 64
+MIN_SAMPLES_PER_CATEGORY = 5
+
+
+def extract_features(path):
+    """Worker side: 1-D float32 feature vector for one image, or None"""
+    try:
+        with Image.open(path) as img:
+            width, height = img.size
+            if img.format == 'JPEG':
+                img.draft('RGB', (SAMPLE_SIZE * 2, SAMPLE_SIZE * 2))
+            img.load()
+            # RGB first: reduce() can't take palette, 1-bit or 16-bit images
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+            factor = max(img.size) // (SAMPLE_SIZE * 2)
+            if factor >= 2:
+                img = img.reduce(factor)
+            small = img.resize((SAMPLE_SIZE, SAMPLE_SIZE), Image.BOX)
+            rgb = np.asarray(small, dtype=np.float32) / 255.0
+            hsv = np.asarray(small.convert('HSV'), dtype=np.float32) / 255.0
+    except Exception as e:
+        print(f"Error reading {os.path.basename(path)}: {e}")
+        return None
+
+    hue, saturation, value = hsv[..., 0], hsv[..., 1], hsv[..., 2]
+    gray = rgb @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+    # Shape: tall phone captures vs wide desktop/movie frames
+    shape = [math.log(height / width), math.log(width * height / 1e6)]
+
+    # 8-bin histogram per channel
+    histograms = [np.histogram(rgb[..., c], bins=8, range=(0, 1))[0] / gray.size for c in range(3)]
+
+    # Saturation and brightness, plus a hue histogram weighted by saturation
+    tone = [saturation.mean(), saturation.std(), value.mean(), value.std(),
+            (value < 0.15).mean(), (value > 0.85).mean()]
+    hue_hist = np.histogram(hue, bins=6, range=(0, 1), weights=saturation)[0] / gray.size
+
+    # Edges: text and UI chrome have many short, strong horizontal gradients
+    gx = np.abs(np.diff(gray, axis=1))
+    gy = np.abs(np.diff(gray, axis=0))
+    strong = gx > 0.12
+    edges = [gx.mean(), gy.mean(), strong.mean(), (strong.mean(axis=1) > 0.1).mean()]
+
+    # Dominant UI colors: coverage of the most common colors (4 levels per channel)
+    quantized = (rgb * 3.999).astype(np.int32)
+    codes = quantized[..., 0] * 16 + quantized[..., 1] * 4 + quantized[..., 2]
+    counts = np.bincount(codes.ravel(), minlength=64) / codes.size
+    top = np.argsort(counts)[::-1]
+    top_color = np.array([top[0] // 16, top[0] // 4 % 4, top[0] % 4], dtype=np.float32) / 3
+    dominant = [counts[top[0]], counts[top[:3]].sum(), (counts > 0.01).sum() / 64,
+                top_color.mean(), top_color.max() - top_color.min()]
+
+    return np.concatenate([shape, *histograms, tone, hue_hist, edges, dominant]).astype(np.float32)
+
+
+def extract_many(paths, workers=None):
+    """(features (N, F), valid (N,)) for paths, decoded on a process pool"""
+    workers = workers or max(1, (os.cpu_count() or 2) - 1)
+    try:
+        pool = ProcessPoolExecutor(max_workers=workers)
+    except (OSError, NotImplementedError):
+        pool = ThreadPoolExecutor(max_workers=workers)
+    with pool:
+        rows = [metrics.unwrap('decode.features', row) for row in
+                pool.map(metrics.wrap(extract_features), paths, chunksize=16)]
+    size = next((len(row) for row in rows if row is not None), 0)
+    features = np.zeros((len(paths), size), dtype=np.float32)
+    valid = np.zeros(len(paths), dtype=bool)
+    for i, row in enumerate(rows):
+        if row is not None:
+            features[i] = row
+            valid[i] = True
+    return features, valid
+
+
+class LocalClassifier:
+    """Softmax regression over standardized features.
+
+    Softmax is confidently wrong on images unlike anything it was trained
+    on, so each category also keeps a centroid and a radius; a prediction
+    further than that from its category's centroid gets zero confidence.
+    """
+
+    def __init__(self, classes, mean, scale, weights, bias, centroids, radii):
+        self.classes = list(classes)
+        self.mean = mean
+        self.scale = scale
+        self.weights = weights
+        self.bias = bias
+        self.centroids = centroids
+        self.radii = radii
+
+    @classmethod
+    def train(cls, features, labels, epochs=400, learning_rate=0.5, l2=1e-2):
+        classes = sorted(set(labels))
+        y = np.array([classes.index(label) for label in labels])
+        mean = features.mean(axis=0)
+        scale = features.std(axis=0) + 1e-6
+        x = (features - mean) / scale
+        onehot = np.eye(len(classes), dtype=np.float32)[y]
+
+        # Inverse-frequency weights so one busy category doesn't drown the rest
+        frequency = onehot.mean(axis=0)
+        sample_weight = (1.0 / (frequency[y] * len(classes)))[:, None]
+
+        weights = np.zeros((x.shape[1], len(classes)), dtype=np.float32)
+        bias = np.zeros(len(classes), dtype=np.float32)
+        for _ in range(epochs):
+            probs = _softmax(x @ weights + bias)
+            grad = (probs - onehot) * sample_weight / len(x)
+            weights -= learning_rate * (x.T @ grad + l2 * weights)
+            bias -= learning_rate * grad.sum(axis=0)
+
+        centroids = np.stack([x[y == k].mean(axis=0) for k in range(len(classes))])
+        distances = np.linalg.norm(x - centroids[y], axis=1)
+        radii = np.array([np.percentile(distances[y == k], 95) * 1.5 for k in range(len(classes))])
+        return cls(classes, mean, scale, weights, bias, centroids, radii)
+
+    def predict(self, features):
+        """(category per row, confidence per row)"""
+        x = (features - self.mean) / self.scale
+        probs = _softmax(x @ self.weights + self.bias)
+        best = probs.argmax(axis=1)
+        confidence = probs[np.arange(len(best)), best]
+        familiar = np.linalg.norm(x - self.centroids[best], axis=1) <= self.radii[best]
+        return [self.classes[i] for i in best], np.where(familiar, confidence, 0.0)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, classes=np.array(self.classes), mean=self.mean, scale=self.scale,
+                 weights=self.weights, bias=self.bias, centroids=self.centroids, radii=self.radii)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['classes'].tolist(), data['mean'], data['scale'],
+                       data['weights'], data['bias'], data['centroids'], data['radii'])
+
+
+def _softmax(logits):
+    logits = logits - logits.max(axis=1, keepdims=True)
+    exp = np.exp(logits)
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+def train_from_examples(examples, holdout=0.2, seed=0):
+    """Train on [(category, path), ...]; returns (classifier, report dict).
+
+    Categories with fewer than MIN_SAMPLES_PER_CATEGORY readable examples
+    are left out. The report includes accuracy on a held-out share of the
+    examples, measured before the final model is fit on all of them.
+    """
+    paths = [path for _, path in examples]
+    features, valid = extract_many(paths)
+    labels = [category for category, _ in examples]
+    counts = {}
+    for label, ok in zip(labels, valid):
+        if ok:
+            counts[label] = counts.get(label, 0) + 1
+    usable = {label for label, count in counts.items() if count >= MIN_SAMPLES_PER_CATEGORY}
+    keep = np.array([ok and label in usable for label, ok in zip(labels, valid)], dtype=bool)
+    if len(usable) < 2:
+        raise ValueError(f"need at least {MIN_SAMPLES_PER_CATEGORY} sorted screenshots "
+                         f"in two or more categories (have {counts or 'none'})")
+
+    features = features[keep]
+    labels = [label for label, k in zip(labels, keep) if k]
+    order = np.random.default_rng(seed).permutation(len(labels))
+    cut = int(len(order) * holdout)
+    accuracy = None
+    if cut >= len(usable):
+        test, train = order[:cut], order[cut:]
+        if len({labels[i] for i in train}) == len(usable):
+            trial = LocalClassifier.train(features[train], [labels[i] for i in train])
+            predicted, _ = trial.predict(features[test])
+            accuracy = float(np.mean([p == labels[i] for p, i in zip(predicted, test)]))
+
+    model = LocalClassifier.train(features, labels)
+    report = {'samples': len(labels), 'categories': {label: counts[label] for label in sorted(usable)},
+              'holdout_accuracy': accuracy}
+    return model, report
@@ -0,0 +1,164 @@
+"""Category counters that never hand out the same number twice.
+
+The next free number of every category lives in counters.json. Taking
+numbers is a reservation made under an exclusive file lock: read the file,
+bump it, atomically replace it. Several threads, several app windows and a
+cron'd `watch` can all sort into the same folder without two of them
+writing tickets_007.png.
+
+To keep that cheap, numbers are leased in blocks: one locked write covers
+the next LEASE_SIZE files of a category, and the rest come from memory.
+flush() hands back what is left of a lease if nobody leased after it, so
+normally no numbers are lost; a crash can only ever leave a gap.
+"""
+import json
+import os
+import threading
+
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
+
+LEASE_SIZE = 64
+
+
+def write_json_atomic(path, data):
+    """Write data to path so readers see either the old or the new file"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class FileLock:
+    """Exclusive inter-process lock on a side file (path + '.lock')"""
+
+    def __init__(self, path):
+        self.path = path + '.lock'
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, 'a+b')
+        if os.name == 'nt':
+            self.file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after ~10 seconds; keep waiting
+                    continue
+        else:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if os.name == 'nt':
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        self.file.close()
+        self.file = None
+
+
+class CounterStore:
+    """Thread- and process-safe next-number store backed by counters.json"""
+
+    def __init__(self, path, lease_size=LEASE_SIZE):
+        self.path = path
+        self.lease_size = lease_size
+        self.lock = threading.Lock()
+        self.file_lock = FileLock(path)
+        self.leases = {}    # category -> [next number, end of lease (exclusive)]
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    def _read(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def peek(self, category):
+        """Number the next reservation in this category would start at"""
+        with self.lock:
+            lease = self.leases.get(category)
+            if lease and lease[0] < lease[1]:
+                return lease[0]
+        return self._read().get(category, 1)
+
+    def peek_all(self, categories):
+        """{category: next number} for several categories, reading the file once"""
+        stored = self._read()
+        with self.lock:
+            counts = {}
+            for category in categories:
+                lease = self.leases.get(category)
+                counts[category] = lease[0] if lease and lease[0] < lease[1] else stored.get(category, 1)
+            return counts
+
+    def reserve(self, category, count=1):
+        """Reserve count consecutive numbers, returns the first one"""
+        with self.lock:
+            lease = self.leases.get(category)
+            if lease and lease[1] - lease[0] >= count:
+                first = lease[0]
+                lease[0] += count
+                return first
+
+            with self.file_lock:
+                counters = self._read()
+                stored = counters.get(category, 1)
+                if lease and stored == lease[1]:
+                    # Nobody leased after us: extend the current block
+                    first = lease[0]
+                else:
+                    first = stored
+                end = first + max(count, self.lease_size)
+                counters[category] = end
+                write_json_atomic(self.path, counters)
+            self.leases[category] = [first + count, end]
+            return first
+
+    def unreserve(self, category, number):
+        """Give back number if it is the most recent one reserved here"""
+        with self.lock:
+            lease = self.leases.get(category)
+            if lease and lease[0] == number + 1:
+                lease[0] = number
+                return True
+            return False
+
+    def raise_to(self, counts):
+        """Never hand out numbers below counts {category: next number}"""
+        with self.lock, self.file_lock:
+            counters = self._read()
+            changed = False
+            for category, number in counts.items():
+                if number > counters.get(category, 1):
+                    counters[category] = number
+                    self.leases.pop(category, None)
+                    changed = True
+                elif category in self.leases and self.leases[category][0] < number:
+                    # The file is ahead but this lease still points below number
+                    self.leases.pop(category)
+            if changed:
+                write_json_atomic(self.path, counters)
+
+    def flush(self):
+        """Return unused leased numbers, so the stored counters are exact"""
+        with self.lock:
+            unused = {category: lease for category, lease in self.leases.items() if lease[0] < lease[1]}
+            self.leases.clear()
+            if not unused:
+                return
+            with self.file_lock:
+                counters = self._read()
+                for category, (next_number, end) in unused.items():
+                    if counters.get(category, 1) == end:
+                        counters[category] = next_number
+                write_json_atomic(self.path, counters)
@@ -0,0 +1,184 @@
+"""Index of every file sorted into each destination folder.
+
+One row per file placed: its path relative to the destination, the
+category it went to and its number. Placing a file first claims its name
+here, which is a single primary-key insert, so a collision is found
+without listing or even stat-ing a folder of half a million files, and two
+processes can't both take the same name.
+
+The highest number per category is an indexed lookup, so the counters
+are brought up to date from the index (next_numbers) instead of walking
+the destination. A destination the index has never seen is walked once,
+on first use; `reindex` walks it again after files were added, renamed or
+deleted by hand.
+
+Sharding keeps folders small: with 'month' a file goes to
+<category>/YYYY/MM/ by its modification time (when the screenshot was
+taken), with 'year' to <category>/YYYY/, and with 'hash' to
+<category>/<first hex digits of a hash of its name>/, which spreads any
+number of files evenly.
+"""
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from metrics import metrics
+
+SHARD_MODES = ('none', 'year', 'month', 'hash')
+
+# Rows written per transaction while walking a destination
+BATCH_SIZE = 5000
+NUMBER = re.compile(r'_(\d+)$')
+
+
+def shard_folder(mode, stem, mtime=None, hash_chars=2):
+    """Subfolder (with os.sep) a file named stem goes to, '' without sharding"""
+    if mode in ('year', 'month'):
+        taken = datetime.fromtimestamp(mtime if mtime is not None else time.time())
+        return taken.strftime('%Y' if mode == 'year' else os.path.join('%Y', '%m'))
+    if mode == 'hash':
+        return hashlib.sha1(stem.encode('utf-8')).hexdigest()[:max(1, hash_chars)]
+    return ''
+
+
+def name_number(name):
+    """Number at the end of a sorted file's name (tickets_007.png -> 7), or None"""
+    match = NUMBER.search(os.path.splitext(os.path.basename(name))[0])
+    return int(match.group(1)) if match else None
+
+
+class DestinationIndex:
+    """SQLite table of placed files, one row per (destination, relative path)"""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS roots (
+                               id INTEGER PRIMARY KEY,
+                               path TEXT NOT NULL UNIQUE,
+                               indexed REAL)''')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS files (
+                               root INTEGER NOT NULL,
+                               name TEXT NOT NULL,
+                               category TEXT NOT NULL,
+                               number INTEGER,
+                               PRIMARY KEY (root, name)) WITHOUT ROWID''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS files_number ON files (root, category, number)')
+        self.db.commit()
+        self.lock = threading.Lock()
+        self.root_ids = {}
+
+    def root_id(self, root):
+        """Integer id for a destination folder, created on first use"""
+        root = os.path.abspath(root)
+        if root not in self.root_ids:
+            with self.lock:
+                self.db.execute('INSERT OR IGNORE INTO roots (path) VALUES (?)', (root,))
+                self.db.commit()
+                self.root_ids[root] = self.db.execute('SELECT id FROM roots WHERE path = ?', (root,)).fetchone()[0]
+        return self.root_ids[root]
+
+    def indexed(self, root):
+        """True once root has been walked (or rebuilt) into the index"""
+        root_id = self.root_id(root)
+        with self.lock:
+            return self.db.execute('SELECT indexed FROM roots WHERE id = ?', (root_id,)).fetchone()[0] is not None
+
+    def claim(self, root, name, category):
+        """Take name (relative to root) for a new file; False if it is already taken"""
+        root_id = self.root_id(root)
+        try:
+            with self.lock:
+                self.db.execute('INSERT INTO files (root, name, category, number) VALUES (?, ?, ?, ?)',
+                                (root_id, name, category, name_number(name)))
+                self.db.commit()
+        except sqlite3.IntegrityError:
+            metrics.count('index.collisions')
+            return False
+        return True
+
+    def release(self, root, name):
+        """Forget a name again, e.g. its file failed to arrive or was undone"""
+        root_id = self.root_id(root)
+        with self.lock:
+            self.db.execute('DELETE FROM files WHERE root = ? AND name = ?', (root_id, name))
+            self.db.commit()
+
+    def taken(self, root, name):
+        root_id = self.root_id(root)
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM files WHERE root = ? AND name = ?',
+                                   (root_id, name)).fetchone() is not None
+
+    def locate(self, path):
+        """(destination, relative name) of a file under a known destination, or None"""
+        path = os.path.abspath(path)
+        with self.lock:
+            roots = [row[0] for row in self.db.execute('SELECT path FROM roots')]
+        for root in sorted(roots, key=len, reverse=True):
+            if path.startswith(root + os.sep):
+                return root, os.path.relpath(path, root)
+        return None
+
+    def next_numbers(self, root):
+        """{category: highest number in use + 1} for a destination"""
+        root_id = self.root_id(root)
+        with self.lock:
+            rows = self.db.execute('''SELECT category, MAX(number) FROM files
+                                      WHERE root = ? AND number IS NOT NULL GROUP BY category''',
+                                   (root_id,)).fetchall()
+        return {category: number + 1 for category, number in rows}
+
+    def count(self, root):
+        root_id = self.root_id(root)
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM files WHERE root = ?', (root_id,)).fetchone()[0]
+
+    def rebuild(self, root, folders):
+        """Walk root again and record every file under the given folders.
+
+        folders maps a top-level folder name to the category its files
+        belong to (ai_renamed -> ai_smart). Returns the number of files.
+        """
+        root = os.path.abspath(root)
+        root_id = self.root_id(root)
+        with metrics.timer('index.rebuild') as timer:
+            with self.lock:
+                self.db.execute('DELETE FROM files WHERE root = ?', (root_id,))
+            batch = []
+            total = 0
+            for folder, category in folders.items():
+                top = os.path.join(root, folder)
+                for dirpath, dirnames, filenames in os.walk(top):
+                    dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+                    for filename in filenames:
+                        if filename.startswith('.'):
+                            continue  # e.g. encoder temp files
+                        name = os.path.relpath(os.path.join(dirpath, filename), root)
+                        batch.append((root_id, name, category, name_number(name)))
+                    if len(batch) >= BATCH_SIZE:
+                        total += self._insert(batch)
+                        batch = []
+            total += self._insert(batch)
+            with self.lock:
+                self.db.execute('UPDATE roots SET indexed = ? WHERE id = ?', (time.time(), root_id))
+                self.db.commit()
+            timer.annotate(files=total)
+        return total
+
+    def _insert(self, rows):
+        with self.lock:
+            self.db.executemany('INSERT OR IGNORE INTO files (root, name, category, number) VALUES (?, ?, ?, ?)',
+                                rows)
+            self.db.commit()
+        return len(rows)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,134 @@
+"""The window's one way in from other threads, and pause/cancel for background work.
+
+Tk may only be used from the thread running mainloop. Scans, jobs, the
+thumbnail pool, Gemini's connect and the duplicate finder all post()
+callbacks here instead, from whatever thread they are on; the Tk thread
+runs them in order once per frame (60 per second). A frame stops running
+callbacks after BUDGET seconds and leaves the rest for the next one, so a
+burst of ten thousand results can't keep clicks and redraws waiting.
+
+Progress is different: only the newest matters. progress(key, ...) keeps
+the latest arguments per key and runs the callback once per frame at
+most, at the place of the first update still waiting, so it never
+overtakes an event posted after it (a job's 'finished' sees its last
+count). A sort of 10k files draws its progress bar 60 times a second, not
+10k times.
+
+Per-frame hooks (every_frame) are for pollers that already keep their
+own thread-safe queue, like the thumbnail loader.
+
+A TaskControl is handed to background work where it expects a cancel
+event: set() cancels, pause() holds it at its next check.
+"""
+import queue
+import threading
+import time
+
+FPS = 60
+# Seconds of callbacks per frame, about half a frame
+BUDGET = 0.008
+# Poll this often (ms) when nothing is happening
+IDLE_MS = 100
+
+
+class UIDispatcher:
+    def __init__(self, root, fps=FPS, budget=BUDGET):
+        self.root = root
+        self.frame_ms = max(1, round(1000 / fps))
+        self.budget = budget
+        self.events = queue.Queue()
+        self.latest = {}            # progress key -> (callback, args)
+        self.latest_lock = threading.Lock()
+        self.hooks = []             # (callback, busy) run every frame
+        self.after_id = None
+
+    def post(self, callback, *args):
+        """Run callback(*args) on the Tk thread; safe from any thread"""
+        self.events.put((callback, args))
+
+    def progress(self, key, callback, *args):
+        """Like post(), but only the newest update per key is run"""
+        with self.latest_lock:
+            waiting = key in self.latest
+            self.latest[key] = (callback, args)
+        if not waiting:
+            self.events.put((None, key))
+
+    def every_frame(self, callback, busy=None):
+        """Call callback() on each frame; busy() tells if it wants the full frame rate"""
+        self.hooks.append((callback, busy))
+
+    def start(self):
+        if self.after_id is None:
+            self.after_id = self.root.after(0, self._frame)
+
+    def stop(self):
+        if self.after_id is not None:
+            self.root.after_cancel(self.after_id)
+            self.after_id = None
+
+    def _frame(self):
+        deadline = time.perf_counter() + self.budget
+        ran = 0
+        while time.perf_counter() < deadline:
+            try:
+                callback, args = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if callback is None:
+                with self.latest_lock:
+                    callback, args = self.latest.pop(args)
+            ran += 1
+            try:
+                callback(*args)
+            except Exception as e:
+                # One broken handler must not stop the window's updates
+                print(f"⚠️ UI update failed: {e}")
+        busy = ran or not self.events.empty()
+        for hook, wants_frames in self.hooks:
+            hook()
+            busy = busy or (wants_frames is not None and wants_frames())
+        self.after_id = self.root.after(self.frame_ms if busy else IDLE_MS, self._frame)
+
+
+class TaskControl:
+    """Cancel and pause for one background operation.
+
+    Stands in for the threading.Event the engine takes as cancel_event:
+    set() cancels. While paused, is_set() blocks until resumed (or
+    cancelled), so work stops at exactly the places that already check
+    for cancelling and no new request or copy is started. Only call
+    is_set() from the worker; the UI uses cancelled and paused.
+    """
+
+    def __init__(self):
+        self.cancel_event = threading.Event()
+        self.running = threading.Event()
+        self.running.set()
+
+    def set(self):
+        self.cancel_event.set()
+        self.running.set()
+
+    def is_set(self):
+        self.running.wait()
+        return self.cancel_event.is_set()
+
+    def wait(self, timeout=None):
+        """Sleep up to timeout; True if cancelled meanwhile (like Event.wait)"""
+        return self.cancel_event.wait(timeout)
+
+    def pause(self):
+        if not self.cancel_event.is_set():
+            self.running.clear()
+
+    def resume(self):
+        self.running.set()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    @property
+    def paused(self):
+        return not self.running.is_set()
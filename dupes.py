@@ -0,0 +1,276 @@
+"""Near-duplicate detection with perceptual hashes.
+
+Every image gets a 64-bit pHash (DCT of a 32x32 grayscale copy) and a
+64-bit dHash (horizontal gradients of a 9x8 copy). Decoding is spread over
+a process pool and the hashes are cached by path, size and mtime, so a
+folder is only ever hashed once. Hashing itself is done for all images at
+once with NumPy.
+
+Pairs within a Hamming radius are found with multi-index hashing: the
+pHash is split into four 16-bit chunks, and two hashes within distance r
+must agree on at least one chunk to within r // 4 bits. Those candidate
+pairs come out of sorted-array lookups and are checked on both hashes, so
+clustering 100k already hashed images takes a second or two.
+"""
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import combinations
+
+from PIL import Image
+
+from metrics import metrics
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+    print("⚠️ numpy not installed: near-duplicate detection is disabled. Run: pip install numpy")
+
+DEFAULT_THRESHOLD = 6
+CHUNKS = 4
+CHUNK_BITS = 64 // CHUNKS
+
+
+def load_gray(path):
+    """Worker side: (32x32, 9x8) grayscale bytes for hashing, or None"""
+    try:
+        with Image.open(path) as img:
+            if img.format == 'JPEG':
+                img.draft('L', (64, 64))
+            img.load()
+            # Gray first: reduce() can't take palette, 1-bit or 16-bit images
+            gray = img.convert('L')
+            factor = max(gray.size) // 128
+            if factor >= 2:
+                gray = gray.reduce(factor)
+            return (gray.resize((32, 32), Image.BILINEAR).tobytes(),
+                    gray.resize((9, 8), Image.BILINEAR).tobytes())
+    except Exception as e:
+        print(f"Error hashing {os.path.basename(path)}: {e}")
+        return None
+
+
+def _dct_matrix(n):
+    k = np.arange(n)
+    matrix = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n))
+    matrix[0] /= np.sqrt(2)
+    return matrix * np.sqrt(2 / n)
+
+
+def _pack_bits(bits):
+    """(N, 64) bool -> (N,) uint64, most significant bit first"""
+    return np.packbits(bits, axis=1).view('>u8').ravel().astype(np.uint64)
+
+
+def compute_hashes(grays):
+    """Vectorized (dhash, phash) uint64 arrays for [(gray32, gray9x8), ...]"""
+    if not grays:
+        empty = np.zeros(0, dtype=np.uint64)
+        return empty, empty
+    big = np.frombuffer(b''.join(g[0] for g in grays), dtype=np.uint8).reshape(-1, 32, 32)
+    small = np.frombuffer(b''.join(g[1] for g in grays), dtype=np.uint8).reshape(-1, 8, 9)
+
+    dhash = _pack_bits((small[:, :, 1:] > small[:, :, :-1]).reshape(-1, 64))
+
+    dct = _dct_matrix(32)
+    coefficients = dct @ big.astype(np.float32) @ dct.T
+    low = coefficients[:, :8, :8].reshape(-1, 64)
+    # Median of the low frequencies without the DC term
+    median = np.median(low[:, 1:], axis=1, keepdims=True)
+    phash = _pack_bits(low > median)
+    return dhash, phash
+
+
+def popcount(values):
+    """Bits set in each element of a uint64 array"""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values).astype(np.int64)
+    table = np.array([bin(i).count('1') for i in range(256)], dtype=np.int64)
+    return table[values.view(np.uint8).reshape(-1, 8)].sum(axis=1)
+
+
+class HashCache:
+    """SQLite store of image hashes keyed by path, validated on size and mtime"""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS hashes (
+                               path TEXT PRIMARY KEY,
+                               file_size INTEGER NOT NULL,
+                               mtime_ns INTEGER NOT NULL,
+                               dhash INTEGER NOT NULL,
+                               phash INTEGER NOT NULL)''')
+        self.db.commit()
+
+    def get_many(self, stats):
+        """{path: (dhash, phash)} for entries of {path: (size, mtime_ns)} still valid"""
+        found = {}
+        paths = list(stats)
+        for start in range(0, len(paths), 500):
+            chunk = paths[start:start + 500]
+            rows = self.db.execute(f'''SELECT path, file_size, mtime_ns, dhash, phash FROM hashes
+                                       WHERE path IN ({','.join('?' * len(chunk))})''', chunk)
+            for path, size, mtime_ns, dhash, phash in rows:
+                if stats[path] == (size, mtime_ns):
+                    found[path] = (dhash, phash)
+        return found
+
+    def put_many(self, rows):
+        """rows: [(path, size, mtime_ns, dhash, phash), ...] with signed 64-bit hashes"""
+        self.db.executemany('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)', rows)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+def _signed(values):
+    return values.astype(np.uint64).view(np.int64)
+
+
+def hash_files(paths, cache=None, workers=None):
+    """(dhash, phash, valid) arrays for paths; unreadable images are not valid"""
+    n = len(paths)
+    dhash = np.zeros(n, dtype=np.uint64)
+    phash = np.zeros(n, dtype=np.uint64)
+    valid = np.zeros(n, dtype=bool)
+
+    stats = {}
+    for path in paths:
+        try:
+            st = os.stat(path)
+            stats[path] = (st.st_size, st.st_mtime_ns)
+        except OSError:
+            pass
+    cached = cache.get_many(stats) if cache else {}
+    metrics.count('duplicates.cache_hits', len(cached))
+
+    todo = []
+    for i, path in enumerate(paths):
+        if path in cached:
+            d, p = cached[path]
+            dhash[i], phash[i] = np.int64(d).view(np.uint64), np.int64(p).view(np.uint64)
+            valid[i] = True
+        elif path in stats:
+            todo.append(i)
+
+    if todo:
+        workers = workers or max(1, (os.cpu_count() or 2) - 1)
+        try:
+            pool = ProcessPoolExecutor(max_workers=workers)
+        except (OSError, NotImplementedError):
+            pool = ThreadPoolExecutor(max_workers=workers)
+        with pool:
+            grays = [metrics.unwrap('decode.hash', gray) for gray in
+                     pool.map(metrics.wrap(load_gray), [paths[i] for i in todo], chunksize=32)]
+        decoded = [i for i, gray in zip(todo, grays) if gray is not None]
+        with metrics.timer('duplicates.hash', images=len(decoded)):
+            new_d, new_p = compute_hashes([gray for gray in grays if gray is not None])
+        dhash[decoded], phash[decoded] = new_d, new_p
+        valid[decoded] = True
+        if cache and decoded:
+            cache.put_many([(paths[i], *stats[paths[i]], int(d), int(p))
+                            for i, d, p in zip(decoded, _signed(new_d), _signed(new_p))])
+    return dhash, phash, valid
+
+
+def _flip_masks(bits, radius):
+    """Every chunk XOR mask with at most radius bits set"""
+    masks = [0]
+    for r in range(1, radius + 1):
+        for positions in combinations(range(bits), r):
+            masks.append(sum(1 << p for p in positions))
+    return masks
+
+
+class DuplicateIndex:
+    """Multi-index hash over pHashes, verified on pHash and dHash.
+
+    Images with identical hashes are collapsed first, so a thousand copies
+    of the same blank screen cost one entry, not a million candidate pairs.
+    """
+
+    def __init__(self, dhash, phash, valid=None, threshold=DEFAULT_THRESHOLD):
+        dhash = np.asarray(dhash, dtype=np.uint64)
+        phash = np.asarray(phash, dtype=np.uint64)
+        self.ids = np.flatnonzero(valid) if valid is not None else np.arange(len(phash))
+        self.threshold = threshold
+        keys, inverse = np.unique(np.stack([phash[self.ids], dhash[self.ids]], axis=1),
+                                  axis=0, return_inverse=True)
+        self.inverse = inverse.ravel()
+        self.phash, self.dhash = keys[:, 0], keys[:, 1]
+        mask = np.uint64((1 << CHUNK_BITS) - 1)
+        self.chunks = [((self.phash >> np.uint64(j * CHUNK_BITS)) & mask).astype(np.int64)
+                       for j in range(CHUNKS)]
+
+    def pairs(self):
+        """(a, b) arrays with a < b of near-duplicate pairs of distinct hashes"""
+        sub_radius = self.threshold // CHUNKS
+        masks = _flip_masks(CHUNK_BITS, sub_radius)
+        found_a, found_b = [], []
+        for chunk in self.chunks:
+            order = np.argsort(chunk, kind='stable')
+            ordered = chunk[order]
+            for mask in masks:
+                wanted = chunk ^ mask
+                lo = np.searchsorted(ordered, wanted, 'left')
+                hi = np.searchsorted(ordered, wanted, 'right')
+                counts = hi - lo
+                if not counts.any():
+                    continue
+                a = np.repeat(np.arange(len(chunk)), counts)
+                offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+                b = order[np.repeat(lo, counts) + offsets]
+                keep = a < b
+                a, b = a[keep], b[keep]
+                # Verify right away; most candidates only share a chunk by chance
+                close = ((popcount(self.phash[a] ^ self.phash[b]) <= self.threshold) &
+                         (popcount(self.dhash[a] ^ self.dhash[b]) <= self.threshold))
+                found_a.append(a[close])
+                found_b.append(b[close])
+        if not found_a:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty
+
+        # The same pair can turn up through several chunks
+        n = len(self.phash)
+        unique = np.unique(np.concatenate(found_a) * n + np.concatenate(found_b))
+        return unique // n, unique % n
+
+    def clusters(self):
+        """Lists of indices (ascending) for every group of two or more near-duplicates"""
+        parent = list(range(len(self.phash)))
+
+        def find(x):
+            root = x
+            while parent[root] != root:
+                root = parent[root]
+            while parent[x] != root:
+                parent[x], x = root, parent[x]
+            return root
+
+        a, b = self.pairs()
+        for x, y in zip(a.tolist(), b.tolist()):
+            rx, ry = find(x), find(y)
+            if rx != ry:
+                parent[max(rx, ry)] = min(rx, ry)
+
+        groups = {}
+        for index, key in zip(self.ids.tolist(), self.inverse.tolist()):
+            groups.setdefault(find(key), []).append(index)
+        return sorted(members for members in groups.values() if len(members) > 1)
+
+
+def find_duplicates(paths, threshold=DEFAULT_THRESHOLD, cache=None, workers=None):
+    """Clusters of near-duplicate images, as lists of indices into paths"""
+    if not NUMPY_AVAILABLE or len(paths) < 2:
+        return []
+    dhash, phash, valid = hash_files(paths, cache, workers)
+    metrics.count('duplicates.hashed', int(valid.sum()))
+    with metrics.timer('duplicates.cluster'):
+        return DuplicateIndex(dhash, phash, valid, threshold).clusters()
@@ -0,0 +1,1528 @@
+"""Headless sorting engine shared by the Tk app and the command line.
+
+The pipeline is a chain of generators: scan -> name -> transfer -> record.
+Nothing in here touches Tk, so it can run on a server or from cron.
+
+Heavy optional packages (google.generativeai, and NumPy behind the
+duplicate finder and classifier) are only imported when first used, so
+starting the app or a plain category sort doesn't pay for them.
+"""
+import os
+import json
+import copy
+import importlib.util
+import itertools
+import contextlib
+import re
+import threading
+import time
+from datetime import datetime
+
+from ai_pool import TokenBucket, CancelledError, call_with_retry, chunked, ordered_map
+from backends import BACKENDS, BackendError, GeminiBackend, LocalBackend, RecordingBackend, ReplayBackend
+from name_cache import NameCache, hash_file, hash_prompt
+from preprocess import StageStats, prepare_image
+from transfer import MODES as TRANSFER_MODES, transfer_file
+from transcode import FORMAT_EXTENSIONS, METADATA_MODES, OUTPUT_FORMATS, Transcoder, format_for
+from journal import Journal
+from jobs import JobQueue, JobTracker
+from catalog import Catalog
+from destindex import SHARD_MODES, DestinationIndex, shard_folder
+from counters import CounterStore, write_json_atomic
+from metrics import metrics
+from scanner import ScanFilter, scan_tree
+from rules import Router
+
+
+def module_available(name):
+    """True if name can be imported, without importing it"""
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
+
+
+# Google's genai package takes a second or more to import; see load_genai()
+GENAI_AVAILABLE = module_available('google.generativeai')
+genai = None
+NUMPY_AVAILABLE = module_available('numpy')
+
+
+def load_genai():
+    """Import google.generativeai on first use (None if it fails)"""
+    global genai, GENAI_AVAILABLE
+    if genai is None and GENAI_AVAILABLE:
+        try:
+            with metrics.timer('import.genai'):
+                import google.generativeai as module
+            genai = module
+        except ImportError:
+            GENAI_AVAILABLE = False
+    return genai
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.path.join(APP_DIR, 'cache')
+# Persistent state that must not be thrown away like a cache
+DATA_DIR = os.path.join(APP_DIR, 'data')
+
+# Catalog rows written per transaction while scanning
+CATALOG_BATCH = 5000
+
+GEMINI_MODEL_NAME = 'gemini-3-flash-preview'
+
+AI_FOLDER = 'ai_renamed'
+
+DEFAULT_CATEGORIES = {
+    'tickets': {'emoji': '🎫', 'color': '#FF6B6B', 'count': 1},
+    'chats': {'emoji': '💬', 'color': '#4ECDC4', 'count': 1},
+    'funny': {'emoji': '😂', 'color': '#FFE66D', 'count': 1},
+    'movie': {'emoji': '🎬', 'color': '#95E1D3', 'count': 1},
+    'others': {'emoji': '📁', 'color': '#A8E6CF', 'count': 1},
+    'ai_smart': {'emoji': '🤖', 'color': '#9B59B6', 'count': 1}
+}
+
+DEFAULT_PROMPT = """You are a filename generator. Look at this image and create a short, descriptive filename (3-5 words).
+
+Rules:
+- Use ONLY lowercase letters, numbers, and hyphens
+- NO spaces, NO special characters
+- Describe the MAIN subject of the image
+- Be specific but concise
+- DO NOT use words like "image", "photo", "picture", "screenshot"
+- DO NOT add any explanations, just return the filename
+
+Examples:
+- For a cat photo: "sleeping-orange-cat"
+- For a food photo: "homemade-pizza-slice"
+- For a landscape: "sunset-mountain-lake"
+- For a document: "quarterly-report-2024"
+- For a meme: "distracted-boyfriend-meme"
+
+Generate only the filename, nothing else:"""
+
+# Used when the prompt box in the AI tab is left empty
+SHORT_PROMPT = "Generate a descriptive filename (3-5 words, use hyphens) for this image."
+
+# Used by generate_ai_filename when called without any prompt at all
+FALLBACK_PROMPT = """You are a filename generator. Look at this image and create a short, descriptive filename (3-5 words).
+
+Rules:
+- Use ONLY lowercase letters, numbers, and hyphens
+- NO spaces, NO special characters
+- Describe the MAIN subject of the image
+- Be specific but concise
+- DO NOT use words like "image", "photo", "picture"
+- DO NOT add any explanations, just return the filename
+
+Generate only the filename:"""
+
+# Tunables for the concurrent AI pipeline, saved under "ai" in config.json
+DEFAULT_AI_SETTINGS = {
+    'workers': 4,
+    'requests_per_minute': 60,
+    'max_retries': 4,
+    'cache': True,
+    'cache_max_entries': 50000,
+    'cache_max_age_days': 90,
+    # Shrink/re-encode images before upload
+    'preprocess': True,
+    'max_edge': 1280,
+    'upload_format': 'webp',
+    'upload_quality': 80,
+    'grayscale_text': True,
+    # Images per generate_content call (1 = one request per image)
+    'batch_size': 8,
+    # Vision backend: gemini, local or replay (see backends.py)
+    'backend': 'gemini',
+    'model': GEMINI_MODEL_NAME,
+    # The local backend's function, as 'module:function'
+    'local_model': '',
+    # Longest image edge the local function takes, 0 = any
+    'local_max_edge': 0,
+    # JSONL file of recorded replies: written with record, read by replay
+    'recording': '',
+    'record': False,
+    # Replay waits the recorded latency times this (0 = answer at once)
+    'replay_speed': 1.0
+}
+
+# How files get into the destination, saved under "transfer" in config.json
+DEFAULT_TRANSFER_SETTINGS = {
+    # copy, move, hardlink or reflink; falls back to copy across devices
+    'mode': 'copy',
+    # Hash both sides of every byte-for-byte copy
+    'verify': False,
+    # Parallel copies for manual category sorts
+    'copy_workers': 4
+}
+
+# What sorted files are written as, saved under "output" in config.json
+DEFAULT_OUTPUT_SETTINGS = {
+    # keep (the original bytes, named with their real extension), png, webp or jpeg
+    'format': 'keep',
+    # Lossy WebP quality, and the JPEG quality cap
+    'quality': 85,
+    # WebP: pixel-exact, or lossy at quality
+    'lossless': True,
+    # WebP compression effort, 0 (fast) to 6 (smallest)
+    'effort': 4,
+    # keep (EXIF, ICC profile, text), color (ICC profile only) or strip
+    'metadata': 'keep',
+    # Keep the original when re-encoding doesn't make it smaller
+    'only_if_smaller': True,
+    # Encoder processes, 0 = one per CPU
+    'workers': 0
+}
+
+# Where files go inside a category folder, saved under "layout" in config.json
+DEFAULT_LAYOUT_SETTINGS = {
+    # none (flat), year (YYYY/), month (YYYY/MM/) by file date, or hash (ab/)
+    'shard': 'none',
+    # Hex digits of the name hash per shard folder: 2 = 256 folders
+    'hash_chars': 2
+}
+
+# Near-duplicate handling, saved under "duplicates" in config.json
+DEFAULT_DUPLICATE_SETTINGS = {
+    # off, share (one AI call names the whole cluster) or skip (sort only the first)
+    'mode': 'off',
+    # Max differing bits (of 64) in both pHash and dHash
+    'threshold': 6
+}
+DUPLICATE_MODES = ('off', 'share', 'skip')
+
+# Which files a scan picks up, saved under "scan" in config.json
+DEFAULT_SCAN_SETTINGS = {
+    # Descend into subfolders
+    'recursive': False,
+    # Glob patterns on the relative path or the file name (empty include = all)
+    'include': [],
+    'exclude': [],
+    # File size limits in bytes, 0 = no limit
+    'min_size': 0,
+    'max_size': 0,
+    # Modification date limits as YYYY-MM-DD (until is inclusive), null = none
+    'since': None,
+    'until': None,
+    # Pixel limits, 0 = no limit
+    'min_width': 0,
+    'min_height': 0,
+    'max_width': 0,
+    'max_height': 0,
+    # Recognize images by their first bytes instead of their extension
+    'sniff': True,
+    # Threads listing folders and sniffing files
+    'workers': 8
+}
+
+# Offline pre-classifier, saved under "classifier" in config.json
+DEFAULT_CLASSIFIER_SETTINGS = {
+    # Sort confidently recognized screenshots into a category without Gemini
+    'enabled': False,
+    # Minimum predicted probability to trust the local guess
+    'threshold': 0.85
+}
+
+# Appended to the user's prompt when several images share one request
+BATCH_INSTRUCTIONS = """
+
+You will receive {count} images, each preceded by a label like "Image 1:".
+Apply the rules above to every image separately.
+Respond with ONLY a JSON array of exactly {count} objects in the same order,
+for example: [{{"image": 1, "filename": "sunset-mountain-lake"}}]"""
+
+UNWANTED_WORDS = ['image', 'photo', 'picture', 'png', 'jpg', 'jpeg', 'screenshot', 'img']
+
+
+def default_categories():
+    """Return a fresh copy of the built-in categories"""
+    return copy.deepcopy(DEFAULT_CATEGORIES)
+
+
+def fallback_filename():
+    """Timestamp name used when the AI gives us nothing usable"""
+    return f"image-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+
+
+def sanitize_filename(text):
+    """Turn a raw model response into a safe hyphenated filename stem.
+
+    Returns an empty string when nothing usable is left.
+    """
+    ai_text = text.strip().lower()
+
+    # Remove any markdown, quotes, or extra text
+    ai_text = re.sub(r'[`*_#]', '', ai_text)  # Remove markdown
+    ai_text = re.sub(r'["\'()]', '', ai_text)  # Remove quotes and parentheses
+
+    # Take only the first line
+    ai_text = ai_text.split('\n')[0]
+
+    # Replace spaces and invalid characters with hyphens
+    ai_text = re.sub(r'[^\w\s-]', '', ai_text)  # Remove special chars
+    ai_text = re.sub(r'[-\s]+', '-', ai_text)   # Replace spaces/hyphens with single hyphen
+    ai_text = ai_text.strip('-')                 # Remove leading/trailing hyphens
+
+    # Remove common unwanted words
+    for word in UNWANTED_WORDS:
+        ai_text = ai_text.replace(f'{word}-', '').replace(f'-{word}', '')
+        if ai_text == word:
+            ai_text = ''
+
+    # Limit length
+    if len(ai_text) > 45:
+        parts = ai_text.split('-')
+        result = []
+        current_len = 0
+        for part in parts:
+            if current_len + len(part) + 1 <= 45:
+                result.append(part)
+                current_len += len(part) + 1
+            else:
+                break
+        ai_text = '-'.join(result)
+
+    if ai_text and len(ai_text) >= 3:
+        return ai_text
+    return ''
+
+
+def parse_batch_response(text, count):
+    """Pull one sanitized filename per image out of a batched JSON reply.
+
+    Raises ValueError unless the reply is a JSON array that lines up with
+    the images that were sent. Unusable individual names come back as ''.
+    """
+    text = text.strip()
+    # Models like to wrap JSON in a markdown code fence anyway
+    text = re.sub(r'^```(?:json)?\s*|\s*```$', '', text)
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"batch reply is not JSON: {e}")
+    if isinstance(data, dict):
+        data = data.get('filenames') or data.get('images') or data.get('results')
+    if not isinstance(data, list) or len(data) != count:
+        raise ValueError(f"expected {count} filenames, got {len(data) if isinstance(data, list) else 0}")
+
+    names = [''] * count
+    seen = set()
+    for position, entry in enumerate(data):
+        if isinstance(entry, str):
+            index, name = position, entry
+        elif isinstance(entry, dict):
+            index = entry.get('image', position + 1)
+            if not isinstance(index, int) or not 1 <= index <= count:
+                raise ValueError(f"bad image index {index!r}")
+            index -= 1
+            name = str(entry.get('filename', ''))
+        else:
+            raise ValueError(f"unexpected entry {entry!r}")
+        if index in seen:
+            raise ValueError(f"image {index + 1} named twice")
+        seen.add(index)
+        names[index] = sanitize_filename(name)
+    return names
+
+
+def day_timestamp(text, days=0):
+    """Epoch seconds of local midnight of a YYYY-MM-DD date, plus days"""
+    return datetime.strptime(text, '%Y-%m-%d').timestamp() + days * 86400
+
+
+class SortResult:
+    """Outcome of one file going through the pipeline"""
+    __slots__ = ('filename', 'new_filename', 'dest_path', 'error', 'line', 'cached', 'skipped',
+                 'classified', 'rule')
+
+    def __init__(self, filename, new_filename=None, dest_path=None, error=None, line='',
+                 cached=False, skipped=False, classified=False, rule=None):
+        self.filename = filename
+        self.new_filename = new_filename
+        self.dest_path = dest_path
+        self.error = error
+        self.line = line
+        self.cached = cached
+        self.skipped = skipped
+        # Sorted into a category by the local classifier instead of Gemini
+        self.classified = classified
+        # Name of the routing rule that picked the category, if one did
+        self.rule = rule
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class SortEngine:
+    def __init__(self, config_path=None, journal_path=None, on_record=None, counters_path=None):
+        # Next to main.py, not the working directory, unless given explicitly
+        self.config_path = config_path or os.path.join(APP_DIR, 'config.json')
+        self.journal_path = journal_path or os.path.join(DATA_DIR, 'journal.db')
+        # Called as on_record(category, block) after each batch is journaled
+        self.on_record = on_record
+        self.categories = default_categories()
+        # Routing rules as written in config.json; see rules.py
+        self.rules = []
+        self.last_source = ''
+        self.last_dest = ''
+        # ai_config is what config.json holds; ai_settings is the live copy
+        # that one-off overrides (e.g. CLI flags) may change without saving
+        self.ai_config = dict(DEFAULT_AI_SETTINGS)
+        self.ai_settings = dict(self.ai_config)
+        self.transfer_config = dict(DEFAULT_TRANSFER_SETTINGS)
+        self.transfer_settings = dict(self.transfer_config)
+        self.output_config = dict(DEFAULT_OUTPUT_SETTINGS)
+        self.output_settings = dict(self.output_config)
+        self.layout_config = dict(DEFAULT_LAYOUT_SETTINGS)
+        self.layout_settings = dict(self.layout_config)
+        self.duplicate_config = dict(DEFAULT_DUPLICATE_SETTINGS)
+        self.duplicate_settings = dict(self.duplicate_config)
+        self.classifier_config = dict(DEFAULT_CLASSIFIER_SETTINGS)
+        self.classifier_settings = dict(self.classifier_config)
+        self.scan_config = copy.deepcopy(DEFAULT_SCAN_SETTINGS)
+        self.scan_settings = copy.deepcopy(self.scan_config)
+        self.classifier_path = os.path.join(DATA_DIR, 'classifier.npz')
+        self._local_classifier = None
+        # Vision backend, set up by init_backend(); None while AI is unavailable
+        self.backend = None
+        self._name_cache = None
+        self._journal = None
+        self._catalog = None
+        self._transcoder = None
+        self._jobs = None
+        self._dest_index = None
+        # Jobs the latest run() submitted
+        self.run_job_ids = []
+        # Destinations whose counters were checked against the index this session
+        self.synced_dests = set()
+        self.upload_stats = StageStats()
+        # Source of truth for numbering; 'count' in categories only mirrors it
+        self.counters = CounterStore(counters_path or os.path.join(
+            os.path.dirname(os.path.abspath(self.config_path)), 'counters.json'))
+        self.load_config()
+        self.refresh_counts()
+
+    @property
+    def ai_available(self):
+        return self.backend is not None
+
+    # ---- config -------------------------------------------------------
+
+    def load_config(self):
+        """Read config.json once: settings plus last used folders"""
+        try:
+            with open(self.config_path, 'r') as f:
+                config = json.load(f)
+        except Exception:
+            return {}
+
+        # Counts saved by older versions (or edited by hand) only ever push
+        # the counter store forward
+        self.counters.raise_to({cat_name: cat_info.get('count', 1)
+                                for cat_name, cat_info in config.get('categories', {}).items()})
+        self.last_source = config.get('last_source', '')
+        self.last_dest = config.get('last_dest', '')
+        self.ai_config.update(config.get('ai', {}))
+        if self.ai_config['backend'] not in BACKENDS:
+            self.ai_config['backend'] = 'gemini'
+        self.ai_settings = dict(self.ai_config)
+        self.transfer_config.update(config.get('transfer', {}))
+        if self.transfer_config['mode'] not in TRANSFER_MODES:
+            self.transfer_config['mode'] = 'copy'
+        self.transfer_settings = dict(self.transfer_config)
+        self.output_config.update(config.get('output', {}))
+        if self.output_config['format'] not in OUTPUT_FORMATS:
+            self.output_config['format'] = 'keep'
+        if self.output_config['metadata'] not in METADATA_MODES:
+            self.output_config['metadata'] = 'keep'
+        self.output_settings = dict(self.output_config)
+        self.layout_config.update(config.get('layout', {}))
+        if self.layout_config['shard'] not in SHARD_MODES:
+            self.layout_config['shard'] = 'none'
+        self.layout_settings = dict(self.layout_config)
+        self.duplicate_config.update(config.get('duplicates', {}))
+        if self.duplicate_config['mode'] not in DUPLICATE_MODES:
+            self.duplicate_config['mode'] = 'off'
+        self.duplicate_settings = dict(self.duplicate_config)
+        self.classifier_config.update(config.get('classifier', {}))
+        self.classifier_settings = dict(self.classifier_config)
+        self.scan_config.update(config.get('scan', {}))
+        self.scan_settings = copy.deepcopy(self.scan_config)
+        self.rules = config.get('rules', [])
+        return config
+
+    def save_config(self):
+        self.refresh_counts()
+        config = {
+            'categories': self.categories,
+            'last_source': self.last_source,
+            'last_dest': self.last_dest,
+            'ai': self.ai_config,
+            'transfer': self.transfer_config,
+            'output': self.output_config,
+            'layout': self.layout_config,
+            'duplicates': self.duplicate_config,
+            'classifier': self.classifier_config,
+            'scan': self.scan_config,
+            'rules': self.rules
+        }
+        try:
+            write_json_atomic(self.config_path, config)
+        except Exception:
+            pass
+
+    def refresh_counts(self):
+        """Copy the next free numbers into categories for display"""
+        counts = self.counters.peek_all(self.categories)
+        for cat_name, cat_info in self.categories.items():
+            cat_info['count'] = counts[cat_name]
+
+    def next_filename(self, category):
+        """Name the next manual sort into this category would get.
+
+        Without re-encoding the extension is that of the file, so only the
+        stem is known up front.
+        """
+        stem = f"{category}_{self.counters.peek(category):03d}"
+        if self.output_settings['format'] == 'keep':
+            return stem
+        return stem + FORMAT_EXTENSIONS[self.output_settings['format']]
+
+    # ---- AI -----------------------------------------------------------
+
+    def init_backend(self, api_key=None):
+        """Set up the vision backend the "ai" settings name, returns a short status string.
+
+        For Gemini this imports the genai package on first call, which is
+        slow; the app calls this from a background thread.
+        """
+        settings = self.ai_settings
+        kind = settings['backend']
+        self.backend = None
+        try:
+            if kind == 'gemini':
+                if load_genai() is None:
+                    return "AI: ❌ Package not installed (pip install google-generativeai)"
+                # Get API key from environment variable
+                api_key = api_key or os.getenv('GEMINI_API_KEY')
+                if not api_key or api_key == "your_api_key_here":
+                    print("❌ No valid API key found in .env file")
+                    return "AI: ❌ No valid API Key (Add to .env file)"
+                backend = GeminiBackend(genai, settings['model'], api_key, default_model=GEMINI_MODEL_NAME)
+            elif kind == 'local':
+                backend = LocalBackend(settings['local_model'], max_edge=settings['local_max_edge'])
+            elif kind == 'replay':
+                backend = ReplayBackend(settings['recording'], speed=settings['replay_speed'])
+            else:
+                raise BackendError(f"unknown backend '{kind}'")
+            if settings['record'] and kind != 'replay':
+                if not settings['recording']:
+                    raise BackendError("record needs a recording file")
+                backend = RecordingBackend(backend, settings['recording'])
+        except Exception as e:
+            print(f"❌ {kind} initialization error: {e}")
+            return f"AI: ❌ Error - {str(e)[:30]}"
+        self.backend = backend
+        print(f"✅ {backend.description} initialized successfully")
+        return f"AI: ✅ Connected to {backend.description}"
+
+    def ai_limits(self):
+        """(images per request, parallel requests) the settings and the backend allow"""
+        batch_size = max(1, self.ai_settings['batch_size'])
+        workers = max(1, self.ai_settings['workers'])
+        if self.backend is not None:
+            if not self.backend.capabilities.batching:
+                batch_size = 1
+            if not self.backend.capabilities.concurrent:
+                workers = 1
+        return batch_size, workers
+
+    @property
+    def name_cache(self):
+        """Persistent AI name cache, opened on first use (None when disabled)"""
+        if self._name_cache is None and self.ai_settings['cache']:
+            self._name_cache = NameCache(os.path.join(CACHE_DIR, 'ai_names.db'),
+                                         max_entries=self.ai_settings['cache_max_entries'],
+                                         max_age_days=self.ai_settings['cache_max_age_days'])
+        return self._name_cache
+
+    @property
+    def local_classifier(self):
+        """Trained offline classifier, loaded on first use (None if untrained)"""
+        if self._local_classifier is None and NUMPY_AVAILABLE and os.path.exists(self.classifier_path):
+            try:
+                from classifier import LocalClassifier
+
+                self._local_classifier = LocalClassifier.load(self.classifier_path)
+            except Exception as e:
+                print(f"⚠️ Could not load local classifier: {e}")
+        return self._local_classifier
+
+    def train_classifier(self):
+        """Fit the local classifier on every manual sort that still stands.
+
+        Returns a report dict; raises ValueError if there is too little
+        history to learn from.
+        """
+        if not NUMPY_AVAILABLE:
+            raise ValueError("numpy is not installed")
+        from classifier import train_from_examples
+
+        examples = [(category, path) for category, path in self.journal.decisions(legacy_root=self.last_dest)
+                    if category in self.categories and os.path.exists(path)]
+        model, report = train_from_examples(examples)
+        model.save(self.classifier_path)
+        self._local_classifier = model
+        return report
+
+    def classify_locally(self, source, filenames):
+        """{filename: (category, confidence)} for the files the local model is sure about"""
+        model = self.local_classifier
+        if not self.classifier_settings['enabled'] or model is None:
+            return {}
+        from classifier import extract_many
+
+        features, valid = extract_many([os.path.join(source, filename) for filename in filenames])
+        if not valid.any():
+            return {}
+        with metrics.timer('classifier.predict', images=len(filenames)):
+            categories, confidences = model.predict(features)
+        threshold = self.classifier_settings['threshold']
+        return {filename: (category, float(confidence))
+                for filename, category, confidence, ok in zip(filenames, categories, confidences, valid)
+                if ok and confidence >= threshold and category in self.categories and category != 'ai_smart'}
+
+    @property
+    def transcoder(self):
+        """Output stage per the "output" settings; encoders start on first use"""
+        if self._transcoder is None:
+            self._transcoder = Transcoder(self.output_settings)
+        return self._transcoder
+
+    def shutdown(self):
+        """Stop the encoder processes, close the backend (e.g. its recording) and the destination index"""
+        if self._transcoder is not None:
+            self._transcoder.close()
+        if self.backend is not None:
+            self.backend.close()
+        if self._dest_index is not None:
+            self._dest_index.close()
+
+    @property
+    def catalog(self):
+        """Metadata catalog of scanned folders, opened on first use"""
+        if self._catalog is None:
+            self._catalog = Catalog(os.path.join(CACHE_DIR, 'catalog.db'))
+        return self._catalog
+
+    @property
+    def journal(self):
+        """Operation journal, opened on first use (imports history.txt once)"""
+        if self._journal is None:
+            self._journal = Journal(self.journal_path,
+                                    legacy_history=os.path.join(APP_DIR, 'history.txt'))
+        return self._journal
+
+    @property
+    def dest_index(self):
+        """Index of the files in each destination, next to the journal"""
+        if self._dest_index is None:
+            self._dest_index = DestinationIndex(os.path.join(os.path.dirname(os.path.abspath(self.journal_path)),
+                                                             'destinations.db'))
+        return self._dest_index
+
+    @property
+    def jobs(self):
+        """Durable job queue, kept in the journal's database"""
+        if self._jobs is None:
+            self._jobs = JobQueue(self.journal)
+        return self._jobs
+
+    def query_ai_filename(self, image_path, prompt):
+        """One model call; raises on network/API errors so callers can retry.
+
+        Returns the sanitized name, or '' if nothing usable came back.
+        """
+        text = self.send_to_model([prompt, self.prepare_upload(image_path)], 1)
+        with metrics.timer('sanitize', reply=text[:200]):
+            ai_text = sanitize_filename(text)
+        if not ai_text:
+            metrics.count('ai.unusable_replies')
+        return ai_text
+
+    def query_ai_batch(self, image_paths, prompt):
+        """One model call carrying several images; returns the raw reply text.
+
+        The prompt is sent once for the whole batch and the model is asked
+        for a JSON array, see parse_batch_response.
+        """
+        contents = [prompt + BATCH_INSTRUCTIONS.format(count=len(image_paths))]
+        for number, image_path in enumerate(image_paths, 1):
+            contents.append(f"Image {number}:")
+            contents.append(self.prepare_upload(image_path))
+        return self.send_to_model(contents, len(image_paths), json_reply=True)
+
+    def send_to_model(self, contents, image_count, json_reply=False):
+        """The backend's reply text; json_reply asks for a JSON answer"""
+        start = time.perf_counter()
+        with metrics.timer('model.call', images=image_count, backend=self.backend.name):
+            text = self.backend.generate(contents, image_count, json_reply=json_reply)
+        self.upload_stats.add_request(time.perf_counter() - start, image_count)
+        metrics.count('model.images', image_count)
+        return text
+
+    def prepare_upload(self, image_path):
+        """Image part for the backend, reduced per the "ai" settings and its max_edge"""
+        settings = self.ai_settings
+        max_edge = settings['max_edge'] if settings['preprocess'] else 0
+        limit = self.backend.capabilities.max_edge if self.backend is not None else 0
+        if limit and (not max_edge or max_edge > limit):
+            max_edge = limit
+        if not settings['preprocess'] and not limit:
+            from PIL import Image
+
+            with Image.open(image_path) as img:
+                img.load()
+            return img
+
+        with metrics.timer('preprocess'):
+            blob, original_bytes, sent_bytes, timings = prepare_image(
+                image_path, max_edge=max_edge, fmt=settings['upload_format'],
+                quality=settings['upload_quality'], grayscale_text=settings['grayscale_text'])
+        self.upload_stats.add(original_bytes, sent_bytes, timings)
+        for stage, seconds in timings.items():
+            metrics.observe(f"preprocess.{stage}", seconds)
+        metrics.count('upload.original_bytes', original_bytes)
+        metrics.count('upload.sent_bytes', sent_bytes)
+        return blob
+
+    def prompt_key(self, prompt):
+        """Name cache key of a prompt, told apart per backend/model"""
+        scope = self.backend.cache_scope if self.backend is not None else ''
+        return hash_prompt(f"{scope}\n{prompt}" if scope else prompt)
+
+    def request_ai_filename(self, image_path, prompt, call=None):
+        """Name an image, checking the content-addressed cache first.
+
+        Returns (name, cached). `call` wraps the network request, e.g. with
+        retries; cache hits never reach it. API errors propagate.
+        """
+        prompt = prompt or FALLBACK_PROMPT
+        cache = self.name_cache
+        key = None
+        if cache is not None:
+            key = (hash_file(image_path), self.prompt_key(prompt))
+            name = cache.get(*key)
+            if name:
+                metrics.count('ai.cache_hits')
+                return name, True
+
+        request = lambda: self.query_ai_filename(image_path, prompt)
+        name = call(request) if call else request()
+        if not name:
+            # Fallback if cleaning resulted in empty string
+            return fallback_filename(), False
+        if key is not None:
+            cache.put(*key, name)
+        return name, False
+
+    def request_ai_batch(self, image_paths, prompt, call=None):
+        """Name several images, sending all cache misses in one request.
+
+        Returns a list of (name, cached) in the same order as image_paths.
+        If the batched reply can't be matched up with the images, the
+        misses are retried one image per request.
+        """
+        prompt = prompt or FALLBACK_PROMPT
+        cache = self.name_cache
+        results = [None] * len(image_paths)
+        keys = [None] * len(image_paths)
+        misses = []
+        for i, image_path in enumerate(image_paths):
+            if cache is not None:
+                keys[i] = (hash_file(image_path), self.prompt_key(prompt))
+                name = cache.get(*keys[i])
+                if name:
+                    metrics.count('ai.cache_hits')
+                    results[i] = (name, True)
+                    continue
+            misses.append(i)
+
+        names = [''] * len(misses)
+        if len(misses) > 1:
+            request = lambda: self.query_ai_batch([image_paths[i] for i in misses], prompt)
+            text = call(request) if call else request()
+            try:
+                with metrics.timer('sanitize', images=len(misses), reply=text[:500]):
+                    names = parse_batch_response(text, len(misses))
+            except ValueError as e:
+                metrics.count('ai.batch_fallbacks')
+                print(f"⚠️ Batch reply unusable ({e}), falling back to one image per request")
+
+        for i, name in zip(misses, names):
+            if name:
+                if keys[i] is not None:
+                    cache.put(*keys[i], name)
+                results[i] = (name, False)
+                continue
+            try:
+                results[i] = self.request_ai_filename(image_paths[i], prompt, call)
+            except CancelledError:
+                raise
+            except Exception as e:
+                metrics.count('ai.errors')
+                print(f"❌ AI generation error: {e}")
+                results[i] = (fallback_filename(), False)
+        return results
+
+    def generate_ai_filename(self, image_path, prompt):
+        """Generate filename using Gemini AI"""
+        try:
+            return self.request_ai_filename(image_path, prompt)[0]
+        except Exception as e:
+            metrics.count('ai.errors')
+            print(f"❌ AI generation error: {e}")
+            return fallback_filename()
+
+    def make_rate_limiter(self):
+        rate = self.ai_settings['requests_per_minute'] / 60.0
+        return TokenBucket(rate, capacity=self.ai_limits()[1])
+
+    # ---- pipeline -----------------------------------------------------
+
+    def scan(self, source, dest=None):
+        """Relative paths of the images under source, yielded as they are found"""
+        return (entry.name for entry in self.scan_entries(source, dest))
+
+    def scan_entries(self, source, dest=None):
+        """ScanEntry objects for source, per the "scan" settings.
+
+        With dest, the folders sorting into it writes to are left out when
+        they are inside source, so a sort never picks up its own output.
+        """
+        settings = self.scan_settings
+        return scan_tree(source, recursive=settings['recursive'], scan_filter=self.scan_filter(),
+                         sniff=settings['sniff'], workers=settings['workers'],
+                         skip=self.output_folders(source, dest) if dest else ())
+
+    def output_folders(self, source, dest):
+        """Folders sorting into dest writes to that are inside source, relative to it with /"""
+        source = os.path.abspath(source)
+        inside = set()
+        for folder in self.destination_folders():
+            path = os.path.join(os.path.abspath(dest), folder)
+            try:
+                if os.path.commonpath([source, path]) != source:
+                    continue
+            except ValueError:
+                continue  # another drive
+            inside.add(os.path.relpath(path, source).replace(os.sep, '/'))
+        return frozenset(inside)
+
+    def scan_indexed(self, source, scan_id, dest=None):
+        """Like scan(), also recording every image in the catalog as scan scan_id.
+
+        Catalog positions are the order names are yielded in. Files the scan
+        no longer finds are dropped from the catalog once it completes.
+        """
+        batch = []
+        position = 0
+        for entry in self.scan_entries(source, dest):
+            batch.append(entry)
+            yield entry.name
+            if len(batch) >= CATALOG_BATCH:
+                self.catalog.update(source, batch, scan_id, position)
+                position += len(batch)
+                batch = []
+        self.catalog.update(source, batch, scan_id, position)
+        self.catalog.prune(source, scan_id)
+
+    def index_details(self, source, should_stop=None, progress=None):
+        """Fill in catalog dimensions, and hashes the duplicate finder already has"""
+        hashes_path = os.path.join(CACHE_DIR, 'hashes.db')
+        if NUMPY_AVAILABLE and os.path.exists(hashes_path):
+            from dupes import HashCache
+
+            cache = HashCache(hashes_path)
+            try:
+                self.catalog.fill_hashes(source, cache)
+            finally:
+                cache.close()
+        return self.catalog.fill_dimensions(source, should_stop=should_stop, progress=progress)
+
+    def scan_filter(self):
+        settings = self.scan_settings
+        return ScanFilter(
+            include=settings['include'], exclude=settings['exclude'],
+            min_size=settings['min_size'], max_size=settings['max_size'],
+            since=day_timestamp(settings['since']) if settings['since'] else None,
+            until=day_timestamp(settings['until'], days=1) if settings['until'] else None,
+            min_width=settings['min_width'], min_height=settings['min_height'],
+            max_width=settings['max_width'], max_height=settings['max_height'])
+
+    def find_duplicates(self, paths):
+        """Clusters of near-duplicates among paths (lists of indices)"""
+        from dupes import HashCache, find_duplicates
+
+        cache = HashCache(os.path.join(CACHE_DIR, 'hashes.db'))
+        try:
+            with metrics.timer('duplicates', images=len(paths)):
+                return find_duplicates(paths, self.duplicate_settings['threshold'], cache)
+        finally:
+            cache.close()
+
+    def group_duplicates(self, source, filenames):
+        """Split filenames into cluster leaders and {leader: [its duplicates]}.
+
+        Leaders keep their input order; with duplicate handling off (or no
+        NumPy) filenames come back untouched and nothing is grouped.
+        """
+        if self.duplicate_settings['mode'] == 'off' or not NUMPY_AVAILABLE:
+            return filenames, {}
+        filenames = list(filenames)
+        clusters = self.find_duplicates([os.path.join(source, filename) for filename in filenames])
+        followers = {}
+        for cluster in clusters:
+            followers[filenames[cluster[0]]] = [filenames[i] for i in cluster[1:]]
+        skipped = {filename for group in followers.values() for filename in group}
+        return [filename for filename in filenames if filename not in skipped], followers
+
+    def skip_duplicate(self, batch_id, filename, leader, job=None):
+        result = SortResult(filename, line=f"⏭ {filename}: near-duplicate of {leader}, skipped",
+                            skipped=True)
+        self.journal_result(batch_id, result, None, job=job)
+        return result
+
+    def transfer(self, src_path, new_path):
+        """Copy, move or link one file according to the transfer settings"""
+        with metrics.timer('transfer') as timer:
+            method, checksum = transfer_file(src_path, new_path, self.transfer_settings['mode'],
+                                             verify=self.transfer_settings['verify'])
+            timer.annotate(method=method)
+        metrics.count(f"transfer.{method}")
+        return method, checksum
+
+    def start_output(self, src_path, folder):
+        """Begin producing src_path's output file in folder; a Future for finish_output"""
+        return self.transcoder.start(src_path, folder)
+
+    def finish_output(self, pending, folder, stem):
+        """Put a started output in place as stem plus the extension of its format.
+
+        Returns (new filename, (method, sha256)) like transfer(); with
+        sharding the filename starts with its shard folder. The name is
+        claimed in the destination index first, so a taken one fails the
+        file instead of overwriting. Re-encoded files are renamed into
+        place; with the move mode the original goes.
+        """
+        encoded = pending.result()
+        root, top = os.path.split(folder)
+        new_filename = os.path.join(self.shard_for(encoded.src_path, stem), stem + encoded.extension)
+        if not self.dest_index.claim(root, os.path.join(top, new_filename), self.folder_category(top)):
+            encoded.discard()
+            # Something put files there behind our back: move the counters past them
+            self.counters.raise_to(self.dest_index.next_numbers(root))
+            raise FileExistsError(f"{top}/{new_filename} is already taken")
+        try:
+            return new_filename, self.place_output(encoded, os.path.join(folder, new_filename))
+        except BaseException:
+            self.dest_index.release(root, os.path.join(top, new_filename))
+            raise
+
+    def place_output(self, encoded, new_path):
+        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+        if encoded.temp_path is None:
+            return self.transfer(encoded.src_path, new_path)
+        with metrics.timer('transfer') as timer:
+            try:
+                os.replace(encoded.temp_path, new_path)
+            except OSError:
+                encoded.discard()
+                raise
+            encoded.temp_path = None
+            method = 'transcode'
+            if self.transfer_settings['mode'] == 'move':
+                os.unlink(encoded.src_path)
+                method = 'transcode_move'
+            timer.annotate(method=method)
+        metrics.count(f"transfer.{method}")
+        return method, None
+
+    def batch_output(self):
+        """Encoder options to journal with a batch, None when files are kept as they are"""
+        if self.output_settings['format'] == 'keep':
+            return None
+        return self.transcoder.options()
+
+    def shard_for(self, src_path, stem):
+        """Shard subfolder of a category folder for a file, '' when flat"""
+        mode = self.layout_settings['shard']
+        if mode == 'none':
+            return ''
+        mtime = None
+        if mode in ('year', 'month'):
+            try:
+                mtime = os.stat(src_path).st_mtime
+            except OSError:
+                pass
+        return shard_folder(mode, stem, mtime, self.layout_settings['hash_chars'])
+
+    @staticmethod
+    def folder_category(folder):
+        return 'ai_smart' if folder == AI_FOLDER else folder
+
+    def destination_folders(self):
+        """{top-level folder in a destination: the category it holds}"""
+        folders = {category: category for category in self.categories if category != 'ai_smart'}
+        folders[AI_FOLDER] = 'ai_smart'
+        return folders
+
+    def sync_destination(self, dest):
+        """Raise the counters past every number dest already holds, per the index.
+
+        A destination the index hasn't seen is walked once first; after
+        that this is one query per session.
+        """
+        dest = os.path.abspath(dest)
+        if dest in self.synced_dests:
+            return
+        index = self.dest_index
+        if not index.indexed(dest):
+            count = self.reindex(dest)
+            if count:
+                print(f"📇 Indexed {count} files already in {dest}")
+        else:
+            self.counters.raise_to(index.next_numbers(dest))
+        self.synced_dests.add(dest)
+
+    def reindex(self, dest):
+        """Walk dest into the index again and raise the counters from it; returns the file count"""
+        count = self.dest_index.rebuild(dest, self.destination_folders())
+        self.counters.raise_to(self.dest_index.next_numbers(dest))
+        self.synced_dests.add(os.path.abspath(dest))
+        return count
+
+    def release_path(self, path):
+        """Drop a sorted file from the destination index (it was undone or is gone)"""
+        found = self.dest_index.locate(path)
+        if found:
+            self.dest_index.release(*found)
+
+    def sort_files(self, source, dest, filenames, category, rules=None, job=None):
+        """Transfer files into dest/<category>/ as <category>_NNN plus the output extension.
+
+        Numbers are handed out in input order here; the transfers (and any
+        re-encoding, which runs on the encoder processes) use a small thread
+        pool so cross-device copies overlap. A file that
+        fails keeps its number, as it always has. Yields one SortResult per
+        file and journals each one as it goes. rules maps filenames to the
+        routing rule that sent them here. job is the JobTracker of a queued
+        job, which learns about every file placed.
+        """
+        rules = rules or {}
+        cat_folder = os.path.join(dest, category)
+        os.makedirs(cat_folder, exist_ok=True)
+        self.sync_destination(dest)
+        batch_id = self.journal.begin_batch(category, self.transfer_settings['mode'], self.batch_output())
+        followers = {}
+        if self.duplicate_settings['mode'] == 'skip':
+            filenames, followers = self.group_duplicates(source, filenames)
+
+        def numbered():
+            if isinstance(filenames, (list, tuple)):
+                # Known size: reserve the whole range in one go
+                first = self.counters.reserve(category, len(filenames)) if filenames else 0
+                for i, filename in enumerate(filenames):
+                    yield filename, f"{category}_{first + i:03d}"
+            else:
+                for filename in filenames:
+                    yield filename, f"{category}_{self.counters.reserve(category):03d}"
+
+        def transfer_one(item):
+            filename, stem = item
+            placed = self.finish_output(self.start_output(os.path.join(source, filename), cat_folder),
+                                        cat_folder, stem)
+            if job is not None:
+                job.copied(filename, os.path.join(category, placed[0]), self.journal_op(placed[1][0]))
+            return placed
+
+        workers = self.transfer_settings['copy_workers']
+        if self.transcoder.active:
+            # Enough threads waiting on encodes to keep every encoder busy
+            workers = max(workers, self.transcoder.workers)
+        lines = []
+        try:
+            for (filename, stem), placed, error in ordered_map(transfer_one, numbered(), workers=max(1, workers)):
+                if error is None:
+                    new_filename, transferred = placed
+                    rule = rules.get(filename)
+                    result = SortResult(filename, new_filename, os.path.join(cat_folder, new_filename),
+                                        line=f"{filename} → {category}/{new_filename}"
+                                             + (f" (rule: {rule})" if rule else ""), rule=rule)
+                else:
+                    transferred = None
+                    result = SortResult(filename, error=error,
+                                        line=f"Error with {filename}: {str(error)}")
+                self.journal_result(batch_id, result, os.path.join(source, filename), transferred, job)
+                results = [result] + [self.skip_duplicate(batch_id, duplicate, filename, job)
+                                      for duplicate in followers.get(filename, ())]
+                for result in results:
+                    lines.append(result.line)
+                    yield result
+        finally:
+            self.finish_batch(batch_id, category, lines)
+
+    def ai_sort_files(self, source, dest, filenames, prompt=None, cancel_event=None, job=None):
+        """Transfer files into dest/ai_renamed/ using AI-generated names.
+
+        Gemini calls run on a bounded worker pool behind an adaptive rate
+        limiter. Results come back in input order and are numbered here, on
+        the consuming thread, so the ai_smart counter never skips or races.
+        Setting cancel_event stops new requests; finished ones are still kept.
+
+        With duplicate handling on, only the first image of each cluster of
+        near-duplicates is sent; the rest share its name or are skipped.
+        With the local classifier on, screenshots it recognizes confidently
+        go straight into their category and never reach Gemini.
+
+        When re-encoding, a file's encode starts as soon as its batch is
+        sent, so it overlaps the AI calls instead of following them.
+
+        With a job (JobTracker), names are stored as they arrive and files
+        the job already has names for are placed without asking again. A
+        request that fails for good stops the job instead of falling back
+        to a timestamp name: its files stay pending for a resume.
+        """
+        ai_folder = os.path.join(dest, AI_FOLDER)
+        os.makedirs(ai_folder, exist_ok=True)
+        self.sync_destination(dest)
+        prompt = prompt or SHORT_PROMPT
+        cancel_event = cancel_event or threading.Event()
+        limiter = self.make_rate_limiter()
+        if self.name_cache is not None:
+            self.name_cache.reset_stats()
+        self.upload_stats.reset()
+        if self.backend is not None:
+            self.backend.reset_stats()
+        batch_size, workers = self.ai_limits()
+        batch_id = self.journal.begin_batch('ai_smart', self.transfer_settings['mode'], self.batch_output())
+        known = {}
+        if job is not None:
+            known = job.names()
+            if known:
+                filenames = [filename for filename in filenames if filename not in known]
+        filenames, followers = self.group_duplicates(source, filenames)
+        skip_duplicates = self.duplicate_settings['mode'] == 'skip'
+        local = {}
+        if self.classifier_settings['enabled'] and self.local_classifier is not None:
+            filenames = list(filenames)
+            local = self.classify_locally(source, filenames)
+            filenames = [filename for filename in filenames if filename not in local]
+
+        def with_retry(request):
+            return call_with_retry(request, limiter, max_retries=self.ai_settings['max_retries'],
+                                   cancel_event=cancel_event)
+
+        def name_batch(batch):
+            src_paths = [os.path.join(source, filename) for filename in batch]
+            try:
+                names = self.request_ai_batch(src_paths, prompt, call=with_retry)
+            except CancelledError:
+                raise
+            except Exception as e:
+                metrics.count('ai.errors', len(batch))
+                print(f"❌ AI generation error: {e}")
+                if job is not None:
+                    # Leave the rest for a resume rather than giving them made-up names
+                    job.error = f"AI generation error: {e}"
+                    cancel_event.set()
+                    raise CancelledError() from e
+                return [(fallback_filename(), False)] * len(batch)
+            if job is not None:
+                for filename, (name, cached) in zip(batch, names):
+                    job.named(filename, name, cached)
+            return names
+
+        pending = {}
+        transcoding = self.transcoder.active
+
+        def start_outputs(batch, folder):
+            for filename in batch:
+                group = [filename] + ([] if skip_duplicates else followers.get(filename, []))
+                for member in group:
+                    pending[member] = self.start_output(os.path.join(source, member), folder)
+
+        def started(batches):
+            for batch in batches:
+                if transcoding:
+                    start_outputs(batch, ai_folder)
+                yield batch
+
+        def named_files():
+            # Batches are named concurrently, files come out one at a time in order
+            batches = started(chunked(filenames, batch_size))
+            for batch, names, error in ordered_map(name_batch, batches, workers=workers,
+                                                   cancel_event=cancel_event):
+                for i, filename in enumerate(batch):
+                    yield filename, names[i] if names else None, error
+
+        def place(filename, named, error):
+            src_path = os.path.join(source, filename)
+            output = pending.pop(filename, None)
+            try:
+                if error is not None:
+                    raise error
+                ai_name, cached = named
+                number = self.counters.reserve('ai_smart')
+                # Placed here, not on the pool, so a failed file can
+                # hand its number straight back and leave no gap
+                try:
+                    new_filename, transferred = self.finish_output(
+                        output or self.start_output(src_path, ai_folder), ai_folder, f"{ai_name}_{number:03d}")
+                except Exception:
+                    self.counters.unreserve('ai_smart', number)
+                    raise
+                new_path = os.path.join(ai_folder, new_filename)
+                if job is not None:
+                    job.copied(filename, os.path.join(AI_FOLDER, new_filename), self.journal_op(transferred[0]))
+                result = SortResult(filename, new_filename, new_path,
+                                    line=f"{filename} → {new_filename}", cached=cached)
+            except Exception as e:
+                if output is not None:
+                    self.transcoder.discard(output)
+                transferred = None
+                result = SortResult(filename, error=e,
+                                    line=f"❌ {filename}: Error - {str(e)[:50]}")
+            self.journal_result(batch_id, result, src_path, transferred, job)
+            return result
+
+        def place_local(filename, category, confidence):
+            src_path = os.path.join(source, filename)
+            cat_folder = os.path.join(dest, category)
+            output = pending.pop(filename, None)
+            try:
+                os.makedirs(cat_folder, exist_ok=True)
+                number = self.counters.reserve(category)
+                try:
+                    new_filename, transferred = self.finish_output(
+                        output or self.start_output(src_path, cat_folder), cat_folder, f"{category}_{number:03d}")
+                except Exception:
+                    self.counters.unreserve(category, number)
+                    raise
+                new_path = os.path.join(cat_folder, new_filename)
+                if job is not None:
+                    job.copied(filename, os.path.join(category, new_filename), self.journal_op(transferred[0]))
+                result = SortResult(filename, new_filename, new_path, classified=True,
+                                    line=f"{filename} → {category}/{new_filename} (local, {confidence:.0%})")
+            except Exception as e:
+                if output is not None:
+                    self.transcoder.discard(output)
+                transferred = None
+                result = SortResult(filename, error=e,
+                                    line=f"❌ {filename}: Error - {str(e)[:50]}")
+            self.journal_result(batch_id, result, src_path, transferred, job)
+            return result
+
+        def with_duplicates(filename, result, place_duplicate):
+            results = [result]
+            for duplicate in followers.get(filename, ()):
+                if skip_duplicates:
+                    results.append(self.skip_duplicate(batch_id, duplicate, filename, job))
+                else:
+                    results.append(place_duplicate(duplicate))
+            return results
+
+        lines = []
+        try:
+            if transcoding:
+                # Local decisions are known now, so their encodes go first
+                for filename, (category, _) in local.items():
+                    os.makedirs(os.path.join(dest, category), exist_ok=True)
+                    start_outputs([filename], os.path.join(dest, category))
+            # Named in an earlier run of the job
+            for filename, named in known.items():
+                result = place(filename, named, None)
+                lines.append(result.line)
+                yield result
+            # Local decisions are instant, so they come out first
+            for filename, (category, confidence) in local.items():
+                for result in with_duplicates(filename, place_local(filename, category, confidence),
+                                              lambda d: place_local(d, category, confidence)):
+                    lines.append(result.line)
+                    yield result
+            for filename, named, error in named_files():
+                for result in with_duplicates(filename, place(filename, named, error),
+                                              lambda d: place(d, named, error)):
+                    lines.append(result.line)
+                    yield result
+        finally:
+            # Cancelled before they were placed
+            for output in pending.values():
+                self.transcoder.discard(output)
+            self.finish_batch(batch_id, 'ai_smart', lines)
+
+    def run(self, source, dest, category=None, prompt=None, cancel_event=None, router=None,
+            rules_only=False):
+        """Full streaming pipeline over a whole folder.
+
+        With a category every image goes there, otherwise the AI names them.
+        Files are sorted while the scan is still walking the rest of the tree.
+
+        With a router, files its rules match are sorted first, before any AI
+        call; only the rest go on to the category or Gemini, or nowhere with
+        rules_only. Routing needs the whole scan up front.
+
+        Each part runs as a job of the queue, so an interrupted run can be
+        resumed (see run_job); their ids are in run_job_ids.
+        """
+        kind = 'sort' if category else 'ai'
+        if not router:
+            job_id = self.jobs.submit(kind, source, dest, category=category, prompt=prompt, listed=False,
+                                      state='running')
+            self.run_job_ids = [job_id]
+            return self.run_job(job_id, cancel_event)
+        routed, unmatched = router.route(source, self.scan_entries(source, dest))
+        job_ids = [self.jobs.submit('sort', source, dest, [name for name, _ in files], category=routed_category,
+                                    rules=dict(files), state='running')
+                   for routed_category, files in routed.items()]
+        if unmatched and not rules_only:
+            job_ids.append(self.jobs.submit(kind, source, dest, unmatched, category=category, prompt=prompt,
+                                            state='running'))
+        self.run_job_ids = job_ids
+        return itertools.chain.from_iterable(self.run_job(job_id, cancel_event) for job_id in job_ids)
+
+    def run_job(self, job_id, cancel_event=None):
+        """Run or resume a job of the queue; yields a SortResult per file.
+
+        Files already finished are left alone and files in place but not
+        journaled yet are journaled first. A job whose scan never finished
+        scans its folder again for files it doesn't have. Setting
+        cancel_event stops it after the files in flight.
+
+        The job ends up 'done', 'failed' (with why, e.g. Gemini unreachable)
+        or 'cancelled'; the last two can be resumed.
+        """
+        queue = self.jobs
+        job = queue.job(job_id)
+        if job is None:
+            raise ValueError(f"no job #{job_id}")
+        tracker = JobTracker(queue, job)
+        queue.set_state(job_id, 'running')
+        try:
+            yield from self.journal_placed(tracker)
+            filenames = tracker.remaining()
+            if not job.listed:
+                filenames = itertools.chain(filenames, tracker.track(self.scan(job.source, job.dest)))
+            if isinstance(filenames, list) and not filenames:
+                return
+            if job.kind == 'sort':
+                results = self.sort_files(job.source, job.dest, filenames, job.category, rules=tracker.rules(),
+                                          job=tracker)
+            else:
+                results = self.ai_sort_files(job.source, job.dest, filenames, job.prompt, cancel_event, job=tracker)
+            with contextlib.closing(results):
+                for result in results:
+                    yield result
+                    # A category sort has no requests to stop; it stops between files
+                    if cancel_event is not None and cancel_event.is_set() and job.kind == 'sort':
+                        break
+        except Exception as e:
+            tracker.error = tracker.error or str(e)
+            raise
+        finally:
+            if tracker.error:
+                print(f"⚠️ Job #{job_id} stopped with {tracker.left} files left: {tracker.error}")
+                queue.set_state(job_id, 'failed', tracker.error)
+            elif job.listed and not tracker.left:
+                queue.set_state(job_id, 'done')
+            else:
+                queue.set_state(job_id, 'cancelled')
+
+    def journal_placed(self, tracker):
+        """Journal a job's files that were put in place but not recorded, in a batch of their own.
+
+        Ones that are no longer there go back to pending.
+        """
+        job = tracker.job
+        placed = []
+        for filename, relative, op in tracker.placed():
+            if os.path.exists(os.path.join(job.dest, relative)):
+                placed.append((filename, relative, op))
+            else:
+                self.dest_index.release(job.dest, relative)
+                tracker.reset(filename)
+        if not placed:
+            return
+        category = job.category or 'ai_smart'
+        batch_id = self.journal.begin_batch(category, self.transfer_settings['mode'], self.batch_output())
+        lines = []
+        try:
+            for filename, relative, op in placed:
+                new_path = os.path.join(job.dest, relative)
+                result = SortResult(filename, os.path.basename(relative), new_path,
+                                    line=f"{filename} → {relative.replace(os.sep, '/')} (resumed)")
+                self.journal_result(batch_id, result, os.path.join(job.source, filename), (op, None), tracker)
+                lines.append(result.line)
+                yield result
+        finally:
+            self.finish_batch(batch_id, category, lines)
+
+    def sort_rest(self, source, dest, filenames, category=None, prompt=None, cancel_event=None):
+        """Everything into category, or named by the AI without one"""
+        if isinstance(filenames, list) and not filenames:
+            return iter(())
+        if category:
+            return self.sort_files(source, dest, filenames, category)
+        return self.ai_sort_files(source, dest, filenames, prompt, cancel_event)
+
+    # ---- rules --------------------------------------------------------
+
+    def make_router(self):
+        """Compiled routing rules from config (falsy if there are none); raises RuleError"""
+        return Router(self.rules, self.categories)
+
+    def route(self, source, dest, entries, router):
+        """Sort the ScanEntry objects a rule matches, one batch per category.
+
+        Returns (results generator, names no rule matched).
+        """
+        routed, unmatched = router.route(source, entries)
+
+        def sort_routed():
+            for category, files in routed.items():
+                yield from self.sort_files(source, dest, [name for name, _ in files], category,
+                                           rules=dict(files))
+
+        return sort_routed(), unmatched
+
+    # ---- record -------------------------------------------------------
+
+    def journal_op(self, method):
+        """Journal op for a transfer method: a move that fell back to copy still removed the source"""
+        return 'move' if self.transfer_settings['mode'] == 'move' and method in TRANSFER_MODES else method
+
+    def journal_result(self, batch_id, result, src_path, transferred=None, job=None):
+        """Append one file to the journal; transferred is transfer()'s return.
+
+        With a job (JobTracker) the file is marked finished in the same commit.
+        """
+        if not result.ok or result.skipped:
+            metrics.count('files.skipped' if result.skipped else 'files.failed')
+            also = job.finished(result.filename, 'skipped' if result.skipped else 'failed') if job else None
+            with metrics.timer('journal.write'):
+                self.journal.append(batch_id, result.line, also=also)
+            return
+        method, checksum = transferred
+        op = self.journal_op(method)
+        try:
+            st = os.stat(result.dest_path)
+            size, mtime_ns = st.st_size, st.st_mtime_ns
+        except OSError:
+            size = mtime_ns = None
+        metrics.count('files.sorted')
+        metrics.count('transfer.bytes', size or 0)
+        with metrics.timer('journal.write'):
+            self.journal.append(batch_id, result.line, op, os.path.abspath(src_path),
+                                os.path.abspath(result.dest_path), size, mtime_ns, checksum,
+                                also=job.finished(result.filename, 'journaled') if job else None)
+
+    def finish_batch(self, batch_id, category, lines):
+        """Close a journaled batch and persist the new counts"""
+        self.counters.flush()
+        self.journal.end_batch(batch_id)
+        if lines and self.on_record:
+            batch = self.journal.batch(batch_id)
+            batch.lines = lines
+            self.on_record(category, batch.format())
+        self.save_config()
+
+    def undo_batch(self, batch_id=None):
+        """Reverse a batch (default: the latest): delete the files it created
+        and put moved files back. Files changed since are left alone.
+
+        A moved original that was re-encoded is written back in its own
+        format from the sorted file; pixels match unless the encode was lossy.
+
+        Counters are not rewound, so undone numbers are simply never reused.
+        Returns (batch_id, reversed, skipped); batch_id is None if nothing
+        can be undone.
+        """
+        batch_id = self._pick_batch(batch_id, 'done')
+        if batch_id is None:
+            return None, 0, 0
+        reversed_count = skipped = 0
+        for op in reversed(self.journal.operations(batch_id)):
+            try:
+                st = os.stat(op.dest)
+                if op.size is not None and (st.st_size, st.st_mtime_ns) != (op.size, op.mtime_ns):
+                    raise OSError(f"{op.dest} changed since it was sorted")
+                if op.op == 'move':
+                    if os.path.exists(op.source):
+                        raise OSError(f"{op.source} already exists")
+                    os.makedirs(os.path.dirname(op.source), exist_ok=True)
+                    transfer_file(op.dest, op.source, 'move')
+                elif op.op == 'transcode_move':
+                    if os.path.exists(op.source):
+                        raise OSError(f"{op.source} already exists")
+                    os.makedirs(os.path.dirname(op.source), exist_ok=True)
+                    self.transcoder.encode(op.dest, op.source, format_for(op.source) or 'png', quality=95,
+                                           lossless=True, metadata='keep', only_if_smaller=False)
+                    os.unlink(op.dest)
+                else:
+                    os.unlink(op.dest)
+                self.release_path(op.dest)
+                reversed_count += 1
+            except OSError as e:
+                print(f"⚠️ Undo skipped: {e}")
+                skipped += 1
+        self.journal.set_state(batch_id, 'undone')
+        return batch_id, reversed_count, skipped
+
+    def redo_batch(self, batch_id=None):
+        """Repeat an undone batch (default: the latest) with the same names"""
+        batch_id = self._pick_batch(batch_id, 'undone')
+        if batch_id is None:
+            return None, 0, 0
+        redone = skipped = 0
+        # Encode as the batch did, whatever the output settings are now
+        options = dict(self.journal.batch(batch_id).output or {}, only_if_smaller=False)
+        for op in self.journal.operations(batch_id):
+            try:
+                if os.path.exists(op.dest):
+                    raise OSError(f"{op.dest} already exists")
+                found = self.dest_index.locate(op.dest)
+                if found and not self.dest_index.claim(*found, self.folder_category(found[1].split(os.sep)[0])):
+                    raise OSError(f"{op.dest} is taken by a newer file")
+                try:
+                    os.makedirs(os.path.dirname(op.dest), exist_ok=True)
+                    if op.op in ('transcode', 'transcode_move'):
+                        self.transcoder.encode(op.source, op.dest, format_for(op.dest), **options)
+                        if op.op == 'transcode_move':
+                            os.unlink(op.source)
+                    else:
+                        transfer_file(op.source, op.dest, op.op)
+                except OSError:
+                    if found:
+                        self.dest_index.release(*found)
+                    raise
+                # The new file's stat is what a later undo checks against
+                if op.size is not None:
+                    st = os.stat(op.dest)
+                    self.journal.restat(op.id, st.st_size, st.st_mtime_ns)
+                redone += 1
+            except OSError as e:
+                print(f"⚠️ Redo skipped: {e}")
+                skipped += 1
+        self.journal.set_state(batch_id, 'done')
+        return batch_id, redone, skipped
+
+    def _pick_batch(self, batch_id, state):
+        if batch_id is None:
+            return self.journal.last_batch(state)
+        batch = self.journal.batch(batch_id)
+        if batch is None:
+            raise ValueError(f"no batch #{batch_id}")
+        if batch.state != state:
+            raise ValueError(f"batch #{batch_id} is {batch.state}")
+        return batch_id
@@ -0,0 +1,474 @@
+"""Durable queue of sorting jobs, so long batches survive a crash, a closed
+window or a lost network.
+
+A job is one category sort or AI rename: its folders, its category or
+prompt, and every file with how far it got:
+
+pending    nothing done yet
+named      Gemini's name is stored, so it is never asked again
+copied     the output is in place (placed, relative to dest), not journaled yet
+journaled  finished; 'failed' and 'skipped' are final too
+
+The tables live in the journal's database, so a file's journal row and its
+'journaled' state are one transaction: a resumed job never sorts or records
+a file twice. Resuming skips finished files, places named ones without
+asking Gemini again and only journals copied ones.
+
+A job whose files come from a scan that is still running is not 'listed'
+yet; resuming it scans the folder again for files it never got to.
+
+Jobs in the window run one at a time on a JobRunner thread: interactive
+ones (clicked) before background ones (resumed from an earlier session).
+An AI job running in the background gives way when an interactive one is
+queued: it stops after the files in flight and goes back into the queue.
+"""
+import os
+import threading
+import time
+from datetime import datetime
+
+from dispatch import TaskControl
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+FINAL_STATES = ('journaled', 'failed', 'skipped')
+# Finished jobs (and their file lists) are forgotten after this long
+KEEP_DAYS = 30
+
+
+def process_alive(pid):
+    """True if a process with this id exists (on this machine)"""
+    if pid is None:
+        return False
+    if os.name == 'nt':
+        import ctypes
+
+        # PROCESS_QUERY_LIMITED_INFORMATION; STILL_ACTIVE is 259
+        handle = ctypes.windll.kernel32.OpenProcess(0x1000, False, pid)
+        if not handle:
+            return False
+        try:
+            code = ctypes.c_ulong()
+            ctypes.windll.kernel32.GetExitCodeProcess(handle, ctypes.byref(code))
+            return code.value == 259
+        finally:
+            ctypes.windll.kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class Job:
+    __slots__ = ('id', 'kind', 'priority', 'state', 'source', 'dest', 'category', 'prompt', 'listed', 'pid',
+                 'created', 'updated', 'error', 'counts')
+
+    def __init__(self, id, kind, priority, state, source, dest, category, prompt, listed, pid, created,
+                 updated, error, counts=None):
+        self.id = id
+        self.kind = kind
+        self.priority = priority
+        self.state = state
+        self.source = source
+        self.dest = dest
+        self.category = category
+        self.prompt = prompt
+        self.listed = bool(listed)
+        self.pid = pid
+        self.created = created
+        self.updated = updated
+        self.error = error
+        # file state -> number of files
+        self.counts = counts or {}
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    @property
+    def finished(self):
+        return sum(self.counts.get(state, 0) for state in FINAL_STATES)
+
+    @property
+    def interrupted(self):
+        """Left running by a process that is gone"""
+        return self.state == 'running' and not process_alive(self.pid)
+
+    @property
+    def label(self):
+        return self.category if self.kind == 'sort' else 'AI rename'
+
+    def format(self):
+        """One line for `jobs` and the resume prompt"""
+        started = datetime.fromtimestamp(self.created).strftime("%Y-%m-%d %H:%M")
+        state = 'interrupted' if self.interrupted else self.state
+        text = (f"#{self.id} {started} {self.label}: {state}, {self.finished} of {self.total}"
+                f"{'' if self.listed else '+'} files done")
+        if self.counts.get('failed'):
+            text += f" ({self.counts['failed']} failed)"
+        text += f"  {self.source} → {self.dest}"
+        if self.error:
+            text += f"\n    {self.error}"
+        return text
+
+
+class JobQueue:
+    """Jobs and their files, stored next to the journal's tables"""
+
+    def __init__(self, journal):
+        self.db = journal.db
+        self.lock = journal.lock
+        with self.lock:
+            self.db.executescript('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    priority INTEGER NOT NULL,
+                    state TEXT NOT NULL,
+                    source TEXT NOT NULL,
+                    dest TEXT NOT NULL,
+                    category TEXT,
+                    prompt TEXT,
+                    listed INTEGER NOT NULL,
+                    pid INTEGER,
+                    created REAL NOT NULL,
+                    updated REAL NOT NULL,
+                    error TEXT);
+                CREATE TABLE IF NOT EXISTS job_files (
+                    job_id INTEGER NOT NULL,
+                    position INTEGER NOT NULL,
+                    filename TEXT NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'pending',
+                    name TEXT,
+                    cached INTEGER,
+                    rule TEXT,
+                    placed TEXT,
+                    op TEXT,
+                    PRIMARY KEY (job_id, position)) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, priority, id);
+            ''')
+            cutoff = time.time() - KEEP_DAYS * 86400
+            self.db.execute('''DELETE FROM job_files WHERE job_id IN
+                               (SELECT id FROM jobs WHERE state IN ('done', 'cancelled') AND updated < ?)''',
+                            (cutoff,))
+            self.db.execute("DELETE FROM jobs WHERE state IN ('done', 'cancelled') AND updated < ?", (cutoff,))
+            self.db.commit()
+
+    # ---- jobs ---------------------------------------------------------
+
+    def submit(self, kind, source, dest, filenames=(), category=None, prompt=None, priority=INTERACTIVE,
+               listed=True, rules=None, state='queued'):
+        """Queue a job ('sort' into category, or 'ai'); returns its id"""
+        rules = rules or {}
+        # Resumed from anywhere later, so never relative to today's working directory
+        source, dest = os.path.abspath(source), os.path.abspath(dest)
+        now = time.time()
+        with self.lock:
+            job_id = self.db.execute('''INSERT INTO jobs (kind, priority, state, source, dest, category, prompt,
+                                                          listed, pid, created, updated)
+                                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                                     (kind, priority, state, source, dest, category, prompt, int(listed),
+                                      os.getpid() if state == 'running' else None, now, now)).lastrowid
+            self.db.executemany('INSERT INTO job_files (job_id, position, filename, rule) VALUES (?, ?, ?, ?)',
+                                ((job_id, position, filename, rules.get(filename))
+                                 for position, filename in enumerate(filenames)))
+            self.db.commit()
+        return job_id
+
+    def job(self, job_id):
+        jobs = self._jobs('WHERE id=?', (job_id,))
+        return jobs[0] if jobs else None
+
+    def recent(self, limit=20):
+        """The latest jobs, newest first"""
+        return self._jobs('ORDER BY id DESC LIMIT ?', (limit,))
+
+    def unfinished(self):
+        """Jobs worth resuming: queued, failed, or left running by a process that is gone"""
+        jobs = self._jobs("WHERE state IN ('queued', 'running', 'failed') ORDER BY priority, id")
+        return [job for job in jobs if job.state != 'running' or job.interrupted]
+
+    def _jobs(self, where, params=()):
+        with self.lock:
+            rows = self.db.execute(f'''SELECT id, kind, priority, state, source, dest, category, prompt, listed,
+                                              pid, created, updated, error FROM jobs {where}''', params).fetchall()
+            jobs = [Job(*row) for row in rows]
+            for job in jobs:
+                job.counts = dict(self.db.execute('''SELECT state, COUNT(*) FROM job_files WHERE job_id=?
+                                                     GROUP BY state''', (job.id,)))
+        return jobs
+
+    def claim(self, can_run=None):
+        """Mark the most urgent queued job that can_run(job) allows as ours and return it"""
+        with self.lock:
+            rows = self.db.execute('''SELECT id, kind, priority, state, source, dest, category, prompt, listed,
+                                             pid, created, updated, error FROM jobs
+                                      WHERE state='queued' ORDER BY priority, id''').fetchall()
+            for row in rows:
+                job = Job(*row)
+                if can_run is not None and not can_run(job):
+                    continue
+                self.db.execute("UPDATE jobs SET state='running', pid=?, updated=? WHERE id=?",
+                                (os.getpid(), time.time(), job.id))
+                self.db.commit()
+                job.state = 'running'
+                return job
+        return None
+
+    def set_state(self, job_id, state, error=None):
+        with self.lock:
+            self.db.execute('UPDATE jobs SET state=?, pid=?, error=?, updated=? WHERE id=?',
+                            (state, os.getpid() if state == 'running' else None, error, time.time(), job_id))
+            self.db.commit()
+
+    def requeue(self, job_id, priority=BACKGROUND):
+        with self.lock:
+            self.db.execute("UPDATE jobs SET state='queued', priority=?, pid=NULL, error=NULL, updated=? WHERE id=?",
+                            (priority, time.time(), job_id))
+            self.db.commit()
+
+    def queued(self):
+        """Number of jobs waiting to run"""
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM jobs WHERE state='queued'").fetchone()[0]
+
+    def set_listed(self, job_id):
+        with self.lock:
+            self.db.execute('UPDATE jobs SET listed=1 WHERE id=?', (job_id,))
+            self.db.commit()
+
+    # ---- files --------------------------------------------------------
+
+    def files(self, job_id):
+        """[(position, filename, state, name, cached, rule, placed, op)] in position order"""
+        with self.lock:
+            return self.db.execute('''SELECT position, filename, state, name, cached, rule, placed, op
+                                      FROM job_files WHERE job_id=? ORDER BY position''', (job_id,)).fetchall()
+
+    def add_files(self, job_id, rows):
+        """Append (position, filename) rows to a job that is still being listed"""
+        with self.lock:
+            self.db.executemany('INSERT OR IGNORE INTO job_files (job_id, position, filename) VALUES (?, ?, ?)',
+                                ((job_id, position, filename) for position, filename in rows))
+            self.db.commit()
+
+    def mark(self, job_id, position, state, **fields):
+        """Move one file to state, storing fields (name, cached, placed, op) with it"""
+        sql, params = self.mark_statement(job_id, position, state, **fields)
+        with self.lock:
+            self.db.execute(sql, params)
+            self.db.commit()
+
+    @staticmethod
+    def mark_statement(job_id, position, state, **fields):
+        """(sql, params) of mark(), for committing together with a journal row"""
+        assignments = ''.join(f', {key}=?' for key in fields)
+        return (f'UPDATE job_files SET state=?{assignments} WHERE job_id=? AND position=?',
+                (state, *fields.values(), job_id, position))
+
+
+class JobTracker:
+    """One run of a job: the engine reports every file's progress through it.
+
+    Thread-safe; naming and placing happen on worker threads.
+    """
+
+    def __init__(self, queue, job):
+        self.queue = queue
+        self.job = job
+        self.lock = threading.Lock()
+        self.rows = {}          # filename -> [position, state, name, cached, rule, placed, op]
+        self.unsaved = []       # (position, filename) seen in a scan, not stored yet
+        # Why the run stopped early (e.g. Gemini unreachable), if it did
+        self.error = None
+        for position, filename, *rest in queue.files(job.id):
+            self.rows[filename] = [position, *rest]
+
+    def track(self, filenames):
+        """Pass on the filenames the job doesn't know yet, adding them to it.
+
+        Known ones are left out: remaining() already has those still to do.
+        """
+        for filename in filenames:
+            with self.lock:
+                if filename in self.rows:
+                    continue
+                position = len(self.rows)
+                self.rows[filename] = [position, 'pending', None, None, None, None, None]
+                self.unsaved.append((position, filename))
+                if len(self.unsaved) >= 256:
+                    self._save_new()
+            yield filename
+        with self.lock:
+            self._save_new()
+        if not self.job.listed:
+            self.queue.set_listed(self.job.id)
+            self.job.listed = True
+
+    def _save_new(self):
+        if self.unsaved:
+            self.queue.add_files(self.job.id, self.unsaved)
+            self.unsaved = []
+
+    def remaining(self):
+        """Files not placed yet (pending or named), in job order"""
+        with self.lock:
+            rows = sorted((row[0], filename) for filename, row in self.rows.items() if row[1] in ('pending', 'named'))
+        return [filename for _, filename in rows]
+
+    def names(self):
+        """{filename: (name, cached)} of files Gemini already named"""
+        with self.lock:
+            return {filename: (row[2], bool(row[3])) for filename, row in self.rows.items() if row[1] == 'named'}
+
+    def rules(self):
+        """{filename: routing rule} for files a rule sent here"""
+        with self.lock:
+            return {filename: row[4] for filename, row in self.rows.items() if row[4]}
+
+    def placed(self):
+        """[(filename, placed, op)] of files in place but not journaled, in job order"""
+        with self.lock:
+            rows = sorted((row[0], filename, row[5], row[6]) for filename, row in self.rows.items()
+                          if row[1] == 'copied')
+        return [(filename, placed, op) for _, filename, placed, op in rows]
+
+    @property
+    def left(self):
+        """Files that still need work"""
+        with self.lock:
+            return sum(1 for row in self.rows.values() if row[1] not in FINAL_STATES)
+
+    def _update(self, filename, state, **fields):
+        """In-memory update; returns the position, or None for a file the job doesn't have"""
+        with self.lock:
+            row = self.rows.get(filename)
+            if row is None:
+                return None
+            self._save_new()
+            row[1] = state
+            for key, value in fields.items():
+                row[('name', 'cached', 'rule', 'placed', 'op').index(key) + 2] = value
+            return row[0]
+
+    def named(self, filename, name, cached):
+        position = self._update(filename, 'named', name=name, cached=int(cached))
+        if position is not None:
+            self.queue.mark(self.job.id, position, 'named', name=name, cached=int(cached))
+
+    def copied(self, filename, placed, op):
+        position = self._update(filename, 'copied', placed=placed, op=op)
+        if position is not None:
+            self.queue.mark(self.job.id, position, 'copied', placed=placed, op=op)
+
+    def reset(self, filename):
+        """Back to pending, e.g. a copied file that is no longer there"""
+        position = self._update(filename, 'pending', placed=None, op=None)
+        if position is not None:
+            self.queue.mark(self.job.id, position, 'pending', placed=None, op=None)
+
+    def finished(self, filename, state):
+        """(sql, params) moving the file to a final state, for the journal's transaction"""
+        position = self._update(filename, state)
+        if position is None:
+            return None
+        return self.queue.mark_statement(self.job.id, position, state)
+
+
+class JobRunner:
+    """Runs queued jobs one at a time on a daemon thread, most urgent first.
+
+    on_event(event, job, payload) is called from that thread with
+    'started', 'result' (payload: a SortResult) and 'finished' (payload:
+    the job's new state); job carries its file counts on 'started' and
+    'finished'. can_run(job) can hold jobs back, e.g. AI jobs until
+    Gemini is connected. The running job can be cancelled, or paused at its
+    next file or request.
+    """
+
+    def __init__(self, engine, on_event, can_run=None):
+        self.engine = engine
+        self.on_event = on_event
+        self.can_run = can_run
+        self.wake = threading.Event()
+        self.lock = threading.Lock()
+        self.current = None     # (job, TaskControl)
+        self.preempted = False
+        threading.Thread(target=self._loop, daemon=True, name='jobs').start()
+
+    def submit(self, source, dest, filenames, category=None, prompt=None, priority=INTERACTIVE, rules=None):
+        """Queue a category sort (or an AI rename without category); returns the job id"""
+        job_id = self.engine.jobs.submit('sort' if category else 'ai', source, dest, filenames,
+                                         category=category, prompt=prompt, priority=priority, rules=rules)
+        with self.lock:
+            if self.current is not None:
+                job, cancel_event = self.current
+                if job.kind == 'ai' and job.priority > priority:
+                    self.preempted = True
+                    cancel_event.set()
+        self.wake.set()
+        return job_id
+
+    def resume(self, job_ids, priority=BACKGROUND):
+        for job_id in job_ids:
+            self.engine.jobs.requeue(job_id, priority)
+        self.wake.set()
+
+    def cancel(self, job_id):
+        """Stop a running job after the files in flight, or drop a queued one"""
+        with self.lock:
+            if self.current is not None and self.current[0].id == job_id:
+                self.current[1].set()
+                return
+        job = self.engine.jobs.job(job_id)
+        if job is not None and job.state == 'queued':
+            self.engine.jobs.set_state(job_id, 'cancelled')
+
+    def pause(self, job_id, paused=True):
+        """Hold the running job before its next file or request (paused=False goes on); False if it isn't running"""
+        with self.lock:
+            if self.current is None or self.current[0].id != job_id:
+                return False
+            control = self.current[1]
+        if paused:
+            control.pause()
+        else:
+            control.resume()
+        return True
+
+    def _loop(self):
+        while True:
+            self.wake.wait()
+            self.wake.clear()
+            while True:
+                job = self.engine.jobs.claim(self.can_run)
+                if job is None:
+                    break
+                self._run(job)
+
+    def _run(self, job):
+        cancel_event = TaskControl()
+        with self.lock:
+            self.current = (job, cancel_event)
+            self.preempted = False
+        try:
+            results = self.engine.run_job(job.id, cancel_event)
+            self.on_event('started', self.engine.jobs.job(job.id), None)
+            for result in results:
+                self.on_event('result', job, result)
+        except Exception as e:
+            print(f"❌ Job #{job.id} stopped: {e}")
+            self.engine.jobs.set_state(job.id, 'failed', str(e))
+        finally:
+            with self.lock:
+                self.current = None
+                preempted = self.preempted
+            job = self.engine.jobs.job(job.id)
+            if preempted and job.state == 'cancelled':
+                self.engine.jobs.requeue(job.id, job.priority)
+                job.state = 'queued'
+            self.on_event('finished', job, job.state)
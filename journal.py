@@ -0,0 +1,267 @@
+"""Append-only journal of every file the app sorted.
+
+Each batch (one click, one CLI run, one watch poll) gets a row, and every
+file in it an operation row with source, destination, size, mtime and,
+when it is already known, the SHA-256. Appending is a single INSERT, the
+History tab reads it a page at a time, and because the journal knows
+exactly which files a batch created it can be undone without rescanning.
+A batch that re-encoded its files also keeps the encoder options it used,
+so a redo writes the same files again.
+
+The old history.txt is imported once, as read-only batches, the first
+time the journal is created.
+"""
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+PAGE_SIZE = 50
+
+LEGACY_HEADER = re.compile(r'^--- (\d{4}-\d\d-\d\d \d\d:\d\d:\d\d) - Category: (.+?) ---$')
+
+
+class Batch:
+    __slots__ = ('id', 'started', 'category', 'mode', 'state', 'lines', 'output')
+
+    def __init__(self, id, started, category, mode, state, lines=None, output=None):
+        self.id = id
+        self.started = started
+        self.category = category
+        self.mode = mode
+        self.state = state
+        self.lines = lines or []
+        # Encoder options ({'quality', 'lossless', ...}) of a re-encoding batch
+        self.output = json.loads(output) if output else None
+
+    def format(self):
+        """Text block for the History tab, in the old history.txt layout"""
+        timestamp = datetime.fromtimestamp(self.started).strftime("%Y-%m-%d %H:%M:%S")
+        status = " [undone]" if self.state == 'undone' else ""
+        block = f"\n--- {timestamp} - Category: {self.category} (#{self.id}){status} ---\n"
+        return block + ''.join(f"{line}\n" for line in self.lines)
+
+
+class Operation:
+    __slots__ = ('id', 'op', 'source', 'dest', 'size', 'mtime_ns', 'sha256')
+
+    def __init__(self, id, op, source, dest, size, mtime_ns, sha256):
+        self.id = id
+        self.op = op
+        self.source = source
+        self.dest = dest
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.sha256 = sha256
+
+
+class Journal:
+    """SQLite journal shared by the Tk thread and sorting workers"""
+
+    def __init__(self, path, legacy_history=None):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        is_new = not os.path.exists(path)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS batches (
+                id INTEGER PRIMARY KEY,
+                started REAL NOT NULL,
+                category TEXT NOT NULL,
+                mode TEXT,
+                state TEXT NOT NULL DEFAULT 'done');
+            CREATE TABLE IF NOT EXISTS operations (
+                id INTEGER PRIMARY KEY,
+                batch_id INTEGER NOT NULL,
+                op TEXT,
+                source TEXT,
+                dest TEXT,
+                size INTEGER,
+                mtime_ns INTEGER,
+                sha256 TEXT,
+                line TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS operations_batch ON operations (batch_id);
+        ''')
+        # Journals from before batches recorded their encoder options
+        if 'output' not in {row[1] for row in self.db.execute('PRAGMA table_info(batches)')}:
+            self.db.execute('ALTER TABLE batches ADD COLUMN output TEXT')
+        self.fts = self._create_search_index()
+        self.db.commit()
+        self.lock = threading.Lock()
+        if is_new and legacy_history and os.path.exists(legacy_history):
+            self.import_history(legacy_history)
+
+    def _create_search_index(self):
+        """Full-text index over the lines, if this SQLite has FTS5"""
+        try:
+            self.db.executescript('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS operations_fts
+                    USING fts5(line, content='operations', content_rowid='id');
+                CREATE TRIGGER IF NOT EXISTS operations_fts_insert AFTER INSERT ON operations BEGIN
+                    INSERT INTO operations_fts (rowid, line) VALUES (new.id, new.line);
+                END;
+            ''')
+            return True
+        except sqlite3.OperationalError:
+            return False
+
+    # ---- writing ------------------------------------------------------
+
+    def begin_batch(self, category, mode=None, output=None):
+        """New batch; output is the encoder options when its files are re-encoded"""
+        with self.lock:
+            cursor = self.db.execute('INSERT INTO batches (started, category, mode, output) VALUES (?, ?, ?, ?)',
+                                     (time.time(), category, mode, json.dumps(output) if output else None))
+            self.db.commit()
+            return cursor.lastrowid
+
+    def append(self, batch_id, line, op=None, source=None, dest=None, size=None,
+               mtime_ns=None, sha256=None, also=None):
+        """Record one file; op is None for failures, which can't be undone.
+
+        also is an optional (sql, params) committed in the same transaction,
+        e.g. the job queue marking the file done.
+        """
+        with self.lock:
+            self.db.execute('''INSERT INTO operations (batch_id, op, source, dest, size, mtime_ns, sha256, line)
+                               VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                            (batch_id, op, source, dest, size, mtime_ns, sha256, line))
+            if also is not None:
+                self.db.execute(*also)
+            self.db.commit()
+
+    def end_batch(self, batch_id):
+        """Drop the batch again if nothing was recorded in it"""
+        with self.lock:
+            self.db.execute('''DELETE FROM batches WHERE id=?
+                               AND NOT EXISTS (SELECT 1 FROM operations WHERE batch_id=?)''',
+                            (batch_id, batch_id))
+            self.db.commit()
+
+    def restat(self, operation_id, size, mtime_ns):
+        """Record the size and mtime of a file written again (by a redo)"""
+        with self.lock:
+            self.db.execute('UPDATE operations SET size=?, mtime_ns=? WHERE id=?', (size, mtime_ns, operation_id))
+            self.db.commit()
+
+    def set_state(self, batch_id, state):
+        with self.lock:
+            self.db.execute('UPDATE batches SET state=? WHERE id=?', (state, batch_id))
+            self.db.commit()
+
+    def clear(self):
+        with self.lock:
+            self.db.execute('DELETE FROM operations')
+            self.db.execute('DELETE FROM batches')
+            if self.fts:
+                self.db.execute("INSERT INTO operations_fts (operations_fts) VALUES ('delete-all')")
+            self.db.commit()
+
+    def import_history(self, path):
+        """Load an old history.txt as batches with lines but no operations"""
+        batch_id = None
+        with open(path, 'r', encoding='utf-8', errors='replace') as f, self.lock:
+            for raw in f:
+                line = raw.rstrip('\n')
+                header = LEGACY_HEADER.match(line)
+                if header:
+                    started = datetime.strptime(header.group(1), "%Y-%m-%d %H:%M:%S").timestamp()
+                    batch_id = self.db.execute('INSERT INTO batches (started, category, state) VALUES (?, ?, ?)',
+                                               (started, header.group(2), 'legacy')).lastrowid
+                elif line.strip() and batch_id is not None:
+                    self.db.execute('INSERT INTO operations (batch_id, line) VALUES (?, ?)', (batch_id, line))
+            self.db.commit()
+
+    # ---- reading ------------------------------------------------------
+
+    def batch(self, batch_id):
+        with self.lock:
+            row = self.db.execute('SELECT id, started, category, mode, state, output FROM batches WHERE id=?',
+                                  (batch_id,)).fetchone()
+        return Batch(*row[:5], output=row[5]) if row else None
+
+    def page(self, before=None, limit=PAGE_SIZE, query=None):
+        """Up to limit batches older than batch id `before`, oldest first.
+
+        With a query only batches containing a matching line are returned,
+        and only their matching lines.
+        """
+        before = before if before is not None else 2 ** 63 - 1
+        with self.lock:
+            if query:
+                matching, term = self._matching(query)
+                rows = self.db.execute(f'''SELECT DISTINCT b.id, b.started, b.category, b.mode, b.state
+                                           FROM batches b JOIN operations o ON o.batch_id = b.id
+                                           WHERE b.id < ? AND o.id IN ({matching})
+                                           ORDER BY b.id DESC LIMIT ?''',
+                                       (before, term, limit)).fetchall()
+            else:
+                rows = self.db.execute('''SELECT id, started, category, mode, state FROM batches
+                                          WHERE id < ? ORDER BY id DESC LIMIT ?''',
+                                       (before, limit)).fetchall()
+            batches = [Batch(*row) for row in reversed(rows)]
+            for batch in batches:
+                if query:
+                    lines = self.db.execute(f'''SELECT line FROM operations
+                                                WHERE batch_id=? AND id IN ({matching}) ORDER BY id''',
+                                            (batch.id, term))
+                else:
+                    lines = self.db.execute('SELECT line FROM operations WHERE batch_id=? ORDER BY id',
+                                            (batch.id,))
+                batch.lines = [line for line, in lines]
+        return batches
+
+    def _matching(self, query):
+        """(subquery selecting matching operation ids, its parameter)"""
+        if self.fts and re.search(r'\w', query):
+            # One quoted prefix phrase, so user input is never FTS syntax
+            return ('SELECT rowid FROM operations_fts WHERE operations_fts MATCH ?',
+                    '"' + query.replace('"', '""') + '"*')
+        escaped = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        return "SELECT id FROM operations WHERE line LIKE ? ESCAPE '\\'", f'%{escaped}%'
+
+    def operations(self, batch_id):
+        """Undoable operations of a batch, in the order they happened"""
+        with self.lock:
+            rows = self.db.execute('''SELECT id, op, source, dest, size, mtime_ns, sha256 FROM operations
+                                      WHERE batch_id=? AND op IS NOT NULL ORDER BY id''', (batch_id,))
+            return [Operation(*row) for row in rows]
+
+    def decisions(self, legacy_root=None, exclude=('ai_smart',)):
+        """[(category, destination path)] of every sort that still stands.
+
+        Legacy history.txt batches only know a relative destination, which
+        is resolved against legacy_root when given.
+        """
+        placeholders = ','.join('?' * len(exclude))
+        with self.lock:
+            rows = self.db.execute(f'''SELECT b.category, o.dest FROM operations o
+                                       JOIN batches b ON b.id = o.batch_id
+                                       WHERE b.state = 'done' AND o.op IS NOT NULL
+                                       AND b.category NOT IN ({placeholders})''', exclude).fetchall()
+            legacy = []
+            if legacy_root:
+                legacy = self.db.execute(f'''SELECT b.category, o.line FROM operations o
+                                             JOIN batches b ON b.id = o.batch_id
+                                             WHERE b.state = 'legacy'
+                                             AND b.category NOT IN ({placeholders})''', exclude).fetchall()
+        for category, line in legacy:
+            target = line.rpartition(' → ')[2]
+            if target != line:
+                rows.append((category, os.path.join(legacy_root, *target.split('/'))))
+        return rows
+
+    def last_batch(self, state):
+        """Most recent batch in state ('done' to undo, 'undone' to redo)"""
+        with self.lock:
+            row = self.db.execute('SELECT id FROM batches WHERE state=? ORDER BY id DESC LIMIT 1',
+                                  (state,)).fetchone()
+        return row[0] if row else None
+
+    def close(self):
+        with self.lock:
+            self.db.close()
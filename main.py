@@ -1,27 +1,37 @@
 import os
-import json
-import shutil
-from datetime import datetime
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, scrolledtext
-from PIL import Image, ImageTk
 import threading
 import time
+from datetime import datetime
 from dotenv import load_dotenv
-import re
 import sys
-import io
+
+from thumbgrid import ThumbnailGrid, THUMB_SIZE
+from thumbs import ThumbnailLoader, ThumbnailCache
+from watch import ProcessedLedger, watch
+from engine import (SortEngine, CACHE_DIR, DATA_DIR, GENAI_AVAILABLE, NUMPY_AVAILABLE, DEFAULT_PROMPT,
+                    SHORT_PROMPT, DUPLICATE_MODES, default_categories)
+from transfer import MODES as TRANSFER_MODES
+from backends import BACKENDS
+from transcode import METADATA_MODES, OUTPUT_FORMATS
+from destindex import SHARD_MODES
+from metrics import metrics
+from catalog import QueryError
+from rules import RuleError
+from scanner import EXTENSION_FORMATS, ScanEntry
+from jobs import BACKGROUND, JobRunner
+from dispatch import TaskControl, UIDispatcher
+
+# Manual sorts of fewer files only report in the status bar, without a progress window
+PROGRESS_WINDOW_MIN = 20
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Try to import Google's genai package
-try:
-    import google.generativeai as genai
-    GENAI_AVAILABLE = True
+if GENAI_AVAILABLE:
     print("✅ Using google.generativeai package")
-except ImportError:
-    GENAI_AVAILABLE = False
+else:
     print("❌ Google AI packages not installed. Run: pip install google-generativeai")
 
 class ScreenshotRenamer:
@@ -36,85 +46,131 @@ class ScreenshotRenamer:
         # Initialize status variables FIRST
         self.ai_status = tk.StringVar(value="AI: Initializing...")
         
-        # Categories configuration
-        self.categories = {
-            'tickets': {'emoji': '🎫', 'color': '#FF6B6B', 'count': 1},
-            'chats': {'emoji': '💬', 'color': '#4ECDC4', 'count': 1},
-            'funny': {'emoji': '😂', 'color': '#FFE66D', 'count': 1},
-            'movie': {'emoji': '🎬', 'color': '#95E1D3', 'count': 1},
-            'others': {'emoji': '📁', 'color': '#A8E6CF', 'count': 1},
-            'ai_smart': {'emoji': '🤖', 'color': '#9B59B6', 'count': 1}
-        }
+        # Every other thread reaches the widgets through this queue, drained once per frame
+        self.dispatcher = UIDispatcher(root)
+        
+        # All sorting, naming and bookkeeping lives in the headless engine;
+        # this class only reads widgets and shows results.
+        self.engine = SortEngine(on_record=self.on_batch_recorded)
+        
+        # Sorts and AI renames run one at a time as durable jobs, off the UI thread;
+        # AI jobs wait until Gemini is connected
+        self.job_runner = JobRunner(self.engine, self.on_job_event,
+                                    can_run=lambda job: job.kind != 'ai' or self.ai_available)
+        # job id -> its progress window's widgets and counts
+        self.job_windows = {}
+        # job id -> [done, failed, cache hits], counted on the job thread
+        self.job_tallies = {}
+        self.offered_resume = False
         
         # Variables
         self.source_folder = tk.StringVar()
         self.dest_folder = tk.StringVar()
-        self.selected_files = []
-        self.preview_images = []
-        self.gemini_model = None
-        self.ai_available = False
-        self.category_counts = self.load_counts()
         
-        # Initialize Gemini AI
-        self.init_gemini()
+        # Bumped by every Load, so results of an older scan are dropped
+        self.scan_generation = 0
+        # Cancel/pause of the running scan and dimension indexing
+        self.scan_control = None
+        self.batch_busy = False
+        # (folder, catalog scan id) of what the grid shows, for Find queries
+        self.loaded_scan = None
+        
+        # Widgets of tabs that are only built when first opened
+        self.ai_prompt = None
+        self.test_ai_button = None
+        self.history_text = None
         
         # Setup UI
         self.setup_ui()
         
-        # Load existing config
+        # Show the config the engine already read
         self.load_config()
         
+        self.dispatcher.start()
+        
+        # Connect to Gemini in the background, the window is usable meanwhile
+        self.init_gemini()
+    
+    @property
+    def categories(self):
+        return self.engine.categories
+    
+    @categories.setter
+    def categories(self, value):
+        self.engine.categories = value
+    
+    @property
+    def ai_available(self):
+        return self.engine.ai_available
+        
     def init_gemini(self):
-        """Initialize Google Gemini AI"""
-        if not GENAI_AVAILABLE:
-            self.ai_available = False
-            self.ai_status.set("AI: ❌ Package not installed (pip install google-generativeai)")
+        """Initialize Google Gemini AI on a background thread"""
+        def connect():
+            status = self.engine.init_backend()
+            self.dispatcher.post(self.on_gemini_ready, status)
+        
+        threading.Thread(target=connect, daemon=True).start()
+    
+    def on_gemini_ready(self, status):
+        self.ai_status.set(status)
+        state = 'normal' if self.ai_available else 'disabled'
+        self.ai_button.config(state=state)
+        if self.test_ai_button is not None:
+            self.test_ai_button.config(state=state)
+        if not self.offered_resume:
+            self.offered_resume = True
+            self.offer_resume()
+        # Queued AI jobs may run now
+        self.job_runner.wake.set()
+    
+    def offer_resume(self):
+        """Ask whether to finish the jobs an earlier session left unfinished"""
+        jobs = self.engine.jobs.unfinished()
+        if not jobs:
             return
-            
-        try:
-            # Get API key from environment variable
-            api_key = os.getenv('GEMINI_API_KEY')
-            if api_key and api_key != "your_api_key_here":
-                # Configure Gemini
-                genai.configure(api_key=api_key)
-                self.gemini_model = genai.GenerativeModel('gemini-3-flash-preview')
-                self.ai_available = True
-                self.ai_status.set("AI: ✅ Connected to Gemini")
-                print("✅ Gemini AI initialized successfully")
-            else:
-                self.ai_available = False
-                self.ai_status.set("AI: ❌ No valid API Key (Add to .env file)")
-                print("❌ No valid API key found in .env file")
-        except Exception as e:
-            self.ai_available = False
-            self.ai_status.set(f"AI: ❌ Error - {str(e)[:30]}")
-            print(f"❌ Gemini initialization error: {e}")
+        listing = '\n'.join(job.format() for job in jobs[:5])
+        if len(jobs) > 5:
+            listing += f"\n... and {len(jobs) - 5} more"
+        answer = messagebox.askyesnocancel(
+            "Unfinished Jobs",
+            f"{len(jobs)} jobs from an earlier session did not finish:\n\n{listing}\n\n"
+            "Yes: finish them in the background\nNo: drop them\nCancel: ask again next time")
+        if answer is None:
+            return
+        if not answer:
+            for job in jobs:
+                self.engine.jobs.set_state(job.id, 'cancelled')
+            return
+        for job in jobs:
+            self.open_job_window(job.id, job.label, job.total - job.finished)
+        self.job_runner.resume([job.id for job in jobs], BACKGROUND)
     
     def setup_ui(self):
         # Create notebook for tabs
-        notebook = ttk.Notebook(self.root)
-        notebook.pack(fill='both', expand=True, padx=10, pady=5)
+        self.notebook = ttk.Notebook(self.root)
+        self.notebook.pack(fill='both', expand=True, padx=10, pady=5)
         
         # Main Tab
-        main_frame = ttk.Frame(notebook)
-        notebook.add(main_frame, text='📸 Sortshot')
-        
-        # AI Tab
-        ai_frame = ttk.Frame(notebook)
-        notebook.add(ai_frame, text='🤖 AI Settings')
-        
-        # Settings Tab
-        settings_frame = ttk.Frame(notebook)
-        notebook.add(settings_frame, text='⚙️ Categories')
-        
-        # History Tab
-        history_frame = ttk.Frame(notebook)
-        notebook.add(history_frame, text='📜 History')
-        
+        main_frame = ttk.Frame(self.notebook)
+        self.notebook.add(main_frame, text='📸 Sortshot')
         self.setup_main_tab(main_frame)
-        self.setup_ai_tab(ai_frame)
-        self.setup_settings_tab(settings_frame)
-        self.setup_history_tab(history_frame)
+        
+        # The other tabs are built the first time they are opened
+        self.pending_tabs = {}
+        for text, setup in (('🤖 AI Settings', self.setup_ai_tab),
+                            ('⚙️ Categories', self.setup_settings_tab),
+                            ('📜 History', self.setup_history_tab),
+                            ('📊 Stats', self.setup_stats_tab)):
+            frame = ttk.Frame(self.notebook)
+            self.notebook.add(frame, text=text)
+            self.pending_tabs[str(frame)] = (setup, frame)
+        self.notebook.bind('<<NotebookTabChanged>>', self.on_tab_changed)
+    
+    def on_tab_changed(self, event):
+        pending = self.pending_tabs.pop(self.notebook.select(), None)
+        if pending:
+            setup, frame = pending
+            setup(frame)
         
     def setup_main_tab(self, parent):
         # Top Frame - Folder Selection
@@ -145,14 +201,19 @@ class ScreenshotRenamer:
         tk.Button(button_frame, text="📂 Load Screenshots", command=self.load_images, 
                  bg='#95E1D3', font=('Arial', 10, 'bold'), padx=20).pack(side='left', padx=5)
         
-        # AI Quick Rename Button
-        ai_button = tk.Button(button_frame, text="🤖 AI Smart Rename", command=self.ai_rename_selected,
-                     bg='#9B59B6', fg='white', font=('Arial', 10, 'bold'), padx=20)
-        ai_button.pack(side='left', padx=5)
+        self.scan_recursive = tk.BooleanVar(value=self.engine.scan_config['recursive'])
+        tk.Checkbutton(button_frame, text="Include subfolders", variable=self.scan_recursive,
+                      command=self.save_scan_settings, bg='#f0f0f0').pack(side='left', padx=5)
         
-        # Disable AI button if not available
-        if not self.ai_available:
-            ai_button.config(state='disabled')
+        # AI Quick Rename Button, enabled once Gemini is connected
+        self.ai_button = tk.Button(button_frame, text="🤖 AI Smart Rename", command=self.ai_rename_selected,
+                                   bg='#9B59B6', fg='white', font=('Arial', 10, 'bold'), padx=20,
+                                   state='disabled')
+        self.ai_button.pack(side='left', padx=5)
+        
+        # Sort whatever the rules in config.json match, without AI
+        tk.Button(button_frame, text="⚡ Apply Rules", command=self.apply_rules,
+                 bg='#FFB347', font=('Arial', 10, 'bold'), padx=20).pack(side='left', padx=5)
         
         # Category Buttons Frame
         category_frame = tk.LabelFrame(parent, text="Categories", bg='#f0f0f0', font=('Arial', 10, 'bold'))
@@ -161,7 +222,7 @@ class ScreenshotRenamer:
         # Create category buttons
         self.category_buttons = {}
         for i, (cat_name, cat_info) in enumerate(self.categories.items()):
-            btn_text = f"{cat_info['emoji']} {cat_name.title()} (Next: {cat_name}_{cat_info['count']:03d})"
+            btn_text = f"{cat_info['emoji']} {cat_name.title()} (Next: {self.engine.next_filename(cat_name)})"
             btn = tk.Button(category_frame, text=btn_text, 
                           bg=cat_info['color'],
                           fg='black' if cat_name != 'ai_smart' else 'white',
@@ -174,27 +235,19 @@ class ScreenshotRenamer:
         preview_label = tk.Label(parent, text="Preview Screenshots:", bg='#f0f0f0', font=('Arial', 10, 'bold'))
         preview_label.pack(anchor='w', padx=10)
         
-        # Create canvas with scrollbar for thumbnails
-        canvas_frame = tk.Frame(parent)
-        canvas_frame.pack(fill='both', expand=True, padx=10, pady=5)
-        
-        self.canvas = tk.Canvas(canvas_frame, bg='white')
-        scrollbar = tk.Scrollbar(canvas_frame, orient='vertical', command=self.canvas.yview)
-        self.scrollable_frame = tk.Frame(self.canvas, bg='white')
-        
-        self.scrollable_frame.bind(
-            "<Configure>",
-            lambda e: self.canvas.configure(scrollregion=self.canvas.bbox("all"))
-        )
+        # Virtualized thumbnail grid: only visible rows exist as canvas items.
+        # Thumbnails are decoded in a process pool and streamed back, collected each frame.
+        self.thumb_loader = ThumbnailLoader(THUMB_SIZE, self.on_thumbnail_ready,
+                                            cache=ThumbnailCache(os.path.join(CACHE_DIR, 'thumbnails.db')))
+        self.thumb_grid = ThumbnailGrid(parent, self.thumb_loader.request,
+                                        on_change=self.toggle_selection)
+        self.thumb_grid.pack(fill='both', expand=True, padx=10, pady=5)
+        self.dispatcher.every_frame(self.thumb_loader.pump, lambda: self.thumb_loader.busy)
         
-        self.canvas.create_window((0, 0), window=self.scrollable_frame, anchor="nw")
-        self.canvas.configure(yscrollcommand=scrollbar.set)
-        
-        self.canvas.pack(side='left', fill='both', expand=True)
-        scrollbar.pack(side='right', fill='y')
-        
-        # Bind mousewheel for scrolling
-        self.canvas.bind_all("<MouseWheel>", self._on_mousewheel)
+        # Bind mousewheel for scrolling (Button-4/5 on X11)
+        self.thumb_grid.canvas.bind_all("<MouseWheel>", self._on_mousewheel)
+        self.thumb_grid.canvas.bind_all("<Button-4>", lambda e: self.thumb_grid.scroll_units(-1))
+        self.thumb_grid.canvas.bind_all("<Button-5>", lambda e: self.thumb_grid.scroll_units(1))
         
         # Bottom Frame with Stats
         bottom_frame = tk.Frame(parent, bg='#f0f0f0')
@@ -202,9 +255,35 @@ class ScreenshotRenamer:
         
         self.stats_label = tk.Label(bottom_frame, text="Ready", bg='#f0f0f0')
         self.stats_label.pack(side='left')
+        self.index_label = tk.Label(bottom_frame, text="", bg='#f0f0f0', fg='#777777')
+        self.index_label.pack(side='left', padx=10)
+        
+        # Pause or stop loading a folder: the scan, reading dimensions and thumbnails
+        self.load_pause_button = tk.Button(bottom_frame, text="⏸", command=self.toggle_loading_pause,
+                                           width=2, state='disabled')
+        self.load_pause_button.pack(side='left')
+        self.load_stop_button = tk.Button(bottom_frame, text="⏹", command=self.stop_loading,
+                                          width=2, state='disabled')
+        self.load_stop_button.pack(side='left', padx=(2, 0))
         
         # Select All Button
         tk.Button(bottom_frame, text="Select All", command=self.select_all, bg='#A8E6CF').pack(side='right', padx=5)
+        
+        # Near-duplicate finder
+        self.dupes_button = tk.Button(bottom_frame, text="🔍 Select Duplicates", command=self.select_duplicates,
+                                      bg='#FFD93D')
+        self.dupes_button.pack(side='right', padx=5)
+        if not NUMPY_AVAILABLE:
+            self.dupes_button.config(state='disabled')
+        
+        # Query the metadata catalog, e.g. "format:png dims:1080x2400 age<7d size>1M"
+        self.query_text = tk.StringVar()
+        tk.Button(bottom_frame, text="Select Matches", command=self.select_matches,
+                 bg='#A8E6CF').pack(side='right', padx=5)
+        query_entry = tk.Entry(bottom_frame, textvariable=self.query_text, width=30)
+        query_entry.pack(side='right', padx=5)
+        query_entry.bind('<Return>', lambda e: self.select_matches())
+        tk.Label(bottom_frame, text="Find:", bg='#f0f0f0').pack(side='right')
     
     def setup_ai_tab(self, parent):
         # API Key Setup
@@ -249,45 +328,94 @@ class ScreenshotRenamer:
         self.ai_prompt.pack(pady=5, fill='both', expand=True)
         
         # Load default prompt
-        default_prompt = """You are a filename generator. Look at this image and create a short, descriptive filename (3-5 words).
-
-Rules:
-- Use ONLY lowercase letters, numbers, and hyphens
-- NO spaces, NO special characters
-- Describe the MAIN subject of the image
-- Be specific but concise
-- DO NOT use words like "image", "photo", "picture", "screenshot"
-- DO NOT add any explanations, just return the filename
-
-Examples:
-- For a cat photo: "sleeping-orange-cat"
-- For a food photo: "homemade-pizza-slice"
-- For a landscape: "sunset-mountain-lake"
-- For a document: "quarterly-report-2024"
-- For a meme: "distracted-boyfriend-meme"
-
-Generate only the filename, nothing else:"""
-        
-        self.ai_prompt.insert('1.0', default_prompt)
+        self.ai_prompt.insert('1.0', DEFAULT_PROMPT)
         
         # Test button
-        test_btn = tk.Button(prompt_frame, text="Test AI Connection", command=self.test_ai_connection,
-                     bg='#9B59B6', fg='white')
-        test_btn.pack(pady=5)
+        self.test_ai_button = tk.Button(prompt_frame, text="Test AI Connection", command=self.test_ai_connection,
+                                        bg='#9B59B6', fg='white')
+        self.test_ai_button.pack(pady=5)
         
         if not self.ai_available:
-            test_btn.config(state='disabled')
+            self.test_ai_button.config(state='disabled')
+        
+        # Local Pre-Classifier
+        local_frame = tk.LabelFrame(parent, text="Local Pre-Classifier", padx=10, pady=10)
+        local_frame.pack(fill='x', padx=10, pady=10)
+        
+        self.classifier_enabled = tk.BooleanVar(value=self.engine.classifier_config['enabled'])
+        self.classifier_threshold = tk.DoubleVar(value=self.engine.classifier_config['threshold'])
+        tk.Checkbutton(local_frame, text="Sort obvious screenshots into categories without asking Gemini",
+                      variable=self.classifier_enabled, command=self.save_classifier_settings).pack(anchor='w')
+        tk.Scale(local_frame, label="Confidence needed", variable=self.classifier_threshold,
+                from_=0.5, to=0.99, resolution=0.01, orient='horizontal', length=250,
+                command=lambda _: self.save_classifier_settings()).pack(anchor='w')
+        
+        self.train_button = tk.Button(local_frame, text="🧠 Train from History", command=self.train_classifier,
+                                      bg='#4ECDC4')
+        self.train_button.pack(anchor='w', pady=5)
+        self.classifier_status = tk.Label(local_frame, fg='gray', justify='left',
+                                          text="Trained" if self.engine.local_classifier else "Not trained yet")
+        self.classifier_status.pack(anchor='w')
+        if not NUMPY_AVAILABLE:
+            self.train_button.config(state='disabled')
+            self.classifier_status.config(text="Needs numpy: pip install numpy")
+    
+    def save_classifier_settings(self):
+        for settings in (self.engine.classifier_config, self.engine.classifier_settings):
+            settings['enabled'] = self.classifier_enabled.get()
+            settings['threshold'] = self.classifier_threshold.get()
+        self.save_config()
+    
+    def train_classifier(self):
+        """Train on past manual sorts in the background"""
+        self.train_button.config(state='disabled')
+        self.classifier_status.config(text="Training...")
+        
+        def train():
+            try:
+                text = format_training_report(self.engine.train_classifier())
+            except ValueError as e:
+                text = f"❌ Not enough history to train: {e}"
+            self.dispatcher.post(done, text)
+        
+        def done(text):
+            self.train_button.config(state='normal')
+            self.classifier_status.config(text=text)
+        
+        threading.Thread(target=train, daemon=True).start()
     
     def test_ai_connection(self):
-        """Test if AI is working"""
-        try:
-            if self.gemini_model:
-                response = self.gemini_model.generate_content("Say 'AI is working!' if you can read this. Reply with just that phrase.")
-                messagebox.showinfo("AI Test", f"✅ AI Response: {response.text}")
-            else:
-                messagebox.showerror("AI Test", "❌ AI not initialized")
-        except Exception as e:
-            messagebox.showerror("AI Test", f"❌ Error: {str(e)}")
+        """Send the backend a tiny request in the background and show its reply"""
+        backend = self.engine.backend
+        if backend is None:
+            messagebox.showerror("AI Test", "❌ AI not initialized")
+            return
+        if backend.name == 'replay':
+            # Only recorded requests have replies; there is nothing to reach
+            messagebox.showinfo("AI Test", f"✅ {backend.description}")
+            return
+        self.test_ai_button.config(state='disabled')
+        
+        def test():
+            contents = ["Say 'AI is working!' if you can read this. Reply with just that phrase."]
+            images = 0
+            if not backend.capabilities.batching:
+                # One image per call (the local backend): give it a blank one
+                from PIL import Image
+                contents.append(Image.new('RGB', (64, 64), 'white'))
+                images = 1
+            try:
+                text = backend.generate(contents, images)
+            except Exception as e:
+                self.dispatcher.post(done, messagebox.showerror, f"❌ Error: {str(e)}")
+                return
+            self.dispatcher.post(done, messagebox.showinfo, f"✅ AI Response: {text}")
+        
+        def done(show, message):
+            self.test_ai_button.config(state='normal')
+            show("AI Test", message)
+        
+        threading.Thread(target=test, daemon=True).start()
     
     def setup_settings_tab(self, parent):
         # Category Management
@@ -318,22 +446,203 @@ Generate only the filename, nothing else:"""
         naming_frame = tk.LabelFrame(parent, text="Naming Convention", padx=10, pady=10)
         naming_frame.pack(fill='x', padx=10, pady=5)
         
-        tk.Label(naming_frame, text="Standard: [Category]_[Number].png").pack(anchor='w')
-        tk.Label(naming_frame, text="AI Mode: [AI-Description]_[Number].png").pack(anchor='w')
+        tk.Label(naming_frame, text="Standard: [Category]_[Number].[ext]").pack(anchor='w')
+        tk.Label(naming_frame, text="AI Mode: [AI-Description]_[Number].[ext]").pack(anchor='w')
         tk.Label(naming_frame, text="Example: golden-retriever-play_001.png").pack(anchor='w')
+        
+        # Output Format
+        output_frame = tk.LabelFrame(parent, text="Output Format", padx=10, pady=10)
+        output_frame.pack(fill='x', padx=10, pady=5)
+        
+        self.output_format = tk.StringVar(value=self.engine.output_config['format'])
+        self.output_lossless = tk.BooleanVar(value=self.engine.output_config['lossless'])
+        self.output_quality = tk.IntVar(value=self.engine.output_config['quality'])
+        self.output_metadata = tk.StringVar(value=self.engine.output_config['metadata'])
+        format_labels = {
+            'keep': "Keep the original file (named with its real extension)",
+            'png': "Optimized PNG (identical pixels)",
+            'webp': "WebP (smallest; lossless unless unticked below)",
+            'jpeg': "JPEG at the quality below"
+        }
+        for fmt in OUTPUT_FORMATS:
+            tk.Radiobutton(output_frame, text=format_labels[fmt], variable=self.output_format,
+                          value=fmt, command=self.save_output_settings).pack(anchor='w')
+        options_row = tk.Frame(output_frame)
+        options_row.pack(anchor='w', pady=(5, 0))
+        tk.Checkbutton(options_row, text="Lossless WebP", variable=self.output_lossless,
+                      command=self.save_output_settings).pack(side='left')
+        tk.Label(options_row, text="Quality:").pack(side='left', padx=(10, 0))
+        quality_box = tk.Spinbox(options_row, from_=1, to=100, width=4, textvariable=self.output_quality,
+                                 command=self.save_output_settings)
+        quality_box.pack(side='left')
+        quality_box.bind('<FocusOut>', lambda e: self.save_output_settings())
+        tk.Label(options_row, text="Metadata:").pack(side='left', padx=(10, 0))
+        ttk.Combobox(options_row, textvariable=self.output_metadata, values=METADATA_MODES, width=7,
+                    state='readonly').pack(side='left')
+        self.output_metadata.trace_add('write', lambda *_: self.save_output_settings())
+        tk.Label(output_frame, text="Metadata: keep all, color (ICC profile only) or strip. "
+                                    "A re-encode that isn't smaller keeps the original.",
+                font=('Arial', 8), fg='gray').pack(anchor='w')
+        
+        # Destination Layout
+        layout_frame = tk.LabelFrame(parent, text="Destination Layout", padx=10, pady=10)
+        layout_frame.pack(fill='x', padx=10, pady=5)
+        
+        self.layout_shard = tk.StringVar(value=self.engine.layout_config['shard'])
+        shard_labels = {
+            'none': "All files directly in the category folder",
+            'year': "By year: category/2024/",
+            'month': "By month: category/2024/05/",
+            'hash': "By name hash: category/3f/ (even spread for huge folders)"
+        }
+        for mode in SHARD_MODES:
+            tk.Radiobutton(layout_frame, text=shard_labels[mode], variable=self.layout_shard,
+                          value=mode, command=self.save_layout_settings).pack(anchor='w')
+        tk.Label(layout_frame, text="Dates are the screenshot's modification time. "
+                                    "Run 'reindex' after changing a destination by hand.",
+                font=('Arial', 8), fg='gray').pack(anchor='w')
+        
+        # File Transfer
+        transfer_frame = tk.LabelFrame(parent, text="File Transfer", padx=10, pady=10)
+        transfer_frame.pack(fill='x', padx=10, pady=5)
+        
+        self.transfer_mode = tk.StringVar(value=self.engine.transfer_config['mode'])
+        self.transfer_verify = tk.BooleanVar(value=self.engine.transfer_config['verify'])
+        mode_labels = {
+            'copy': "Copy (keep originals)",
+            'move': "Move (instant on the same drive)",
+            'hardlink': "Hard link (no extra space, same drive only)",
+            'reflink': "Reflink (copy-on-write clone where supported)"
+        }
+        for mode in TRANSFER_MODES:
+            tk.Radiobutton(transfer_frame, text=mode_labels[mode], variable=self.transfer_mode,
+                          value=mode, command=self.save_transfer_settings).pack(anchor='w')
+        tk.Checkbutton(transfer_frame, text="Verify copies with a checksum", variable=self.transfer_verify,
+                      command=self.save_transfer_settings).pack(anchor='w')
+        tk.Label(transfer_frame, text="Across drives every mode falls back to a copy (move deletes the original after).",
+                font=('Arial', 8), fg='gray').pack(anchor='w')
+        
+        # Near-Duplicates
+        dupes_frame = tk.LabelFrame(parent, text="Near-Duplicates", padx=10, pady=10)
+        dupes_frame.pack(fill='x', padx=10, pady=5)
+        
+        self.duplicate_mode = tk.StringVar(value=self.engine.duplicate_config['mode'])
+        mode_labels = {
+            'off': "Treat every screenshot separately",
+            'share': "AI names a cluster once, every copy is sorted",
+            'skip': "Sort only the first of each cluster"
+        }
+        for mode in DUPLICATE_MODES:
+            tk.Radiobutton(dupes_frame, text=mode_labels[mode], variable=self.duplicate_mode, value=mode,
+                          command=self.save_duplicate_settings,
+                          state='normal' if NUMPY_AVAILABLE else 'disabled').pack(anchor='w')
+    
+    def save_duplicate_settings(self):
+        for settings in (self.engine.duplicate_config, self.engine.duplicate_settings):
+            settings['mode'] = self.duplicate_mode.get()
+        self.save_config()
+    
+    def save_output_settings(self):
+        try:
+            quality = min(100, max(1, self.output_quality.get()))
+        except tk.TclError:
+            return  # half-typed number
+        for settings in (self.engine.output_config, self.engine.output_settings):
+            settings['format'] = self.output_format.get()
+            settings['lossless'] = self.output_lossless.get()
+            settings['quality'] = quality
+            settings['metadata'] = self.output_metadata.get()
+        self.save_config()
+        # The buttons show the extension re-encoded files get
+        for category in self.category_buttons:
+            self.update_category_button(category)
+    
+    def save_layout_settings(self):
+        for settings in (self.engine.layout_config, self.engine.layout_settings):
+            settings['shard'] = self.layout_shard.get()
+        self.save_config()
+    
+    def save_transfer_settings(self):
+        for settings in (self.engine.transfer_config, self.engine.transfer_settings):
+            settings['mode'] = self.transfer_mode.get()
+            settings['verify'] = self.transfer_verify.get()
+        self.save_config()
     
     def setup_history_tab(self, parent):
+        # Search and undo toolbar
+        toolbar = tk.Frame(parent)
+        toolbar.pack(fill='x', padx=10, pady=(10, 0))
+        
+        self.history_search = tk.StringVar()
+        search_entry = tk.Entry(toolbar, textvariable=self.history_search, width=30)
+        search_entry.pack(side='left', padx=5)
+        search_entry.bind('<Return>', lambda e: self.load_history())
+        tk.Button(toolbar, text="🔍 Search", command=self.load_history).pack(side='left', padx=5)
+        tk.Button(toolbar, text="↩ Undo Last Batch", command=self.undo_batch,
+                 bg='#FFD93D').pack(side='right', padx=5)
+        tk.Button(toolbar, text="↪ Redo", command=self.redo_batch,
+                 bg='#A8E6CF').pack(side='right', padx=5)
+        
         # History display
         self.history_text = scrolledtext.ScrolledText(parent, height=20, width=80)
         self.history_text.pack(padx=10, pady=10, fill='both', expand=True)
         
-        # Clear history button
-        tk.Button(parent, text="Clear History", command=self.clear_history, 
-                 bg='#FF6B6B').pack(pady=5)
+        btn_frame = tk.Frame(parent)
+        btn_frame.pack(pady=5)
+        tk.Button(btn_frame, text="Load Older", command=self.load_older_history,
+                 bg='#4ECDC4').pack(side='left', padx=5)
+        tk.Button(btn_frame, text="Clear History", command=self.clear_history, 
+                 bg='#FF6B6B').pack(side='left', padx=5)
         
-        # Load history
+        # Load the most recent page of the journal
+        self.history_oldest = None
         self.load_history()
     
+    def setup_stats_tab(self, parent):
+        toolbar = tk.Frame(parent)
+        toolbar.pack(fill='x', padx=10, pady=(10, 0))
+        
+        self.metrics_enabled = tk.BooleanVar(value=metrics.enabled)
+        tk.Checkbutton(toolbar, text="Collect timings", variable=self.metrics_enabled,
+                      command=self.toggle_metrics).pack(side='left', padx=5)
+        tk.Button(toolbar, text="Export Trace...", command=self.export_trace,
+                 bg='#4ECDC4').pack(side='right', padx=5)
+        tk.Button(toolbar, text="Reset", command=self.reset_metrics,
+                 bg='#FF6B6B').pack(side='right', padx=5)
+        
+        # Live per-stage timings, refreshed every second
+        self.stats_text = scrolledtext.ScrolledText(parent, height=20, width=80, font=('Courier', 9))
+        self.stats_text.pack(padx=10, pady=10, fill='both', expand=True)
+        tk.Label(parent, text="Exported traces open in chrome://tracing or ui.perfetto.dev",
+                font=('Arial', 8), fg='gray').pack(pady=(0, 5))
+        self.refresh_stats()
+    
+    def toggle_metrics(self):
+        if self.metrics_enabled.get():
+            metrics.enable(trace=True)
+        else:
+            metrics.disable()
+        self.refresh_stats(repeat=False)
+    
+    def reset_metrics(self):
+        metrics.reset()
+        self.refresh_stats(repeat=False)
+    
+    def refresh_stats(self, repeat=True):
+        top = self.stats_text.yview()[0]
+        self.stats_text.delete('1.0', tk.END)
+        self.stats_text.insert('1.0', metrics.summary())
+        self.stats_text.yview_moveto(top)
+        if repeat:
+            self.root.after(1000, self.refresh_stats)
+    
+    def export_trace(self):
+        path = filedialog.asksaveasfilename(title="Export Trace", defaultextension='.json',
+                                            filetypes=[("Chrome trace", "*.json")])
+        if path:
+            count = metrics.export_trace(path)
+            messagebox.showinfo("Trace Exported", f"{count} events written to {path}")
+    
     def load_categories_to_editor(self):
         self.cat_text.delete('1.0', tk.END)
         for name, info in self.categories.items():
@@ -366,19 +675,12 @@ Generate only the filename, nothing else:"""
             messagebox.showerror("Error", f"Failed to save categories: {str(e)}")
     
     def reset_categories(self):
-        self.categories = {
-            'tickets': {'emoji': '🎫', 'color': '#FF6B6B', 'count': 1},
-            'chats': {'emoji': '💬', 'color': '#4ECDC4', 'count': 1},
-            'funny': {'emoji': '😂', 'color': '#FFE66D', 'count': 1},
-            'movie': {'emoji': '🎬', 'color': '#95E1D3', 'count': 1},
-            'others': {'emoji': '📁', 'color': '#A8E6CF', 'count': 1},
-            'ai_smart': {'emoji': '🤖', 'color': '#9B59B6', 'count': 1}
-        }
+        self.categories = default_categories()
         self.load_categories_to_editor()
         self.save_config()
     
     def _on_mousewheel(self, event):
-        self.canvas.yview_scroll(int(-1*(event.delta/120)), "units")
+        self.thumb_grid.scroll_units(int(-1*(event.delta/120)) or (-1 if event.delta > 0 else 1))
     
     def browse_source(self):
         folder = filedialog.askdirectory(title="Select Source Folder")
@@ -395,95 +697,177 @@ Generate only the filename, nothing else:"""
             messagebox.showwarning("Warning", "Please select a source folder first!")
             return
         
-        # Clear existing thumbnails
-        for widget in self.scrollable_frame.winfo_children():
-            widget.destroy()
-        self.selected_files = []
-        self.preview_images = []
-        
-        # Load image files
-        valid_extensions = ('.png', '.jpg', '.jpeg', '.gif', '.bmp')
-        files = []
-        for file in os.listdir(self.source_folder.get()):
-            if file.lower().endswith(valid_extensions):
-                files.append(file)
-        
-        if not files:
-            messagebox.showinfo("Info", "No images found in the selected folder!")
+        # Scan on a thread; the grid fills up while big trees are still being walked
+        source = self.source_folder.get()
+        # Sorted files in a destination inside the source are not shown again
+        dest = self.dest_folder.get() or None
+        if self.scan_control is not None:
+            self.scan_control.set()
+        self.scan_generation += 1
+        generation = self.scan_generation
+        control = self.scan_control = TaskControl()
+        scan_id = time.time_ns()
+        self.loaded_scan = (source, scan_id)
+        self.thumb_loader.reset()
+        self.thumb_loader.paused = False
+        self.thumb_grid.set_items(())
+        self.stats_label.config(text="Scanning...")
+        self.index_label.config(text="")
+        self.load_pause_button.config(state='normal', text="⏸")
+        self.load_stop_button.config(state='normal')
+        
+        def scan():
+            batch = []
+            flushed = time.monotonic()
+            complete = False
+            try:
+                for file in self.engine.scan_indexed(source, scan_id, dest):
+                    if control.is_set():
+                        return
+                    batch.append((file, os.path.join(source, file)))
+                    if len(batch) >= 500 or time.monotonic() - flushed > 0.1:
+                        self.dispatcher.post(self.add_scanned, generation, batch)
+                        batch = []
+                        flushed = time.monotonic()
+                complete = True
+            finally:
+                self.dispatcher.post(self.add_scanned, generation, batch)
+                self.dispatcher.post(self.scan_finished, generation, complete)
+            if complete:
+                self.index_details(source, generation, control)
+        
+        threading.Thread(target=scan, daemon=True).start()
+    
+    def add_scanned(self, generation, batch):
+        """Move a batch of scanned files into the grid"""
+        if generation != self.scan_generation:
             return
-        
-        # Sort files
-        files.sort()
-        
-        # Create thumbnails
-        for i, file in enumerate(files[:20]):  # Limit to 20 files for performance
-            file_path = os.path.join(self.source_folder.get(), file)
-            self.create_thumbnail(file_path, file, i)
-        
-        self.stats_label.config(text=f"Loaded {len(files)} images (showing first 20)")
+        self.thumb_grid.extend_items(batch)
+        if not self.scan_control.cancelled:
+            self.stats_label.config(text=f"Scanning... {len(self.thumb_grid.items)} images so far")
+    
+    def scan_finished(self, generation, complete):
+        if generation != self.scan_generation:
+            return
+        count = len(self.thumb_grid.items)
+        if not complete:
+            self.stats_label.config(text=f"Stopped, {count} images loaded")
+        elif count:
+            self.stats_label.config(text=f"Loaded {count} images")
+        else:
+            self.stats_label.config(text="Ready")
+            messagebox.showinfo("Info", "No images found in the selected folder!")
     
-    def create_thumbnail(self, file_path, filename, index):
+    def index_details(self, source, generation, control):
+        """Scan thread: read image dimensions into the catalog for Find"""
+        def progress(done, total):
+            self.dispatcher.progress('index', self.show_index_progress, generation, f"Indexing {done}/{total}")
+        
         try:
-            # Open and resize image
-            img = Image.open(file_path)
-            img.thumbnail((150, 150))
-            photo = ImageTk.PhotoImage(img)
-            
-            # Create frame for each image
-            frame = tk.Frame(self.scrollable_frame, bg='white', relief='solid', borderwidth=1)
-            frame.pack(side='left', padx=5, pady=5, anchor='n')
-            
-            # Checkbox
-            var = tk.BooleanVar()
-            chk = tk.Checkbutton(frame, variable=var, bg='white', 
-                                command=lambda f=filename, v=var: self.toggle_selection(f, v))
-            chk.pack()
-            
-            # Image
-            label = tk.Label(frame, image=photo, bg='white')
-            label.image = photo  # Keep a reference
-            label.pack()
-            
-            # Filename
-            tk.Label(frame, text=filename[:15] + "..." if len(filename) > 15 else filename, 
-                    bg='white', wraplength=140).pack()
-            
-            # Store reference
-            self.preview_images.append({
-                'frame': frame,
-                'var': var,
-                'filename': filename,
-                'path': file_path
-            })
-            
+            self.engine.index_details(source, should_stop=control.is_set, progress=progress)
         except Exception as e:
-            print(f"Error loading {filename}: {e}")
+            print(f"⚠️ Could not index {source}: {e}")
+        self.dispatcher.progress('index', self.show_index_progress, generation, "")
+        self.dispatcher.post(self.loading_finished, generation)
     
-    def toggle_selection(self, filename, var):
-        if var.get():
-            if filename not in self.selected_files:
-                self.selected_files.append(filename)
-        else:
-            if filename in self.selected_files:
-                self.selected_files.remove(filename)
-        
-        self.stats_label.config(text=f"Selected: {len(self.selected_files)} files")
+    def show_index_progress(self, generation, text):
+        if generation == self.scan_generation:
+            self.index_label.config(text=text)
+    
+    def loading_finished(self, generation):
+        # Thumbnails are requested as the grid scrolls, so only the scan and indexing end
+        if generation == self.scan_generation and not self.thumb_loader.paused:
+            self.load_pause_button.config(state='disabled', text="⏸")
+            self.load_stop_button.config(state='disabled')
+    
+    def toggle_loading_pause(self):
+        """Hold (or continue) the scan, dimension indexing and thumbnail decoding"""
+        paused = not self.thumb_loader.paused
+        self.thumb_loader.paused = paused
+        if self.scan_control is not None:
+            if paused:
+                self.scan_control.pause()
+            else:
+                self.scan_control.resume()
+        self.load_pause_button.config(text="▶" if paused else "⏸")
+        if paused:
+            self.stats_label.config(text=f"Paused, {len(self.thumb_grid.items)} images loaded")
+        elif self.scan_control is not None and self.scan_control.cancelled:
+            self.loading_finished(self.scan_generation)
+    
+    def stop_loading(self):
+        """Stop the scan and indexing; thumbnails not decoded yet are dropped until scrolled to"""
+        if self.scan_control is not None:
+            self.scan_control.set()
+        self.thumb_loader.reset()
+        self.thumb_loader.paused = False
+        self.index_label.config(text="")
+        self.stats_label.config(text=f"Stopped, {len(self.thumb_grid.items)} images loaded")
+        self.load_pause_button.config(state='disabled', text="⏸")
+        self.load_stop_button.config(state='disabled')
+    
+    def select_matches(self):
+        """Select the loaded images that match the Find query"""
+        if not self.thumb_grid.items or self.loaded_scan is None:
+            messagebox.showwarning("Warning", "Please load screenshots first!")
+            return
+        source, scan_id = self.loaded_scan
+        try:
+            positions = self.engine.catalog.query(source, self.query_text.get(), scan_id=scan_id)
+        except QueryError as e:
+            messagebox.showerror("Find", f"Can't read that query: {e}")
+            return
+        count = len(self.thumb_grid.items)
+        self.thumb_grid.select(position for position in positions if position < count)
+        text = f"{len(self.thumb_grid.selection)} of {count} images match"
+        if self.index_label.cget('text'):
+            text += " (dimensions still being read)"
+        self.stats_label.config(text=text)
+    
+    def save_scan_settings(self):
+        for settings in (self.engine.scan_config, self.engine.scan_settings):
+            settings['recursive'] = self.scan_recursive.get()
+        self.save_config()
+    
+    def on_thumbnail_ready(self, index, path, img):
+        items = self.thumb_grid.items
+        if index < len(items) and items[index][1] == path:
+            self.thumb_grid.set_thumbnail(index, img)
+    
+    @property
+    def selected_files(self):
+        return [filename for filename, path in self.thumb_grid.selected_items()]
+    
+    def toggle_selection(self):
+        self.stats_label.config(text=f"Selected: {len(self.thumb_grid.selection)} files")
     
     def select_all(self):
-        if not self.preview_images:
+        self.thumb_grid.toggle_all()
+    
+    def select_duplicates(self):
+        """Hash the loaded images in the background, then select the extra copies"""
+        items = list(self.thumb_grid.items)
+        if len(items) < 2:
+            messagebox.showwarning("Warning", "Please load screenshots first!")
             return
-            
-        # Check if all are selected
-        all_selected = all(item['var'].get() for item in self.preview_images)
-        select = not all_selected  # Toggle
         
-        self.selected_files = []
-        for item in self.preview_images:
-            item['var'].set(select)
-            if select:
-                self.selected_files.append(item['filename'])
+        self.dupes_button.config(state='disabled')
+        self.stats_label.config(text=f"Looking for near-duplicates among {len(items)} images...")
+        
+        def find():
+            clusters = self.engine.find_duplicates([path for _, path in items])
+            self.dispatcher.post(show, clusters)
         
-        self.stats_label.config(text=f"Selected: {len(self.selected_files)} files")
+        def show(clusters):
+            self.dupes_button.config(state='normal')
+            if self.thumb_grid.items != items:
+                return  # a different folder was loaded meanwhile
+            extra = [index for cluster in clusters for index in cluster[1:]]
+            self.thumb_grid.select(extra)
+            self.stats_label.config(text=f"{len(clusters)} groups of near-duplicates, "
+                                         f"{len(extra)} extra copies selected")
+        
+        threading.Thread(target=find, daemon=True).start()
     
     def rename_selected(self, category):
         if not self.selected_files:
@@ -494,46 +878,69 @@ Generate only the filename, nothing else:"""
             messagebox.showwarning("Warning", "Please select a destination folder!")
             return
         
-        # Create category subfolder if it doesn't exist
-        cat_folder = os.path.join(self.dest_folder.get(), category)
-        os.makedirs(cat_folder, exist_ok=True)
-        
-        # Get starting number
-        start_num = self.categories[category]['count']
-        
-        # Rename and move files
-        renamed_files = []
-        for i, filename in enumerate(self.selected_files):
-            # Generate new filename
-            new_filename = f"{category}_{start_num + i:03d}.png"
-            new_path = os.path.join(cat_folder, new_filename)
-            
-            # Copy and rename file
-            src_path = os.path.join(self.source_folder.get(), filename)
-            try:
-                shutil.copy2(src_path, new_path)
-                renamed_files.append(f"{filename} → {category}/{new_filename}")
-            except Exception as e:
-                renamed_files.append(f"Error with {filename}: {str(e)}")
-        
-        # Update category count
-        self.categories[category]['count'] = start_num + len(self.selected_files)
+        # Transfer and rename through the engine (it also records history and counts),
+        # queued as a job so more can be picked meanwhile
+        self.sync_folders()
+        files = list(self.selected_files)
+        job_id = self.job_runner.submit(self.source_folder.get(), self.dest_folder.get(), files, category)
+        self.thumb_grid.clear_selection()
+        self.stats_label.config(text=f"Queued {len(files)} files for {category} (job #{job_id})")
+        if len(files) >= PROGRESS_WINDOW_MIN:
+            self.open_job_window(job_id, category, len(files))
+    
+    def apply_rules(self):
+        """Sort the selected images (or all loaded ones) that a routing rule matches"""
+        items = self.thumb_grid.selected_items() or list(self.thumb_grid.items)
+        if not items:
+            messagebox.showwarning("Warning", "Please load screenshots first!")
+            return
+        if not self.dest_folder.get():
+            messagebox.showwarning("Warning", "Please select a destination folder!")
+            return
+        try:
+            router = self.engine.make_router()
+        except RuleError as e:
+            messagebox.showerror("Rules", f"Can't use the rules in config.json: {e}")
+            return
+        if not router:
+            messagebox.showinfo("Rules", "No rules yet. Add a \"rules\" list to config.json.")
+            return
         
-        # Save to history
-        self.save_to_history(category, renamed_files)
+        self.sync_folders()
+        source, dest = self.source_folder.get(), self.dest_folder.get()
+        self.thumb_grid.clear_selection()
+        self.stats_label.config(text=f"Matching rules against {len(items)} images...")
         
-        # Update button text
-        btn_text = f"{self.categories[category]['emoji']} {category.title()} (Next: {category}_{self.categories[category]['count']:03d})"
+        def route():
+            # Rules may read EXIF, so match off the Tk thread too; each category becomes a job
+            entries = []
+            for filename, path in items:
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                fmt = EXTENSION_FORMATS.get(os.path.splitext(filename)[1].lower())
+                entries.append(ScanEntry(filename, path, st.st_size, st.st_mtime_ns, fmt))
+            routed, unmatched = router.route(source, entries)
+            jobs = [(self.job_runner.submit(source, dest, [name for name, _ in files], category, rules=dict(files)),
+                     category, len(files))
+                    for category, files in routed.items()]
+            self.dispatcher.post(routed_done, jobs, len(unmatched))
+        
+        def routed_done(jobs, unmatched):
+            for job_id, category, count in jobs:
+                if count >= PROGRESS_WINDOW_MIN:
+                    self.open_job_window(job_id, category, count)
+            queued = sum(count for _, _, count in jobs)
+            self.stats_label.config(text=f"Queued {queued} files in {len(jobs)} jobs by the rules")
+            messagebox.showinfo("Rules Applied", f"Queued {queued} files, {unmatched} matched no rule.\n\n"
+                                                 f"{router.summary()}")
+        
+        threading.Thread(target=route, daemon=True).start()
+    
+    def update_category_button(self, category):
+        btn_text = f"{self.categories[category]['emoji']} {category.title()} (Next: {self.engine.next_filename(category)})"
         self.category_buttons[category].config(text=btn_text)
-        
-        # Save counts
-        self.save_counts()
-        
-        # Clear selection
-        self.select_all()
-        self.selected_files = []
-        
-        messagebox.showinfo("Success", f"Renamed {len(renamed_files)} files to {category} folder!")
     
     def ai_rename_selected(self):
         """Rename selected files using AI-generated descriptions"""
@@ -550,258 +957,645 @@ Generate only the filename, nothing else:"""
             messagebox.showwarning("Warning", "Please select a destination folder!")
             return
         
-        # Create AI folder
-        ai_folder = os.path.join(self.dest_folder.get(), "ai_renamed")
-        os.makedirs(ai_folder, exist_ok=True)
-        
         # Get prompt from AI settings tab
-        prompt_text = self.ai_prompt.get('1.0', tk.END).strip()
-        if not prompt_text:
-            prompt_text = "Generate a descriptive filename (3-5 words, use hyphens) for this image."
-        
-        # Progress window
+        # The AI tab may never have been opened, then its default prompt applies
+        prompt_text = (self.ai_prompt.get('1.0', tk.END).strip() if self.ai_prompt else DEFAULT_PROMPT) or SHORT_PROMPT
+        
+        self.sync_folders()
+        files = list(self.selected_files)
+        job_id = self.job_runner.submit(self.source_folder.get(), self.dest_folder.get(), files,
+                                        prompt=prompt_text)
+        self.thumb_grid.clear_selection()
+        self.open_job_window(job_id, "AI rename", len(files))
+    
+    def open_job_window(self, job_id, label, total):
+        """Progress window of one queued job; on_job_event keeps it current"""
         progress_win = tk.Toplevel(self.root)
-        progress_win.title("AI Processing")
+        progress_win.title(f"Job #{job_id}: {label}")
         progress_win.geometry("500x250")
         progress_win.transient(self.root)
-        progress_win.grab_set()
         
-        tk.Label(progress_win, text="🤖 AI is analyzing your images...", 
-                font=('Arial', 12, 'bold')).pack(pady=10)
-        tk.Label(progress_win, text="This may take a few seconds per image", 
-                font=('Arial', 9)).pack()
+        tk.Label(progress_win, text="🤖 AI is analyzing your images..." if label == "AI rename"
+                 else f"📁 Sorting into {label}...", font=('Arial', 12, 'bold')).pack(pady=10)
+        tk.Label(progress_win, text="Closing the app is safe: unfinished jobs can be resumed",
+                 font=('Arial', 9)).pack()
         
         progress_bar = ttk.Progressbar(progress_win, length=400, mode='determinate')
         progress_bar.pack(pady=10)
         
-        current_file_label = tk.Label(progress_win, text="", font=('Arial', 9), 
-                                    wraplength=450, fg='blue')
+        current_file_label = tk.Label(progress_win, text="", font=('Arial', 9),
+                                      wraplength=450, fg='blue')
         current_file_label.pack(pady=5)
         
-        status_label = tk.Label(progress_win, text="Starting...", font=('Arial', 9))
+        ahead = self.engine.jobs.queued() - 1
+        status_label = tk.Label(progress_win, font=('Arial', 9),
+                                text=f"Waiting for {ahead} jobs ahead..." if ahead > 0 else "Starting...")
         status_label.pack(pady=5)
         
-        # Process in background thread
-        def process_with_ai():
-            renamed_files = []
-            total = len(self.selected_files)
-            failed_count = 0
-            
-            for i, filename in enumerate(self.selected_files):
-                try:
-                    # Update progress
-                    progress_value = (i / total) * 100
-                    progress_win.after(0, progress_bar.config, {'value': progress_value})
-                    progress_win.after(0, current_file_label.config, 
-                                     {'text': f"📷 Analyzing: {filename}"})
-                    progress_win.after(0, status_label.config, 
-                                     {'text': f"Processing {i+1} of {total}..."})
-                    progress_win.after(0, progress_win.update)
-                    
-                    # Get full path
-                    src_path = os.path.join(self.source_folder.get(), filename)
-                    
-                    # Generate AI description
-                    ai_name = self.generate_ai_filename(src_path, prompt_text)
-                    
-                    # Create new filename with counter
-                    new_filename = f"{ai_name}_{self.categories['ai_smart']['count']:03d}.png"
-                    new_path = os.path.join(ai_folder, new_filename)
-                    
-                    # Copy and rename file
-                    shutil.copy2(src_path, new_path)
-                    renamed_files.append(f"{filename} → {new_filename}")
-                    
-                    # Increment counter
-                    self.categories['ai_smart']['count'] += 1
-                    
-                    # Small delay to show progress
-                    time.sleep(0.2)
-                    
-                except Exception as e:
-                    failed_count += 1
-                    renamed_files.append(f"❌ {filename}: Error - {str(e)[:50]}")
-            
-            # Update UI in main thread
-            progress_win.after(0, progress_bar.config, {'value': 100})
-            progress_win.after(0, current_file_label.config, {'text': ""})
-            progress_win.after(0, status_label.config, 
-                             {'text': f"✅ Complete! {total-failed_count} successful, {failed_count} failed"})
-            
-            # Save to history
-            self.save_to_history("ai_smart", renamed_files)
-            
-            # Update AI button text
-            btn_text = f"🤖 AI Smart (Next: ai_{self.categories['ai_smart']['count']:03d})"
-            self.category_buttons['ai_smart'].config(text=btn_text)
-            
-            # Save counts
-            self.save_counts()
-            
-            # Close progress window after 2 seconds
-            progress_win.after(2000, progress_win.destroy)
-            
-            # Show summary
-            messagebox.showinfo("AI Rename Complete", 
-                              f"✅ Successfully renamed: {total-failed_count} files\n"
-                              f"❌ Failed: {failed_count} files\n"
-                              f"📁 Location: {ai_folder}")
+        # Cancel stops new Gemini requests; files already named are still copied.
+        # Pause holds the job before its next file or request
+        buttons = tk.Frame(progress_win)
+        buttons.pack(pady=5)
+        
+        def cancel():
+            self.job_runner.cancel(job_id)
+            cancel_btn.config(state='disabled', text="Cancelling...")
+            pause_btn.config(state='disabled')
+        
+        def toggle_pause():
+            paused = pause_btn.cget('text') == "Pause"
+            if self.job_runner.pause(job_id, paused):
+                pause_btn.config(text="Continue" if paused else "Pause")
+                if paused:
+                    status_label.config(text="⏸ Paused after the files in flight")
+        
+        pause_btn = tk.Button(buttons, text="Pause", command=toggle_pause, bg='#FFD93D')
+        pause_btn.pack(side='left', padx=5)
+        cancel_btn = tk.Button(buttons, text="Cancel", command=cancel, bg='#FF6B6B')
+        cancel_btn.pack(side='left', padx=5)
+        progress_win.protocol("WM_DELETE_WINDOW", progress_win.withdraw)
+        self.job_windows[job_id] = {'window': progress_win, 'bar': progress_bar, 'file': current_file_label,
+                                    'status': status_label, 'cancel': cancel_btn, 'pause': pause_btn,
+                                    'total': total, 'done': 0, 'failed': 0, 'cache_hits': 0}
+    
+    def on_job_event(self, event, job, payload):
+        """JobRunner callback, on its thread: count results here, show them at most once a frame"""
+        if event != 'result':
+            if event == 'finished' and payload != 'queued':
+                self.job_tallies.pop(job.id, None)
+            self.dispatcher.post(self.show_job_event, event, job, payload)
+            return
+        tally = self.job_tallies.setdefault(job.id, [0, 0, 0])
+        tally[0] += 1
+        tally[1] += not payload.ok
+        tally[2] += payload.cached
+        self.dispatcher.progress(('job', job.id), self.show_job_progress, job.id, tuple(tally), payload.filename)
+    
+    def show_job_progress(self, job_id, tally, filename):
+        view = self.job_windows.get(job_id)
+        if view is None:
+            return
+        view['done'], view['failed'], view['cache_hits'] = tally
+        done, total = view['done'], max(view['total'], view['done'])
+        view['bar'].config(value=done / total * 100)
+        view['file'].config(text=f"📷 {filename}")
+        if view['pause'].cget('text') == "Pause":
+            view['status'].config(text=f"Processed {done} of {total}... "
+                                       f"(cache hits: {view['cache_hits']}, {view['cache_hits'] / done:.0%})")
+    
+    def show_job_event(self, event, job, payload):
+        view = self.job_windows.get(job.id)
+        if event == 'started':
+            if view is not None:
+                view['status'].config(text="Starting...")
+                view['pause'].config(text="Pause", state='normal')
+            return
         
-        # Start processing thread
-        thread = threading.Thread(target=process_with_ai)
-        thread.daemon = True
-        thread.start()
+        # finished: payload is the job's state now
+        for category in self.category_buttons:
+            self.update_category_button(category)
+        if job.kind == 'ai':
+            print(self.engine.upload_stats.summary())
+            if self.engine.backend is not None:
+                print(self.engine.backend.latency_summary())
+        if self.engine.transfer_settings['mode'] == 'move' and job.finished:
+            self.load_images()
+        if payload == 'queued':
+            # Gave way to an interactive job, goes on after it
+            if view is not None:
+                view['status'].config(text="⏸ Paused for a newer job, continues after it")
+                view['pause'].config(state='disabled')
+            return
+        if view is None or job.kind != 'ai':
+            self.job_windows.pop(job.id, None)
+            if view is not None:
+                view['window'].destroy()
+            self.stats_label.config(text=f"Job #{job.id} ({job.label}): {payload}, "
+                                         f"{job.finished} of {job.total} files done")
+            if payload == 'failed':
+                messagebox.showerror("Job Stopped", f"Job #{job.id} stopped: {job.error}")
+            return
+        del self.job_windows[job.id]
+        done, failed = view['done'], view['failed']
+        view['bar'].config(value=100)
+        view['file'].config(text="")
+        view['cancel'].config(state='disabled')
+        view['pause'].config(state='disabled')
+        view['status'].config(text=f"✅ Complete! {done - failed} successful, {failed} failed")
+        view['window'].after(2000, view['window'].destroy)
+        
+        summary = (f"✅ Successfully renamed: {done - failed} files\n"
+                   f"❌ Failed: {failed} files\n"
+                   f"💾 Cache hits: {view['cache_hits']} of {done}\n"
+                   f"📉 Upload: {self.engine.upload_stats.saved_bytes / 1e6:.1f} MB saved\n")
+        left = job.total - job.finished
+        if payload == 'failed':
+            summary += f"⚠️ Stopped: {job.error}\n{left} files left, offered again at the next start\n"
+        elif left:
+            summary += f"⏹ Cancelled: {left} files not processed\n"
+        messagebox.showinfo("AI Rename Complete",
+                            summary + f"📁 Location: {os.path.join(job.dest, 'ai_renamed')}")
     
     def generate_ai_filename(self, image_path, prompt):
         """Generate filename using Gemini AI"""
-        try:
-            from PIL import Image as PILImage
-            
-            # Open image
-            img = PILImage.open(image_path)
-            
-            # Use the custom prompt or default
-            enhanced_prompt = prompt if prompt else """You are a filename generator. Look at this image and create a short, descriptive filename (3-5 words).
-
-Rules:
-- Use ONLY lowercase letters, numbers, and hyphens
-- NO spaces, NO special characters
-- Describe the MAIN subject of the image
-- Be specific but concise
-- DO NOT use words like "image", "photo", "picture"
-- DO NOT add any explanations, just return the filename
-
-Generate only the filename:"""
-            
-            # Generate content using Gemini
-            response = self.gemini_model.generate_content([enhanced_prompt, img])
-            ai_text = response.text.strip().lower()
-            
-            print(f"AI Raw Response: {ai_text}")  # Debug output
-            
-            # Clean the text thoroughly
-            # Remove any markdown, quotes, or extra text
-            ai_text = re.sub(r'[`*_#]', '', ai_text)  # Remove markdown
-            ai_text = re.sub(r'["\'()]', '', ai_text)  # Remove quotes and parentheses
-            
-            # Take only the first line
-            ai_text = ai_text.split('\n')[0]
-            
-            # Replace spaces and invalid characters with hyphens
-            ai_text = re.sub(r'[^\w\s-]', '', ai_text)  # Remove special chars
-            ai_text = re.sub(r'[-\s]+', '-', ai_text)   # Replace spaces/hyphens with single hyphen
-            ai_text = ai_text.strip('-')                 # Remove leading/trailing hyphens
-            
-            # Remove common unwanted words
-            unwanted = ['image', 'photo', 'picture', 'png', 'jpg', 'jpeg', 'screenshot', 'img']
-            for word in unwanted:
-                ai_text = ai_text.replace(f'{word}-', '').replace(f'-{word}', '')
-                if ai_text == word:
-                    ai_text = ''
-            
-            # Limit length
-            if len(ai_text) > 45:
-                parts = ai_text.split('-')
-                result = []
-                current_len = 0
-                for part in parts:
-                    if current_len + len(part) + 1 <= 45:
-                        result.append(part)
-                        current_len += len(part) + 1
-                    else:
-                        break
-                ai_text = '-'.join(result)
-            
-            # If we got a valid name, return it
-            if ai_text and len(ai_text) >= 3:
-                print(f"✅ Generated filename: {ai_text}")
-                return ai_text
-            
-            # Fallback if cleaning resulted in empty string
-            return f"image-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
-            
-        except Exception as e:
-            print(f"❌ AI generation error: {e}")
-            # Fallback to timestamp
-            return f"image-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
-    
-    def save_to_history(self, category, renamed_files):
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.history_text.insert(tk.END, f"\n--- {timestamp} - Category: {category} ---\n")
-        for file in renamed_files:
-            self.history_text.insert(tk.END, f"{file}\n")
-        self.history_text.see(tk.END)
-        
-        # Auto-save history to file
-        self.save_history_to_file()
+        return self.engine.generate_ai_filename(image_path, prompt)
     
-    def save_history_to_file(self):
-        history_file = os.path.join(os.path.dirname(__file__), 'history.txt')
-        try:
-            with open(history_file, 'w', encoding='utf-8') as f:
-                f.write(self.history_text.get('1.0', tk.END))
-        except:
-            pass
+    def on_batch_recorded(self, category, block):
+        """Engine callback, on any thread: the batch is already journaled, mirror it in the tab"""
+        self.dispatcher.post(self.save_to_history, block)
+    
+    def save_to_history(self, block):
+        # An unopened History tab reads the journal when it is built
+        if self.history_text is None or self.history_search.get().strip():
+            return
+        self.history_text.insert(tk.END, block)
+        self.history_text.see(tk.END)
     
     def load_history(self):
-        history_file = os.path.join(os.path.dirname(__file__), 'history.txt')
-        try:
-            if os.path.exists(history_file):
-                with open(history_file, 'r', encoding='utf-8') as f:
-                    self.history_text.insert(tk.END, f.read())
-        except:
-            pass
+        """Show the newest page of batches (matching the search, if any)"""
+        if self.history_text is None:
+            return
+        self.history_text.delete('1.0', tk.END)
+        self.history_oldest = None
+        self.load_older_history()
+        self.history_text.see(tk.END)
+    
+    def load_older_history(self):
+        query = self.history_search.get().strip() or None
+        batches = self.engine.journal.page(before=self.history_oldest, query=query)
+        if not batches:
+            return
+        self.history_oldest = batches[0].id
+        self.history_text.insert('1.0', ''.join(batch.format() for batch in batches))
     
     def clear_history(self):
-        if messagebox.askyesno("Confirm", "Clear all history?"):
-            self.history_text.delete('1.0', tk.END)
-            self.save_history_to_file()
+        if messagebox.askyesno("Confirm", "Clear all history?\n\nBatches can no longer be undone afterwards."):
+            self.engine.journal.clear()
+            self.load_history()
     
-    def save_counts(self):
-        config = {
-            'categories': self.categories,
-            'last_source': self.source_folder.get(),
-            'last_dest': self.dest_folder.get()
-        }
-        try:
-            with open('config.json', 'w') as f:
-                json.dump(config, f, indent=2)
-        except:
-            pass
+    def undo_batch(self):
+        self.change_batch(self.engine.undo_batch, "Undo")
     
-    def load_counts(self):
-        try:
-            with open('config.json', 'r') as f:
-                config = json.load(f)
-                # Update categories with saved counts
-                if 'categories' in config:
-                    for cat_name, cat_info in config['categories'].items():
-                        if cat_name in self.categories:
-                            self.categories[cat_name]['count'] = cat_info.get('count', 1)
-                return config
-        except:
-            return {}
+    def redo_batch(self):
+        self.change_batch(self.engine.redo_batch, "Redo")
+    
+    def change_batch(self, action, verb):
+        """Undo or redo on a thread: a big batch is a lot of file operations"""
+        if self.batch_busy:
+            return
+        self.batch_busy = True
+        
+        def change():
+            try:
+                outcome = action()
+            except Exception as e:
+                outcome = e
+            self.dispatcher.post(self.batch_changed, verb, outcome)
+        
+        threading.Thread(target=change, daemon=True).start()
+    
+    def batch_changed(self, verb, outcome):
+        self.batch_busy = False
+        if isinstance(outcome, Exception):
+            messagebox.showerror(verb, f"{verb} failed: {outcome}")
+            return
+        batch_id, done, skipped = outcome
+        if batch_id is None:
+            messagebox.showinfo("Info", f"Nothing to {verb.lower()}.")
+            return
+        self.load_history()
+        # Moved files may have come back to (or left) the source folder
+        if self.source_folder.get():
+            self.load_images()
+        message = f"{verb} of batch #{batch_id}: {done} files"
+        if skipped:
+            message += f", {skipped} skipped (changed or in the way, see console)"
+        messagebox.showinfo(verb, message)
+    
+    def sync_folders(self):
+        """Push the folder entries into the engine so they get saved"""
+        self.engine.last_source = self.source_folder.get()
+        self.engine.last_dest = self.dest_folder.get()
+    
+    def save_counts(self):
+        self.save_config()
     
     def load_config(self):
-        try:
-            with open('config.json', 'r') as f:
-                config = json.load(f)
-                self.source_folder.set(config.get('last_source', ''))
-                self.dest_folder.set(config.get('last_dest', ''))
-        except:
-            pass
+        self.source_folder.set(self.engine.last_source)
+        self.dest_folder.set(self.engine.last_dest)
     
     def save_config(self):
-        config = {
-            'categories': self.categories,
-            'last_source': self.source_folder.get(),
-            'last_dest': self.dest_folder.get()
-        }
+        self.sync_folders()
+        self.engine.save_config()
+
+def format_training_report(report):
+    categories = ', '.join(f"{name} {count}" for name, count in report['categories'].items())
+    text = f"✅ Trained on {report['samples']} screenshots ({categories})"
+    if report['holdout_accuracy'] is not None:
+        text += f"\nHeld-out accuracy: {report['holdout_accuracy']:.0%}"
+    return text
+
+def print_result(result):
+    if result.skipped:
+        print(result.line)
+    else:
+        print(("✅ " if result.ok else "❌ ") + result.line)
+
+def parse_size(text):
+    """'20K', '1.5M', '300' -> bytes"""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    text = text.strip().upper().rstrip('B')
+    if text[-1:] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def parse_date(text):
+    datetime.strptime(text, '%Y-%m-%d')
+    return text
+
+def parse_dimensions(text):
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+def build_parser():
+    # Only the command line needs argparse; the window starts without it
+    import argparse
+    
+    parser = argparse.ArgumentParser(prog='sortshot', description="Sort screenshots without the GUI")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    
+    # Which files a command looks at
+    scan_common = argparse.ArgumentParser(add_help=False)
+    scan_common.add_argument('-r', '--recursive', action='store_true', help="Include images in subfolders")
+    scan_common.add_argument('--include', action='append', metavar='GLOB',
+                             help="Only files whose name or relative path matches (repeatable)")
+    scan_common.add_argument('--exclude', action='append', metavar='GLOB',
+                             help="Skip files and folders that match (repeatable)")
+    scan_common.add_argument('--min-size', type=parse_size, help="Skip smaller files, e.g. 20K")
+    scan_common.add_argument('--max-size', type=parse_size, help="Skip larger files, e.g. 15M")
+    scan_common.add_argument('--since', type=parse_date, help="Only files modified on or after YYYY-MM-DD")
+    scan_common.add_argument('--until', type=parse_date, help="Only files modified on or before YYYY-MM-DD")
+    scan_common.add_argument('--min-dimensions', type=parse_dimensions, metavar='WxH', help="Skip smaller images")
+    scan_common.add_argument('--max-dimensions', type=parse_dimensions, metavar='WxH', help="Skip larger images")
+    
+    # Options shared by every headless command
+    common = argparse.ArgumentParser(add_help=False, parents=[scan_common])
+    common.add_argument('source', help="Folder containing screenshots")
+    common.add_argument('dest', help="Folder to sort into")
+    mode = common.add_mutually_exclusive_group(required=True)
+    mode.add_argument('--category', help="Put every image into this category")
+    mode.add_argument('--ai', action='store_true', help="Name every image with Gemini")
+    mode.add_argument('--rules-only', action='store_true',
+                      help="Only sort the images a routing rule matches, leave the rest")
+    common.add_argument('--no-rules', action='store_true', help="Ignore the routing rules in config.json")
+    common.add_argument('--prompt-file', help="Text file with a custom AI prompt")
+    common.add_argument('--workers', type=int, help="Parallel Gemini requests")
+    common.add_argument('--rpm', type=int, help="Max Gemini requests per minute")
+    common.add_argument('--no-cache', action='store_true', help="Always ask Gemini, ignore cached names")
+    common.add_argument('--batch-size', type=int, help="Images per Gemini request (1 = no batching)")
+    common.add_argument('--max-edge', type=int, help="Downscale uploads to this long edge (0 = send originals)")
+    common.add_argument('--mode', choices=TRANSFER_MODES,
+                        help="How files reach the destination (default: from config, else copy)")
+    common.add_argument('--verify', action='store_true', help="Checksum every copied file")
+    common.add_argument('--output', choices=OUTPUT_FORMATS,
+                        help="Write sorted files as this format, or keep the originals (default: from config, else keep)")
+    common.add_argument('--quality', type=int, help="Lossy WebP quality and JPEG quality cap (1-100)")
+    common.add_argument('--lossy', action='store_true', help="With --output webp, encode lossy at --quality")
+    common.add_argument('--metadata', choices=METADATA_MODES,
+                        help="Keep all metadata, only the color profile, or strip it when re-encoding")
+    common.add_argument('--encoders', type=int, help="Encoder processes (default: one per CPU)")
+    common.add_argument('--shard', choices=SHARD_MODES,
+                        help="Subfolders inside each category: by year, by month (YYYY/MM) or by name hash")
+    common.add_argument('--dedupe', choices=DUPLICATE_MODES,
+                        help="Near-duplicates: share one AI name or skip all but the first")
+    common.add_argument('--dedupe-threshold', type=int, help="Max differing hash bits (of 64) for near-duplicates")
+    common.add_argument('--local', action='store_true',
+                        help="With --ai, sort screenshots the local classifier is sure about without Gemini")
+    common.add_argument('--local-threshold', type=float, help="Confidence needed to trust the local classifier")
+    common.add_argument('--backend', choices=BACKENDS, help="Vision backend for --ai (default: from config, else gemini)")
+    common.add_argument('--model', help="Gemini model name")
+    common.add_argument('--local-model', metavar='MODULE:FUNCTION',
+                        help="With --backend local, the function that names an image")
+    common.add_argument('--record', metavar='FILE', help="Append every model request and reply to this JSONL file")
+    common.add_argument('--replay', metavar='FILE', help="Answer from a --record file instead of a model")
+    common.add_argument('--replay-speed', type=float,
+                        help="Wait the recorded latency times this when replaying (0 = none)")
+    common.add_argument('--config', help="Path to config.json (default: next to main.py)")
+    common.add_argument('--journal', help="Path to the operation journal (default: data/journal.db)")
+    common.add_argument('--stats', action='store_true', help="Print per-stage timings at the end")
+    common.add_argument('--trace', help="Write a Chrome trace (chrome://tracing, Perfetto) to this file")
+    
+    subparsers.add_parser('sort', parents=[common], help="Sort every image in a folder")
+    
+    watch_parser = subparsers.add_parser('watch', parents=[common],
+                                         help="Keep sorting new screenshots as they appear")
+    watch_parser.add_argument('--interval', type=float, default=5.0, help="Seconds between polls")
+    watch_parser.add_argument('--settle', type=float, default=3.0,
+                              help="Seconds a file must stay unchanged before it is sorted")
+    watch_parser.add_argument('--once', action='store_true', help="Poll once and exit (for cron)")
+    watch_parser.add_argument('--ledger', default=os.path.join(DATA_DIR, 'watch_ledger.db'),
+                              help="Record of already processed files")
+    
+    # Journal commands only need the journal (and config for counts)
+    journal_common = argparse.ArgumentParser(add_help=False)
+    journal_common.add_argument('--config', help="Path to config.json (default: next to main.py)")
+    journal_common.add_argument('--journal', help="Path to the operation journal (default: data/journal.db)")
+    
+    history_parser = subparsers.add_parser('history', parents=[journal_common], help="Show recent batches")
+    history_parser.add_argument('--search', help="Only show lines containing this text")
+    history_parser.add_argument('--limit', type=int, default=20, help="Number of batches to show")
+    subparsers.add_parser('train', parents=[journal_common],
+                          help="Train the local classifier from past manual sorts")
+    for name, verb in (('undo', "Reverse"), ('redo', "Repeat")):
+        undo_parser = subparsers.add_parser(name, parents=[journal_common],
+                                            help=f"{verb} a batch (default: the latest)")
+        undo_parser.add_argument('batch', type=int, nargs='?', help="Batch number shown by 'history'")
+    reindex_parser = subparsers.add_parser('reindex', parents=[journal_common],
+                                           help="Re-read a destination into the index after changing it by hand")
+    reindex_parser.add_argument('dest', help="Folder sorted into")
+    
+    jobs_parser = subparsers.add_parser('jobs', parents=[journal_common], help="Show recent sorting jobs")
+    jobs_parser.add_argument('--limit', type=int, default=20, help="Number of jobs to show")
+    resume_parser = subparsers.add_parser('resume', parents=[journal_common],
+                                          help="Finish an interrupted job (default: every unfinished one)")
+    resume_parser.add_argument('job', type=int, nargs='?', help="Job number shown by 'jobs'")
+    
+    find_parser = subparsers.add_parser('find', parents=[scan_common],
+                                        help="List the images in a folder that match a query")
+    find_parser.add_argument('source', help="Folder containing screenshots")
+    find_parser.add_argument('query', nargs='?', default='',
+                             help='One quoted query, e.g. "format:png dims:1080x2400 age<7d size>1M"')
+    find_parser.add_argument('--config', help="Path to config.json (default: next to main.py)")
+    return parser
+
+def configure_engine(parser, args):
+    """Build an engine from CLI flags; returns (engine, prompt, router) or None if AI is unavailable"""
+    engine = SortEngine(config_path=args.config, journal_path=args.journal)
+    
+    if args.category and args.category not in engine.categories:
+        parser.error(f"unknown category '{args.category}' (choose from {', '.join(engine.categories)})")
+    
+    if args.workers:
+        engine.ai_settings['workers'] = args.workers
+    if args.rpm:
+        engine.ai_settings['requests_per_minute'] = args.rpm
+    if args.no_cache:
+        engine.ai_settings['cache'] = False
+    if args.batch_size:
+        engine.ai_settings['batch_size'] = args.batch_size
+    if args.max_edge is not None:
+        engine.ai_settings['preprocess'] = args.max_edge > 0
+        engine.ai_settings['max_edge'] = args.max_edge
+    if args.mode:
+        engine.transfer_settings['mode'] = args.mode
+    if args.verify:
+        engine.transfer_settings['verify'] = True
+    if args.output:
+        engine.output_settings['format'] = args.output
+    if args.quality is not None:
+        engine.output_settings['quality'] = args.quality
+    if args.lossy:
+        engine.output_settings['lossless'] = False
+    if args.metadata:
+        engine.output_settings['metadata'] = args.metadata
+    if args.encoders:
+        engine.output_settings['workers'] = args.encoders
+    if args.shard:
+        engine.layout_settings['shard'] = args.shard
+    if args.dedupe:
+        engine.duplicate_settings['mode'] = args.dedupe
+    if args.dedupe_threshold is not None:
+        engine.duplicate_settings['threshold'] = args.dedupe_threshold
+    if args.local:
+        engine.classifier_settings['enabled'] = True
+    if args.local_threshold is not None:
+        engine.classifier_settings['threshold'] = args.local_threshold
+    if args.backend:
+        engine.ai_settings['backend'] = args.backend
+    if args.model:
+        engine.ai_settings['model'] = args.model
+    if args.local_model:
+        engine.ai_settings['local_model'] = args.local_model
+    if args.record and args.replay:
+        parser.error("--record and --replay can't be combined")
+    if args.record:
+        engine.ai_settings.update(record=True, recording=args.record)
+    if args.replay:
+        engine.ai_settings.update(backend='replay', recording=args.replay)
+    if args.replay_speed is not None:
+        engine.ai_settings['replay_speed'] = args.replay_speed
+    configure_scan(engine, args)
+    try:
+        router = None if args.no_rules else engine.make_router()
+    except RuleError as e:
+        parser.error(f"bad routing rule in config.json: {e}")
+    if args.rules_only and not router:
+        parser.error("--rules-only needs routing rules in config.json")
+    
+    prompt = DEFAULT_PROMPT
+    if args.ai:
+        print(engine.init_backend())
+        if not engine.ai_available:
+            return None
+        if args.prompt_file:
+            with open(args.prompt_file, 'r', encoding='utf-8') as f:
+                prompt = f.read().strip() or SHORT_PROMPT
+    return engine, prompt, router
+
+def configure_scan(engine, args):
+    """Apply the scan filter flags to the engine's scan settings"""
+    scan = engine.scan_settings
+    if args.recursive:
+        scan['recursive'] = True
+    if args.include:
+        scan['include'] = args.include
+    if args.exclude:
+        scan['exclude'] = scan['exclude'] + args.exclude
+    for key in ('min_size', 'max_size', 'since', 'until'):
+        if getattr(args, key) is not None:
+            scan[key] = getattr(args, key)
+    if args.min_dimensions:
+        scan['min_width'], scan['min_height'] = args.min_dimensions
+    if args.max_dimensions:
+        scan['max_width'], scan['max_height'] = args.max_dimensions
+
+def cli(argv=None):
+    """Headless entry point: sort a whole folder without opening a window"""
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command in ('history', 'undo', 'redo', 'train', 'reindex'):
+        return run_journal_command(parser, args)
+    if args.command == 'find':
+        return run_find(parser, args)
+    if args.command in ('jobs', 'resume'):
+        return run_jobs_command(parser, args)
+    if args.stats or args.trace:
+        metrics.enable(trace=bool(args.trace))
+    configured = configure_engine(parser, args)
+    if configured is None:
+        return 1
+    engine, prompt, router = configured
+    
+    if args.command == 'watch':
+        try:
+            return run_watch(engine, prompt, router, args)
+        finally:
+            report_metrics(args)
+    
+    total = failed = skipped = cache_hits = classified = 0
+    for result in engine.run(args.source, args.dest, category=args.category, prompt=prompt,
+                             router=router, rules_only=args.rules_only):
+        total += 1
+        failed += not result.ok
+        skipped += result.skipped
+        cache_hits += result.cached
+        classified += result.classified
+        print_result(result)
+    
+    print(f"Sorted {total - failed - skipped} of {total} files, {failed} failed"
+          + (f", {skipped} near-duplicates skipped" if skipped else ""))
+    # A job can stop before any file (e.g. Gemini unreachable) and still leave files to resume
+    unfinished = [job for job in map(engine.jobs.job, engine.run_job_ids) if job.state != 'done']
+    for job in unfinished:
+        print(f"❌ Job #{job.id}: {job.state}" + (f" ({job.error})" if job.error else "")
+              + f", {job.total - job.finished} files left ('resume' finishes it)")
+    if router:
+        print(f"Rules: {router.summary()}")
+    if engine.transcoder.active:
+        print(engine.transcoder.summary())
+    engine.shutdown()
+    if args.ai and total:
+        print(f"AI name cache: {cache_hits} hits ({cache_hits / total:.0%})")
+        if engine.classifier_settings['enabled']:
+            print(f"Local classifier: {classified} sorted without Gemini ({classified / total:.0%})")
+        print(engine.upload_stats.summary())
+        print(engine.backend.latency_summary())
+    report_metrics(args)
+    return 1 if failed or unfinished else 0
+
+def report_metrics(args):
+    if args.stats:
+        print(metrics.summary())
+    if args.trace:
+        count = metrics.export_trace(args.trace)
+        print(f"📊 Trace with {count} events written to {args.trace}")
+
+def run_journal_command(parser, args):
+    engine = SortEngine(config_path=args.config, journal_path=args.journal)
+    if args.command == 'train':
         try:
-            with open('config.json', 'w') as f:
-                json.dump(config, f, indent=2)
-        except:
-            pass
+            report = engine.train_classifier()
+        except ValueError as e:
+            print(f"❌ Not enough history to train: {e}")
+            return 1
+        print(format_training_report(report))
+        return 0
+    if args.command == 'history':
+        for batch in engine.journal.page(limit=args.limit, query=args.search):
+            print(batch.format(), end='')
+        return 0
+    if args.command == 'reindex':
+        if not os.path.isdir(args.dest):
+            parser.error(f"{args.dest} is not a folder")
+        count = engine.reindex(args.dest)
+        engine.shutdown()
+        counts = engine.counters.peek_all(engine.categories)
+        print(f"📇 Indexed {count} files in {args.dest}")
+        print("Next numbers: " + ", ".join(f"{category} {number}" for category, number in counts.items()))
+        return 0
+    
+    action = engine.undo_batch if args.command == 'undo' else engine.redo_batch
+    try:
+        batch_id, done, skipped = action(args.batch)
+    except ValueError as e:
+        parser.error(str(e))
+    if batch_id is None:
+        print(f"Nothing to {args.command}")
+        return 1
+    print(f"{args.command.title()} batch #{batch_id}: {done} files, {skipped} skipped")
+    return 1 if skipped else 0
+
+def run_jobs_command(parser, args):
+    engine = SortEngine(config_path=args.config, journal_path=args.journal)
+    if args.command == 'jobs':
+        jobs = engine.jobs.recent(args.limit)
+        for job in jobs:
+            print(job.format())
+        if not jobs:
+            print("No jobs yet")
+        return 0
+    
+    if args.job is None:
+        jobs = engine.jobs.unfinished()
+    else:
+        job = engine.jobs.job(args.job)
+        if job is None:
+            parser.error(f"no job #{args.job}")
+        if job.state == 'done':
+            parser.error(f"job #{job.id} is already done")
+        if job.state == 'running' and not job.interrupted:
+            parser.error(f"job #{job.id} is still running (process {job.pid})")
+        jobs = [job]
+    if not jobs:
+        print("Nothing to resume")
+        return 1
+    if any(job.kind == 'ai' for job in jobs):
+        print(engine.init_backend())
+        if not engine.ai_available:
+            return 1
+    
+    total = failed = 0
+    try:
+        for job in jobs:
+            print(f"▶ Resuming {job.format()}")
+            for result in engine.run_job(job.id):
+                total += 1
+                failed += not result.ok
+                print_result(result)
+            job = engine.jobs.job(job.id)
+            print(f"Job #{job.id}: {job.state}" + (f" ({job.error})" if job.error else ""))
+    finally:
+        engine.shutdown()
+    print(f"Sorted {total - failed} of {total} files, {failed} failed")
+    return 1 if failed or any(engine.jobs.job(job.id).state != 'done' for job in jobs) else 0
+
+def run_find(parser, args):
+    engine = SortEngine(config_path=args.config)
+    configure_scan(engine, args)
+    scan_id = time.time_ns()
+    names = list(engine.scan_indexed(args.source, scan_id))
+    engine.index_details(args.source)
+    try:
+        positions = engine.catalog.query(args.source, args.query, scan_id=scan_id)
+    except QueryError as e:
+        parser.error(f"bad query: {e}")
+    for position in sorted(positions):
+        print(names[position])
+    print(f"{len(positions)} of {len(names)} images match")
+    return 0 if positions else 1
+
+def run_watch(engine, prompt, router, args):
+    ledger = ProcessedLedger(args.ledger)
+    stop_event = threading.Event()
+    if not args.once:
+        print(f"👀 Watching {args.source} every {args.interval:g}s (Ctrl+C to stop)")
+    try:
+        watch(engine, ledger, args.source, args.dest, category=args.category, prompt=prompt,
+              interval=args.interval, settle=args.settle, once=args.once,
+              stop_event=stop_event, on_result=print_result, scan_filter=engine.scan_filter(),
+              router=router, rules_only=args.rules_only, recursive=engine.scan_settings['recursive'],
+              sniff=engine.scan_settings['sniff'])
+    except KeyboardInterrupt:
+        stop_event.set()
+        print("⏹ Stopped watching")
+    finally:
+        ledger.close()
+        engine.shutdown()
+        if engine.transcoder.active:
+            print(engine.transcoder.summary())
+        if router:
+            print(f"Rules: {router.summary()}")
+    return 0
 
 def main():
     root = tk.Tk()
@@ -809,11 +1603,18 @@ def main():
     
     # Save config on close
     def on_closing():
+        app.dispatcher.stop()
+        if app.scan_control is not None:
+            app.scan_control.set()
         app.save_config()
+        app.thumb_loader.shutdown()
+        app.engine.shutdown()
         root.destroy()
     
     root.protocol("WM_DELETE_WINDOW", on_closing)
     root.mainloop()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if len(sys.argv) > 1:
+        sys.exit(cli())
+    main()
@@ -0,0 +1,260 @@
+"""Timers, counters and histograms to see where a sort spends its time.
+
+Off by default. While disabled, timer() hands back one shared do-nothing
+context manager and count()/observe() return on their first line, so the
+instrumentation left in the pipeline costs a call and a branch.
+
+Enabled, every timer feeds a histogram (count, total, max and log-spaced
+buckets, good enough for p50/p99) and, when tracing, a Chrome trace event.
+Open the file written by export_trace() in chrome://tracing or Perfetto to
+see scans, decodes, model calls and copies laid out per thread.
+
+Work done in pool processes is timed there (see wrap) and recorded here
+when its result comes back.
+"""
+import functools
+import json
+import math
+import os
+import threading
+import time
+
+# Beyond this the trace stops growing; histograms and counters keep going
+MAX_TRACE_EVENTS = 200000
+
+# Histogram buckets are 2**(1/8) (~9%) wide, starting at a microsecond
+BUCKETS_PER_DOUBLING = 8
+SMALLEST = 1e-6
+
+
+class Histogram:
+    __slots__ = ('count', 'total', 'min', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+        self.buckets = {}
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        index = 0 if value <= SMALLEST else int(math.log2(value / SMALLEST) * BUCKETS_PER_DOUBLING) + 1
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def percentile(self, pct):
+        """Upper edge of the bucket holding the pct-th value, within min..max"""
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(self.count * pct / 100))
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                upper = SMALLEST * 2 ** (index / BUCKETS_PER_DOUBLING)
+                return min(max(upper, self.min), self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else None,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def annotate(self, **args):
+        pass
+
+
+NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    __slots__ = ('metrics', 'name', 'args', 'start')
+
+    def __init__(self, metrics, name, args):
+        self.metrics = metrics
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.record(self.name, self.start, time.perf_counter() - self.start, self.args)
+        return False
+
+    def annotate(self, **args):
+        """Attach details to the trace event, e.g. once a result is known"""
+        self.args.update(args)
+
+
+class TimedResult:
+    """What a wrapped pool function sends back instead of its bare result"""
+    __slots__ = ('value', 'pid', 'tid', 'start', 'seconds')
+
+    def __init__(self, value, pid, tid, start, seconds):
+        self.value = value
+        self.pid = pid
+        self.tid = tid
+        self.start = start
+        self.seconds = seconds
+
+
+def _run_timed(fn, *args):
+    # perf_counter is system-wide monotonic, so worker times line up with ours
+    start = time.perf_counter()
+    value = fn(*args)
+    return TimedResult(value, os.getpid(), threading.get_ident(), start, time.perf_counter() - start)
+
+
+class Metrics:
+    """Process-wide registry; use the module level `metrics` instance"""
+
+    def __init__(self):
+        self.enabled = False
+        self.tracing = False
+        self.lock = threading.Lock()
+        self.reset()
+
+    def enable(self, trace=False):
+        self.tracing = self.tracing or trace
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+        self.tracing = False
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            self.events = []
+            self.threads = {}
+            self.dropped = 0
+            self.origin = time.perf_counter()
+
+    # ---- recording ----------------------------------------------------
+
+    def timer(self, name, **args):
+        """Context manager timing its block as `name`"""
+        if not self.enabled:
+            return NULL_TIMER
+        return _Timer(self, name, args)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, value):
+        """Add a value to a histogram without a trace event"""
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(value)
+
+    def record(self, name, start, seconds, args=None, pid=None, tid=None):
+        """A finished span: start is a perf_counter() reading"""
+        if not self.enabled:
+            return
+        local = pid is None
+        pid = os.getpid() if local else pid
+        tid = threading.get_ident() if tid is None else tid
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(seconds)
+            if not self.tracing:
+                return
+            if len(self.events) >= MAX_TRACE_EVENTS:
+                self.dropped += 1
+                return
+            event = {'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                     'ts': round((start - self.origin) * 1e6, 1), 'dur': round(seconds * 1e6, 1)}
+            if args:
+                event['args'] = args
+            self.events.append(event)
+            if (pid, tid) not in self.threads:
+                self.threads[(pid, tid)] = threading.current_thread().name if local else f"worker {pid}"
+
+    # ---- pools --------------------------------------------------------
+
+    def wrap(self, fn):
+        """fn itself, or a picklable stand-in that also times it, for pool.map/submit"""
+        if not self.enabled:
+            return fn
+        return functools.partial(_run_timed, fn)
+
+    def unwrap(self, name, value):
+        """Record a result of a wrapped function under name and return the bare value"""
+        if isinstance(value, TimedResult):
+            self.record(name, value.start, value.seconds, pid=value.pid, tid=value.tid)
+            return value.value
+        return value
+
+    # ---- reporting ----------------------------------------------------
+
+    def snapshot(self):
+        """{'counters': {...}, 'timers': {name: {count, total, mean, p50, p99, max}}}"""
+        with self.lock:
+            return {
+                'counters': dict(sorted(self.counters.items())),
+                'timers': {name: histogram.summary() for name, histogram in sorted(self.histograms.items())},
+            }
+
+    def summary(self):
+        """Plain text table for the console or the Stats tab"""
+        snapshot = self.snapshot()
+        if not snapshot['timers'] and not snapshot['counters']:
+            return "No metrics recorded" if self.enabled else "Metrics are off"
+        lines = [f"{'stage':<22} {'calls':>7} {'total s':>9} {'mean ms':>9} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}"]
+        for name, timer in snapshot['timers'].items():
+            lines.append(f"{name:<22} {timer['count']:>7} {timer['total']:>9.3f} {timer['mean'] * 1000:>9.2f} "
+                         f"{timer['p50'] * 1000:>9.2f} {timer['p99'] * 1000:>9.2f} {timer['max'] * 1000:>9.2f}")
+        if snapshot['counters']:
+            lines.append('')
+            lines.extend(f"{name:<22} {value:>7}" for name, value in snapshot['counters'].items())
+        return '\n'.join(lines)
+
+    def export_trace(self, path):
+        """Write a Chrome trace (JSON object format) of everything recorded so far"""
+        with self.lock:
+            events = list(self.events)
+            threads = dict(self.threads)
+            dropped = self.dropped
+        for (pid, tid), name in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}})
+        trace = {'traceEvents': events, 'displayTimeUnit': 'ms',
+                 'otherData': {'dropped_events': dropped, **self.snapshot()}}
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(trace, f)
+        os.replace(tmp_path, path)
+        return len(events)
+
+
+metrics = Metrics()
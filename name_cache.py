@@ -0,0 +1,111 @@
+"""On-disk cache of AI-generated filenames.
+
+Entries are keyed by a hash of the image bytes plus a hash of the prompt,
+so the same screenshot gets the same name no matter which folder it sits
+in, and editing the prompt in the AI tab naturally misses the cache.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(path):
+    """SHA-256 of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_prompt(prompt):
+    return hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+
+
+class NameCache:
+    """SQLite-backed content-addressed cache with size and age eviction"""
+
+    def __init__(self, path, max_entries=50000, max_age_days=90):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 86400
+        self.hits = 0
+        self.misses = 0
+        self.puts_since_evict = 0
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS names (
+                               image_hash TEXT NOT NULL,
+                               prompt_hash TEXT NOT NULL,
+                               name TEXT NOT NULL,
+                               created REAL NOT NULL,
+                               accessed REAL NOT NULL,
+                               PRIMARY KEY (image_hash, prompt_hash))''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS names_accessed ON names (accessed)')
+        self.db.commit()
+        self.evict()
+
+    def get(self, image_hash, prompt_hash):
+        """Cached name or None; counts towards the hit rate"""
+        with self.lock:
+            row = self.db.execute('SELECT name, created FROM names WHERE image_hash=? AND prompt_hash=?',
+                                  (image_hash, prompt_hash)).fetchone()
+            now = time.time()
+            if row is None or now - row[1] > self.max_age:
+                self.misses += 1
+                return None
+            self.db.execute('UPDATE names SET accessed=? WHERE image_hash=? AND prompt_hash=?',
+                            (now, image_hash, prompt_hash))
+            self.db.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, image_hash, prompt_hash, name):
+        with self.lock:
+            now = time.time()
+            self.db.execute('INSERT OR REPLACE INTO names VALUES (?, ?, ?, ?, ?)',
+                            (image_hash, prompt_hash, name, now, now))
+            self.db.commit()
+            self.puts_since_evict += 1
+            due = self.puts_since_evict >= 500
+        if due:
+            self.evict()
+
+    def evict(self):
+        """Drop expired entries, then the least recently used beyond max_entries"""
+        with self.lock:
+            self.puts_since_evict = 0
+            self.db.execute('DELETE FROM names WHERE created < ?', (time.time() - self.max_age,))
+            self.db.execute('''DELETE FROM names WHERE rowid IN (
+                                   SELECT rowid FROM names ORDER BY accessed DESC LIMIT -1 OFFSET ?)''',
+                            (self.max_entries,))
+            self.db.commit()
+
+    def clear(self):
+        with self.lock:
+            self.db.execute('DELETE FROM names')
+            self.db.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM names').fetchone()[0]
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,142 @@
+"""Shrink images before they are uploaded to Gemini.
+
+A retina screenshot is several megabytes of PNG, but the model only needs
+a ~1 MP picture to name it. Decoding uses JPEG draft mode and Image.reduce
+so the big original is never fully decoded and resampled at full size.
+"""
+import io
+import os
+import threading
+import time
+
+from PIL import Image, ImageStat
+
+MIME_TYPES = {'JPEG': 'image/jpeg', 'WEBP': 'image/webp', 'PNG': 'image/png'}
+
+# Mean HSV saturation (0-255) below which a picture is treated as text/UI
+TEXT_SATURATION = 24
+
+
+class StageStats:
+    """Thread-safe totals of bytes and per-stage latency"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.files = 0
+        self.original_bytes = 0
+        self.sent_bytes = 0
+        self.requests = 0
+        self.request_images = 0
+        self.stage_seconds = {}
+
+    def add(self, original_bytes, sent_bytes, timings):
+        with self.lock:
+            self.files += 1
+            self.original_bytes += original_bytes
+            self.sent_bytes += sent_bytes
+            for stage, seconds in timings.items():
+                self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + seconds
+
+    def add_request(self, seconds, image_count):
+        """One model call that carried image_count images"""
+        with self.lock:
+            self.requests += 1
+            self.request_images += image_count
+            self.stage_seconds['request'] = self.stage_seconds.get('request', 0.0) + seconds
+
+    @property
+    def saved_bytes(self):
+        return self.original_bytes - self.sent_bytes
+
+    def summary(self):
+        """One-line human readable report"""
+        with self.lock:
+            if not self.requests:
+                return "Upload: no requests sent"
+            parts = [f"Upload: {self.requests} requests for {self.request_images} images"]
+            if self.files:
+                saved = self.original_bytes - self.sent_bytes
+                pct = saved / self.original_bytes if self.original_bytes else 0.0
+                parts.append(f"{self.original_bytes / 1e6:.1f} MB → {self.sent_bytes / 1e6:.1f} MB "
+                             f"({pct:.0%} saved)")
+            stages = ', '.join(f"{stage} {seconds / self.request_images * 1000:.0f}ms"
+                               for stage, seconds in self.stage_seconds.items())
+            parts.append(f"avg per image: {stages}")
+            return '; '.join(parts)
+
+
+def looks_like_text(img):
+    """Mostly unsaturated pixels: chats, documents, terminals and the like"""
+    small = img.copy()
+    small.thumbnail((64, 64))
+    saturation = ImageStat.Stat(small.convert('HSV')).mean[1]
+    return saturation < TEXT_SATURATION
+
+
+def open_reduced(path, max_edge):
+    """Open an image decoded at roughly max_edge, as cheaply as possible (0 = full size)"""
+    img = Image.open(path)
+    if max_edge <= 0:
+        img.load()
+        return img
+    if img.format == 'JPEG':
+        # Lets libjpeg decode at 1/2, 1/4 or 1/8 scale directly
+        img.draft('RGB', (max_edge, max_edge))
+    img.load()
+
+    # Integer box reduction first, then a small high quality resample
+    factor = max(img.size) // max_edge
+    if factor >= 2:
+        # reduce() only takes 8-bit and 32-bit modes
+        if img.mode == 'P':
+            img = img.convert('RGBA')
+        elif img.mode == '1' or img.mode.startswith('I;'):
+            img = img.convert('L')
+        img = img.reduce(factor)
+    if max(img.size) > max_edge:
+        img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    return img
+
+
+def prepare_image(path, max_edge=1280, fmt='WEBP', quality=80, grayscale_text=True):
+    """Return (blob, original_bytes, sent_bytes, timings) for one image.
+
+    The blob is a {'mime_type', 'data'} dict that generate_content accepts.
+    """
+    fmt = fmt.upper()
+    if fmt == 'JPG':
+        fmt = 'JPEG'
+    timings = {}
+
+    start = time.perf_counter()
+    original_bytes = os.path.getsize(path)
+    img = open_reduced(path, max_edge)
+    timings['decode'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if img.mode not in ('RGB', 'L'):
+        if 'A' in img.getbands() or img.mode == 'P':
+            img = img.convert('RGBA')
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel('A'))
+            img = background
+        else:
+            img = img.convert('RGB')
+    if grayscale_text and img.mode == 'RGB' and looks_like_text(img):
+        img = img.convert('L')
+    timings['convert'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    buffer = io.BytesIO()
+    if fmt == 'PNG':
+        img.save(buffer, 'PNG', optimize=True)
+    else:
+        img.save(buffer, fmt, quality=quality)
+    data = buffer.getvalue()
+    timings['encode'] = time.perf_counter() - start
+
+    blob = {'mime_type': MIME_TYPES[fmt], 'data': data}
+    return blob, original_bytes, len(data), timings
@@ -0,0 +1,331 @@
+"""Declarative routing rules: send files to a category without AI or clicks.
+
+Rules live in config.json next to "categories", and the first rule that
+matches a file wins:
+
+    "rules": [
+        {"name": "boarding passes", "category": "tickets", "filename": ["*boarding*", "*ticket*"]},
+        {"name": "messengers", "category": "chats", "app": ["whatsapp", "*telegram*", "messages"]},
+        {"category": "others", "regex": "^IMG_\\\\d+$", "dims": "1080x2400", "format": ["png"]},
+        {"category": "funny", "software": "*Snipping Tool*", "max_size": "2M"}
+    ]
+
+Every condition in a rule must hold. filename takes globs for the whole
+name and regex is searched in the name without its extension (^ is its
+start, $ its end, so "^IMG_\\d+$" matches IMG_1234.png), app is the app an Android
+screenshot name ends with (Screenshot_20240115-093012_WhatsApp.jpg), and
+folder takes globs for the subfolder, relative to the scanned one. format, min_size/max_size,
+dims (WxH), min_/max_ width/height, orientation and software (the EXIF or
+PNG Software tag) look at the file itself.
+
+Name conditions are compiled once for all rules together. Plain globs
+('*ticket*', 'IMG_*') become substring tests and exact names a dict
+lookup. Literal app names are a dict lookup on the app, which is taken from
+the name once. Everything else goes into one regex of optional lookaheads
+over the name (globs) and one over the stem (regexes), so a single match
+per file evaluates them all. A regex with groups or inline flags ("(?i)")
+of its own is compiled on its own instead: spliced in, its backreferences
+would be renumbered and its flags would no longer be at the start. Each condition knows the
+rules that use it, so a file only visits the rules it could match, in
+order. Their metadata checks run cheapest first, and the image header is
+read at most once per file, only if a candidate rule needs it.
+"""
+import fnmatch
+import os
+import re
+
+from PIL import Image
+
+from metrics import metrics
+
+SOFTWARE_TAG = 0x0131
+# Android names screenshots Screenshot_<date>-<time>_<App>.<ext>
+APP_NAME = re.compile(r'screenshot.*_([^_]+)\.[^.]+\Z', re.IGNORECASE)
+# Flags of a regex without inline ones, e.g. (?i)
+PLAIN_FLAGS = re.compile('').flags
+SIZE_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+FORMAT_ALIASES = {'jpg': 'jpeg', 'tif': 'tiff'}
+ORIENTATIONS = ('portrait', 'landscape', 'square')
+KNOWN_KEYS = {'name', 'category', 'filename', 'regex', 'app', 'folder', 'format', 'min_size', 'max_size', 'dims',
+              'min_width', 'max_width', 'min_height', 'max_height', 'orientation', 'software'}
+
+
+class RuleError(ValueError):
+    pass
+
+
+def _as_list(value):
+    return [value] if isinstance(value, str) else list(value)
+
+
+def _literal_test(glob):
+    """('eq'|'start'|'end'|'in', text) for a glob that is a plain string test, else None"""
+    body = glob.strip('*')
+    if not body or any(c in body for c in '*?['):
+        return None
+    starts, ends = glob.startswith('*'), glob.endswith('*')
+    if len(glob) - len(body) != starts + ends:
+        return None  # '**x' and friends: leave them to the regex
+    return ('in' if starts and ends else 'end' if starts else 'start' if ends else 'eq'), body
+
+
+def _size(value, where):
+    if isinstance(value, int):
+        return value
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)\s*([kmg]?)b?', str(value).strip().lower())
+    if not match:
+        raise RuleError(f"{where}: bad size {value!r} (e.g. 500K, 2M)")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+def read_header(path):
+    """(width, height, software) from the image header; Nones if unreadable"""
+    try:
+        with Image.open(path) as img:
+            software = img.info.get('Software') or img.info.get('software')
+            if software is None and img.format in ('JPEG', 'TIFF', 'WEBP'):
+                software = img.getexif().get(SOFTWARE_TAG)
+            return img.width, img.height, software
+    except Exception:
+        return None, None, None
+
+
+class Rule:
+    __slots__ = ('name', 'category', 'name_masks', 'folder', 'formats', 'min_size', 'max_size',
+                 'header_checks', 'software')
+
+    def __init__(self, index, config, categories):
+        where = f"rule {index + 1}"
+        unknown = set(config) - KNOWN_KEYS
+        if unknown:
+            raise RuleError(f"{where}: unknown keys {', '.join(sorted(unknown))}")
+        self.category = config.get('category')
+        if self.category not in categories:
+            raise RuleError(f"{where}: unknown category {self.category!r}")
+        self.name = config.get('name') or f"{index + 1}:{self.category}"
+        # One bit mask of name conditions per key; each needs one set bit
+        self.name_masks = ()
+        self.folder = (re.compile('|'.join(fnmatch.translate(g.strip('/')) for g in _as_list(config['folder'])),
+                                  re.IGNORECASE) if 'folder' in config else None)
+        self.formats = ({FORMAT_ALIASES.get(f.lower(), f.lower()) for f in _as_list(config['format'])}
+                        if 'format' in config else None)
+        self.min_size = _size(config.get('min_size', 0), where)
+        self.max_size = _size(config.get('max_size', 0), where)
+        self.software = ([re.compile(fnmatch.translate(g), re.IGNORECASE) for g in _as_list(config['software'])]
+                         if 'software' in config else None)
+
+        # (low, high) bounds on width and height; 0 means unbounded
+        bounds = [config.get('min_width', 0), config.get('max_width', 0),
+                  config.get('min_height', 0), config.get('max_height', 0)]
+        if 'dims' in config:
+            width, _, height = str(config['dims']).lower().partition('x')
+            if not (width.isdigit() and height.isdigit()):
+                raise RuleError(f"{where}: bad dims {config['dims']!r} (use WxH)")
+            bounds = [int(width), int(width), int(height), int(height)]
+        orientation = config.get('orientation')
+        if orientation is not None and orientation not in ORIENTATIONS:
+            raise RuleError(f"{where}: orientation must be one of {', '.join(ORIENTATIONS)}")
+        self.header_checks = (bounds, orientation) if any(bounds) or orientation else None
+
+    @property
+    def needs_header(self):
+        return self.header_checks is not None or self.software is not None
+
+    def matches_file(self, folder, size, fmt):
+        if self.folder is not None and not self.folder.match(folder):
+            return False
+        if self.formats is not None and fmt not in self.formats:
+            return False
+        return size >= self.min_size and (not self.max_size or size <= self.max_size)
+
+    def matches_header(self, header):
+        width, height, software = header
+        if self.header_checks is not None:
+            if width is None:
+                return False
+            (min_width, max_width, min_height, max_height), orientation = self.header_checks
+            if width < min_width or (max_width and width > max_width):
+                return False
+            if height < min_height or (max_height and height > max_height):
+                return False
+            if orientation and orientation != ('portrait' if height > width else
+                                               'landscape' if width > height else 'square'):
+                return False
+        if self.software is not None:
+            return software is not None and any(p.match(str(software)) for p in self.software)
+        return True
+
+
+class Router:
+    """Compiled rules plus hit counts; route() is the single dispatch pass"""
+
+    def __init__(self, rules_config, categories):
+        self.rules = []
+        self.conditions = {}     # (kind, text) -> bit
+        self.users = []          # bit index -> mask of the rules using that condition
+        self.always = 0          # rules without name conditions
+        self.tests = {'eq': {}, 'start': [], 'end': [], 'in': []}
+        self.apps = {}           # literal app name -> bits
+        self.app_globs = []      # (compiled glob, bit)
+        # Combined lookahead patterns over the file name (globs) and its stem (regexes)
+        self.regex_bits = {'name': [], 'stem': []}   # (group name, bit) per pattern
+        self.own_regexes = []    # (compiled regex with groups of its own, bit)
+        patterns = {'name': [], 'stem': []}
+        for index, config in enumerate(rules_config or ()):
+            if not isinstance(config, dict):
+                raise RuleError(f"rule {index + 1}: expected an object")
+            rule = Rule(index, config, categories)
+            masks = []
+            if 'filename' in config:
+                masks.append(self._conditions(index, [('glob', g.lower()) for g in _as_list(config['filename'])],
+                                              patterns))
+            if 'regex' in config:
+                try:
+                    re.compile(config['regex'])
+                except re.error as e:
+                    raise RuleError(f"rule {index + 1}: bad regex: {e}") from None
+                masks.append(self._conditions(index, [('regex', config['regex'])], patterns))
+            if 'app' in config:
+                masks.append(self._conditions(index, [('app', g.lower()) for g in _as_list(config['app'])],
+                                              patterns))
+            rule.name_masks = tuple(masks)
+            if not masks:
+                self.always |= 1 << index
+            self.rules.append(rule)
+        # One match sets the group of every regex condition that holds
+        try:
+            self.names, self.stems = (re.compile(''.join(patterns[part]), re.IGNORECASE | re.DOTALL)
+                                      if patterns[part] else None for part in ('name', 'stem'))
+        except re.error as e:
+            raise RuleError(f"can't combine the name conditions: {e}") from None
+        self.hits = {rule.name: 0 for rule in self.rules}
+        self.misses = 0
+
+    def _conditions(self, rule_index, conditions, patterns):
+        """Register name conditions for a rule; returns their combined bit mask"""
+        mask = 0
+        for condition in conditions:
+            bit = self.conditions.get(condition)
+            if bit is None:
+                bit = self.conditions[condition] = len(self.users)
+                self.users.append(0)
+                self._compile(condition, bit, patterns)
+            self.users[bit] |= 1 << rule_index
+            mask |= 1 << bit
+        return mask
+
+    def _compile(self, condition, bit, patterns):
+        kind, text = condition
+        if kind == 'app':
+            if not any(c in text for c in '*?['):
+                self.apps[text] = self.apps.get(text, 0) | 1 << bit
+            else:
+                self.app_globs.append((re.compile(fnmatch.translate(text)), bit))
+            return
+        if kind == 'glob':
+            test = _literal_test(text)
+            if test is not None:
+                how, literal = test
+                if how == 'eq':
+                    self.tests['eq'][literal] = self.tests['eq'].get(literal, 0) | 1 << bit
+                else:
+                    self.tests[how].append((literal, 1 << bit))
+                return
+            part, body = 'name', rf'(?={fnmatch.translate(text)})'
+        else:
+            compiled = re.compile(text)
+            if compiled.groups or compiled.flags != PLAIN_FLAGS:
+                self.own_regexes.append((re.compile(text, re.IGNORECASE | re.DOTALL), 1 << bit))
+                return
+            part, body = 'stem', rf'(?=.*?(?:{text}))'
+        patterns[part].append(f'(?:(?P<c{bit}>{body}))?')
+        self.regex_bits[part].append((f"c{bit}", 1 << bit))
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    def name_bits(self, filename):
+        """Mask of the name conditions a file name meets"""
+        lower = filename.lower()
+        bits = self.tests['eq'].get(lower, 0)
+        for literal, bit in self.tests['start']:
+            if lower.startswith(literal):
+                bits |= bit
+        for literal, bit in self.tests['end']:
+            if lower.endswith(literal):
+                bits |= bit
+        for literal, bit in self.tests['in']:
+            if literal in lower:
+                bits |= bit
+        stem = os.path.splitext(filename)[0]
+        for part, pattern, text in (('name', self.names, filename), ('stem', self.stems, stem)):
+            if pattern is not None:
+                matched = pattern.match(text)
+                for group, bit in self.regex_bits[part]:
+                    if matched.group(group) is not None:
+                        bits |= bit
+        for pattern, bit in self.own_regexes:
+            if pattern.search(stem):
+                bits |= bit
+        if self.apps or self.app_globs:
+            app = APP_NAME.match(filename)
+            if app:
+                app = app.group(1).lower()
+                bits |= self.apps.get(app, 0)
+                for pattern, bit in self.app_globs:
+                    if pattern.match(app):
+                        bits |= 1 << bit
+        return bits
+
+    def match(self, root, entry):
+        """The first rule that matches a ScanEntry, or None"""
+        folder, filename = os.path.split(entry.name)
+        folder = folder.replace(os.sep, '/')
+        bits = self.name_bits(filename)
+        # Rules that use a condition this name meets, plus those without any
+        candidates = self.always
+        remaining = bits
+        while remaining:
+            low = remaining & -remaining
+            candidates |= self.users[low.bit_length() - 1]
+            remaining ^= low
+        header = None
+        while candidates:
+            low = candidates & -candidates
+            candidates ^= low
+            rule = self.rules[low.bit_length() - 1]
+            if not all(bits & mask for mask in rule.name_masks):
+                continue
+            if not rule.matches_file(folder, entry.size, entry.format):
+                continue
+            if rule.needs_header:
+                if header is None:
+                    header = read_header(os.path.join(root, entry.name))
+                if not rule.matches_header(header):
+                    continue
+            return rule
+        return None
+
+    def route(self, root, entries):
+        """Split ScanEntry objects into ({category: [(name, rule name)]}, [unmatched names]).
+
+        Input order is kept within each category.
+        """
+        routed, unmatched = {}, []
+        with metrics.timer('rules', rules=len(self.rules)) as timer:
+            for entry in entries:
+                rule = self.match(root, entry)
+                if rule is None:
+                    unmatched.append(entry.name)
+                    self.misses += 1
+                    continue
+                routed.setdefault(rule.category, []).append((entry.name, rule.name))
+                self.hits[rule.name] += 1
+                metrics.count(f"rules.{rule.name}")
+            timer.annotate(files=len(unmatched) + sum(map(len, routed.values())))
+        return routed, unmatched
+
+    def summary(self):
+        """One line of hit counts, e.g. 'tickets 12, chats 3, 40 unmatched'"""
+        hits = [f"{name} {count}" for name, count in self.hits.items() if count]
+        return ', '.join(hits + [f"{self.misses} unmatched"])
@@ -0,0 +1,227 @@
+"""Recursive, filtered, streaming image scanner.
+
+Directories are listed with os.scandir on a thread pool, and each listing's
+files are identified in chunks on the same pool. Results come out of a
+generator in a fixed order: a folder's own files (sorted by name), then each
+subfolder the same way, like `find`. A flat folder therefore comes out
+exactly sorted, and on a deep year/month tree the first files can be
+previewed or sorted while the rest is still being walked: subfolders are
+listed in the background while their parent's files are consumed.
+
+Files are recognized by their first bytes, not their extension: a PNG saved
+as .jpg is still found, and a text file called .png is not.
+"""
+import fnmatch
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from metrics import metrics
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp', '.tif', '.tiff')
+
+# Leading bytes of the formats Pillow opens without plugins
+SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'II*\x00', 'tiff'),
+    (b'MM\x00*', 'tiff'),
+)
+# Sizes of the BMP info headers Pillow understands; 'BM' alone is too weak
+BMP_HEADER_SIZES = (12, 40, 52, 56, 64, 108, 124)
+SNIFF_BYTES = 32
+
+EXTENSION_FORMATS = {'.png': 'png', '.jpg': 'jpeg', '.jpeg': 'jpeg', '.gif': 'gif', '.bmp': 'bmp',
+                     '.webp': 'webp', '.tif': 'tiff', '.tiff': 'tiff'}
+
+# Files identified per pool task
+CHUNK_SIZE = 256
+DEFAULT_WORKERS = 8
+
+
+def format_of(head):
+    """Image format name for a file's first bytes, or None"""
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    if head[:2] == b'BM' and int.from_bytes(head[14:18], 'little') in BMP_HEADER_SIZES:
+        return 'bmp'
+    for signature, fmt in SIGNATURES:
+        if head.startswith(signature):
+            return fmt
+    return None
+
+
+def sniff_format(path):
+    """Image format of the file at path by its first bytes, or None"""
+    # Raw os calls: a buffered open() costs more than the read itself here
+    try:
+        fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    except OSError:
+        return None
+    try:
+        return format_of(os.read(fd, SNIFF_BYTES))
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+
+
+def read_dimensions(path):
+    """(width, height) from the image header, without decoding pixels"""
+    try:
+        with Image.open(path) as img:
+            return img.size
+    except Exception:
+        return None
+
+
+def _compile_globs(patterns):
+    if not patterns:
+        return None
+    return re.compile('|'.join(fnmatch.translate(pattern) for pattern in patterns), re.IGNORECASE)
+
+
+class ScanFilter:
+    """Which files a scan keeps. Every limit left at 0 or None is off.
+
+    Globs are matched (case-insensitively) against the path relative to the
+    scanned folder, with '/' separators, and against the bare name, so
+    '*.png' and '2023/*' both work. An excluded folder is not descended
+    into. since/until are mtime bounds in epoch seconds.
+    """
+
+    def __init__(self, include=(), exclude=(), min_size=0, max_size=0, since=None, until=None,
+                 min_width=0, min_height=0, max_width=0, max_height=0, include_hidden=False):
+        self.include = _compile_globs(include)
+        self.exclude = _compile_globs(exclude)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.since = since
+        self.until = until
+        self.min_width = min_width
+        self.min_height = min_height
+        self.max_width = max_width
+        self.max_height = max_height
+        self.include_hidden = include_hidden
+
+    @property
+    def needs_dimensions(self):
+        return bool(self.min_width or self.min_height or self.max_width or self.max_height)
+
+    def wants_dir(self, relative, name):
+        return not (self.exclude and (self.exclude.match(relative) or self.exclude.match(name)))
+
+    def wants_name(self, relative, name):
+        if self.include and not (self.include.match(relative) or self.include.match(name)):
+            return False
+        return self.wants_dir(relative, name)
+
+    def wants_stat(self, size, mtime):
+        if size < self.min_size or (self.max_size and size > self.max_size):
+            return False
+        if self.since is not None and mtime < self.since:
+            return False
+        return self.until is None or mtime < self.until
+
+    def wants_dimensions(self, width, height):
+        return (width >= self.min_width and height >= self.min_height
+                and (not self.max_width or width <= self.max_width)
+                and (not self.max_height or height <= self.max_height))
+
+
+class ScanEntry:
+    """One image found by scan_tree; name is relative to the scanned folder"""
+    __slots__ = ('name', 'path', 'size', 'mtime_ns', 'format')
+
+    def __init__(self, name, path, size, mtime_ns, format):
+        self.name = name
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.format = format
+
+
+def _list_dir(root, relative, scan_filter, skip=()):
+    """Pool task: (candidate files, subfolders) of one folder, each sorted"""
+    files, folders = [], []
+    with metrics.timer('scan.list'):
+        try:
+            with os.scandir(os.path.join(root, relative) if relative else root) as entries:
+                for entry in entries:
+                    name = entry.name
+                    if name.startswith('.') and not scan_filter.include_hidden:
+                        continue
+                    child = f"{relative}/{name}" if relative else name
+                    try:
+                        # Symlinked folders are not followed, so loops can't happen
+                        if entry.is_dir(follow_symlinks=False):
+                            if child not in skip and scan_filter.wants_dir(child, name):
+                                folders.append(child)
+                            continue
+                        if not entry.is_file() or not scan_filter.wants_name(child, name):
+                            continue
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    if scan_filter.wants_stat(st.st_size, st.st_mtime):
+                        files.append((child, entry.path, st.st_size, st.st_mtime_ns))
+        except OSError as e:
+            print(f"⚠️ Can't read folder {relative or root}: {e}")
+    files.sort()
+    folders.sort()
+    return files, folders
+
+
+def _identify(files, scan_filter, sniff):
+    """Pool task: ScanEntry for each candidate that really is a wanted image"""
+    found = []
+    needs_dimensions = scan_filter.needs_dimensions
+    with metrics.timer('scan.identify', files=len(files)):
+        for relative, path, size, mtime_ns in files:
+            if sniff:
+                fmt = sniff_format(path)
+            else:
+                fmt = EXTENSION_FORMATS.get(os.path.splitext(relative)[1].lower())
+            if fmt is None:
+                continue
+            if needs_dimensions:
+                dimensions = read_dimensions(path)
+                if dimensions is None or not scan_filter.wants_dimensions(*dimensions):
+                    continue
+            found.append(ScanEntry(relative.replace('/', os.sep), path, size, mtime_ns, fmt))
+    return found
+
+
+def scan_tree(root, recursive=True, scan_filter=None, sniff=True, workers=DEFAULT_WORKERS, skip=()):
+    """Yield a ScanEntry for every image under root, as soon as it is identified.
+
+    Without sniff only files with a known image extension are considered.
+    Subfolders in skip (relative to root, with /) are not entered.
+    Closing the generator early stops the walk.
+    """
+    scan_filter = scan_filter or ScanFilter()
+    pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='scan')
+
+    def walk(listing):
+        files, folders = listing.result()
+        if not sniff:
+            files = [file for file in files if file[0].lower().endswith(IMAGE_EXTENSIONS)]
+        # Everything below this folder is queued before its files are waited on
+        chunks = [pool.submit(_identify, files[start:start + CHUNK_SIZE], scan_filter, sniff)
+                  for start in range(0, len(files), CHUNK_SIZE)]
+        listings = [pool.submit(_list_dir, root, folder, scan_filter, skip) for folder in folders] if recursive else []
+        for chunk in chunks:
+            entries = chunk.result()
+            metrics.count('scan.files', len(entries))
+            yield from entries
+        for listing in listings:
+            yield from walk(listing)
+
+    try:
+        yield from walk(pool.submit(_list_dir, root, '', scan_filter, skip))
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
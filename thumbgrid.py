@@ -0,0 +1,286 @@
+"""Virtualized thumbnail grid for the preview area.
+
+Only the rows that fit on screen exist as canvas items, and only their
+thumbnails are held as PhotoImages. Scrolling recycles the same cells for
+new files, so a folder of 100k screenshots costs the same as one of 20.
+Thumbnails are requested asynchronously for whatever is on screen and
+filled in with set_thumbnail() as they arrive.
+
+Which files are selected lives in SelectionModel, not in the widgets, so
+it survives cells being reused. Click toggles one file, Shift+click selects
+everything from the last clicked file to this one.
+"""
+import tkinter as tk
+
+from PIL import ImageTk
+
+CELL_WIDTH = 166
+CELL_HEIGHT = 196
+THUMB_SIZE = 150
+SCROLL_UNIT = 40
+SHIFT_MASK = 0x0001
+
+
+class SelectionModel:
+    """Set of selected item indices, independent of any widget"""
+
+    def __init__(self):
+        self.selected = set()
+
+    def __len__(self):
+        return len(self.selected)
+
+    def __contains__(self, index):
+        return index in self.selected
+
+    def toggle(self, index):
+        if index in self.selected:
+            self.selected.discard(index)
+        else:
+            self.selected.add(index)
+
+    def select_range(self, first, last):
+        """Add every index from first to last, inclusive, in either order"""
+        if first > last:
+            first, last = last, first
+        self.selected.update(range(first, last + 1))
+
+    def select_all(self, count):
+        self.selected = set(range(count))
+
+    def replace(self, indices):
+        self.selected = set(indices)
+
+    def clear(self):
+        self.selected.clear()
+
+    def indices(self):
+        return sorted(self.selected)
+
+
+class ThumbnailGrid(tk.Frame):
+    def __init__(self, parent, request_thumbnails, on_change=None, **kwargs):
+        """request_thumbnails(wanted, prefetch) asks for the thumbnails still
+        missing on screen, most urgent first, plus the next screenful to warm
+        up ahead of scrolling. Both are [(index, path), ...]; each call
+        replaces the previous one.
+
+        on_change() is called whenever the selection changes.
+        """
+        super().__init__(parent, **kwargs)
+        self.request_thumbnails = request_thumbnails
+        self.on_change = on_change
+
+        self.canvas = tk.Canvas(self, bg='white', highlightthickness=0)
+        self.scrollbar = tk.Scrollbar(self, orient='vertical', command=self.yview)
+        self.canvas.pack(side='left', fill='both', expand=True)
+        self.scrollbar.pack(side='right', fill='y')
+
+        self.items = []        # (filename, path) for every file in the folder
+        self.selection = SelectionModel()
+        self.anchor = None     # last clicked index, where Shift+click ranges start
+        self.offset = 0        # pixels scrolled from the top of the virtual grid
+        self.columns = 1
+        self.cells = []        # recycled canvas item groups
+        self.photos = {}       # index -> PhotoImage (None if unreadable), visible cells only
+        self.requested = ()
+
+        self.canvas.bind('<Configure>', lambda e: self.layout())
+        self.canvas.bind('<Button-1>', self._on_click)
+
+    # ---- data ---------------------------------------------------------
+
+    def set_items(self, items):
+        self.items = list(items)
+        self.selection.clear()
+        self.anchor = None
+        self.photos.clear()
+        self.requested = ()
+        self.offset = 0
+        for cell in self.cells:
+            cell['index'] = None
+        self.layout()
+
+    def extend_items(self, items):
+        """Append items (e.g. while a scan is still running), keeping the view"""
+        self.items.extend(items)
+        self.render(force=False)
+
+    def selected_items(self):
+        return [self.items[i] for i in self.selection.indices()]
+
+    def toggle_all(self):
+        """Select everything, or clear if everything is already selected"""
+        if self.items and len(self.selection) == len(self.items):
+            self.selection.clear()
+        else:
+            self.selection.select_all(len(self.items))
+        self.render(force=True)
+        self._changed()
+
+    def select(self, indices):
+        """Select exactly these item indices"""
+        self.selection.replace(indices)
+        self.render(force=True)
+        self._changed()
+
+    def clear_selection(self):
+        self.selection.clear()
+        self.render(force=True)
+        self._changed()
+
+    # ---- geometry -----------------------------------------------------
+
+    @property
+    def total_height(self):
+        rows = -(-len(self.items) // self.columns)
+        return rows * CELL_HEIGHT
+
+    def layout(self):
+        """Size the cell pool to the viewport, then draw"""
+        width = max(self.canvas.winfo_width(), CELL_WIDTH)
+        height = max(self.canvas.winfo_height(), CELL_HEIGHT)
+        self.columns = max(1, width // CELL_WIDTH)
+        visible_rows = height // CELL_HEIGHT + 2
+        wanted = visible_rows * self.columns
+
+        while len(self.cells) < wanted:
+            self.cells.append(self._make_cell())
+        while len(self.cells) > wanted:
+            cell = self.cells.pop()
+            self.canvas.delete(cell['tag'])
+
+        for cell in self.cells:
+            cell['index'] = None
+        self._clamp_offset()
+        self.render()
+
+    def _make_cell(self):
+        tag = f"cell{len(self.cells)}_{id(self)}"
+        c = self.canvas
+        return {
+            'tag': tag,
+            'index': None,
+            'frame': c.create_rectangle(0, 0, 0, 0, outline='#cccccc', tags=tag),
+            'image': c.create_image(0, 0, anchor='n', tags=tag),
+            'box': c.create_rectangle(0, 0, 0, 0, outline='#555555', fill='white', tags=tag),
+            'check': c.create_text(0, 0, text='', font=('Arial', 10, 'bold'), fill='#2e7d32', tags=tag),
+            'label': c.create_text(0, 0, anchor='n', width=THUMB_SIZE - 10, tags=tag),
+        }
+
+    def _clamp_offset(self):
+        max_offset = max(0, self.total_height - self.canvas.winfo_height())
+        self.offset = min(max(0, self.offset), max_offset)
+
+    # ---- drawing ------------------------------------------------------
+
+    def visible_range(self):
+        """(first, last) item indices currently backed by cells"""
+        first = (self.offset // CELL_HEIGHT) * self.columns
+        return first, min(len(self.items), first + len(self.cells))
+
+    def render(self, force=False):
+        c = self.canvas
+        first_row = self.offset // CELL_HEIGHT
+        shift = first_row * CELL_HEIGHT - self.offset
+        visible = set()
+
+        for k, cell in enumerate(self.cells):
+            row, col = divmod(k, self.columns)
+            index = (first_row + row) * self.columns + col
+            if index >= len(self.items):
+                c.itemconfigure(cell['tag'], state='hidden')
+                cell['index'] = None
+                continue
+
+            visible.add(index)
+            x = col * CELL_WIDTH + 4
+            y = shift + row * CELL_HEIGHT + 4
+            c.itemconfigure(cell['tag'], state='normal')
+            c.coords(cell['frame'], x, y, x + CELL_WIDTH - 8, y + CELL_HEIGHT - 8)
+            c.coords(cell['box'], x + 6, y + 6, x + 20, y + 20)
+            c.coords(cell['check'], x + 13, y + 13)
+            c.coords(cell['image'], x + CELL_WIDTH // 2 - 4, y + 24)
+            c.coords(cell['label'], x + CELL_WIDTH // 2 - 4, y + THUMB_SIZE + 28)
+
+            if cell['index'] != index or force:
+                filename, path = self.items[index]
+                label = filename[:15] + "..." if len(filename) > 15 else filename
+                c.itemconfigure(cell['label'], text=label)
+                c.itemconfigure(cell['check'], text='✓' if index in self.selection else '')
+                c.itemconfigure(cell['image'], image=self.photos.get(index) or '')
+                cell['index'] = index
+
+        # Drop PhotoImages of cells that scrolled out of view
+        for index in list(self.photos):
+            if index not in visible:
+                del self.photos[index]
+        self._update_scrollbar()
+        self._request_missing(visible)
+
+    def _request_missing(self, visible):
+        missing = tuple(sorted(i for i in visible if i not in self.photos))
+        if missing != self.requested:
+            self.requested = missing
+            start = max(visible) + 1 if visible else 0
+            ahead = range(start, min(len(self.items), start + len(self.cells)))
+            self.request_thumbnails([(i, self.items[i][1]) for i in missing],
+                                    [(i, self.items[i][1]) for i in ahead])
+
+    def set_thumbnail(self, index, img):
+        """Show a decoded thumbnail if its cell is still on screen"""
+        if index >= len(self.items):
+            return
+        for cell in self.cells:
+            if cell['index'] == index:
+                photo = self.photos[index] = ImageTk.PhotoImage(img) if img is not None else None
+                self.canvas.itemconfigure(cell['image'], image=photo or '')
+                break
+
+    def _update_scrollbar(self):
+        total = self.total_height
+        height = self.canvas.winfo_height()
+        if total <= height or total == 0:
+            self.scrollbar.set(0.0, 1.0)
+        else:
+            self.scrollbar.set(self.offset / total, (self.offset + height) / total)
+
+    # ---- scrolling and clicks -----------------------------------------
+
+    def yview(self, *args):
+        """Scrollbar command: ('moveto', fraction) or ('scroll', n, what)"""
+        if not args:
+            return
+        if args[0] == 'moveto':
+            self.offset = int(float(args[1]) * self.total_height)
+        elif args[0] == 'scroll':
+            step = SCROLL_UNIT if args[2] == 'units' else self.canvas.winfo_height()
+            self.offset += int(args[1]) * step
+        self._clamp_offset()
+        self.render()
+
+    def scroll_units(self, units):
+        self.yview('scroll', units, 'units')
+
+    def _on_click(self, event):
+        row = (self.offset + event.y) // CELL_HEIGHT
+        col = event.x // CELL_WIDTH
+        if col >= self.columns:
+            return
+        index = row * self.columns + col
+        if index >= len(self.items):
+            return
+        if event.state & SHIFT_MASK and self.anchor is not None:
+            self.selection.select_range(self.anchor, index)
+            self.render(force=True)
+        else:
+            self.selection.toggle(index)
+            for cell in self.cells:
+                if cell['index'] == index:
+                    self.canvas.itemconfigure(cell['check'], text='✓' if index in self.selection else '')
+        self.anchor = index
+        self._changed()
+
+    def _changed(self):
+        if self.on_change:
+            self.on_change()
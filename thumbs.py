@@ -0,0 +1,253 @@
+"""Background thumbnail decoding for the preview grid.
+
+Decoding runs in a process pool so it uses every core and never blocks the
+Tk thread. Requests are served visible-first; scrolling re-prioritizes and
+switching folders drops everything that was still queued, and while paused
+no new decodes start. Everything except the futures' done-callbacks runs on
+the Tk thread, driven by pump().
+
+Finished thumbnails are kept in a persistent ThumbnailCache keyed by path,
+file size and mtime, so reopening a folder skips decoding altogether.
+"""
+import heapq
+import io
+import os
+import queue
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from PIL import Image
+
+from metrics import metrics
+
+
+def decode_thumbnail(path, size):
+    """Worker side: (encoded thumbnail bytes, file size, mtime_ns), or None.
+
+    JPEGs are decoded straight at a reduced scale with draft(); other formats
+    get a cheap integer reduce() before the final resample. The thumbnail is
+    re-encoded (JPEG, or PNG when it has transparency) so it is small
+    enough to cache and cheap to pass back from the worker process.
+    """
+    try:
+        st = os.stat(path)
+        with Image.open(path) as img:
+            if img.format == 'JPEG':
+                img.draft('RGB', (size, size))
+            img.load()
+            factor = max(img.size) // (size * 2)
+            if factor >= 2:
+                # reduce() only takes 8-bit and 32-bit modes
+                if img.mode == 'P':
+                    img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+                elif img.mode == '1' or img.mode.startswith('I;'):
+                    img = img.convert('L')
+                img = img.reduce(factor)
+            img.thumbnail((size, size))
+            buffer = io.BytesIO()
+            if 'transparency' in img.info or 'A' in img.getbands():
+                img.convert('RGBA').save(buffer, 'PNG')
+            else:
+                img.convert('RGB' if img.mode != 'L' else 'L').save(buffer, 'JPEG', quality=85)
+            return buffer.getvalue(), st.st_size, st.st_mtime_ns
+    except Exception as e:
+        print(f"Error loading {os.path.basename(path)}: {e}")
+        return None
+
+
+def to_image(data):
+    img = Image.open(io.BytesIO(data))
+    img.load()
+    return img
+
+
+class ThumbnailCache:
+    """SQLite store of encoded thumbnails, LRU-evicted under a size cap.
+
+    Only used from the Tk thread.
+    """
+
+    def __init__(self, path, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS thumbs (
+                               path TEXT NOT NULL,
+                               thumb_size INTEGER NOT NULL,
+                               file_size INTEGER NOT NULL,
+                               mtime_ns INTEGER NOT NULL,
+                               accessed REAL NOT NULL,
+                               data BLOB NOT NULL,
+                               PRIMARY KEY (path, thumb_size))''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS thumbs_accessed ON thumbs (accessed)')
+        self.db.commit()
+        self.total_bytes = self.db.execute('SELECT COALESCE(SUM(LENGTH(data)), 0) FROM thumbs').fetchone()[0]
+        self.touched = []
+
+    def get(self, path, thumb_size):
+        """Encoded thumbnail if the file is unchanged since it was cached"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        row = self.db.execute('SELECT file_size, mtime_ns, data FROM thumbs WHERE path=? AND thumb_size=?',
+                              (path, thumb_size)).fetchone()
+        if row is None or row[0] != st.st_size or row[1] != st.st_mtime_ns:
+            return None
+        self.touched.append((time.time(), path, thumb_size))
+        return row[2]
+
+    def contains(self, path, thumb_size):
+        """Cheap existence check that doesn't stat the file"""
+        return self.db.execute('SELECT 1 FROM thumbs WHERE path=? AND thumb_size=?',
+                               (path, thumb_size)).fetchone() is not None
+
+    def put(self, path, thumb_size, file_size, mtime_ns, data):
+        old = self.db.execute('SELECT LENGTH(data) FROM thumbs WHERE path=? AND thumb_size=?',
+                              (path, thumb_size)).fetchone()
+        self.db.execute('INSERT OR REPLACE INTO thumbs VALUES (?, ?, ?, ?, ?, ?)',
+                        (path, thumb_size, file_size, mtime_ns, time.time(), data))
+        self.total_bytes += len(data) - (old[0] if old else 0)
+
+    def flush(self):
+        """Commit pending writes and access times, evicting if over the cap"""
+        if self.touched:
+            self.db.executemany('UPDATE thumbs SET accessed=? WHERE path=? AND thumb_size=?', self.touched)
+            self.touched = []
+        if self.total_bytes > self.max_bytes:
+            self.evict(int(self.max_bytes * 0.9))
+        self.db.commit()
+
+    def evict(self, target_bytes):
+        rows = self.db.execute('SELECT rowid, LENGTH(data) FROM thumbs ORDER BY accessed')
+        doomed = []
+        for rowid, size in rows:
+            if self.total_bytes <= target_bytes:
+                break
+            doomed.append((rowid,))
+            self.total_bytes -= size
+        self.db.executemany('DELETE FROM thumbs WHERE rowid=?', doomed)
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+
+class ThumbnailLoader:
+    def __init__(self, size, on_ready, workers=None, cache=None):
+        """on_ready(index, path, pil_image_or_None) is called on the Tk thread"""
+        self.size = size
+        self.on_ready = on_ready
+        self.cache = cache
+        self.workers = workers or max(1, (os.cpu_count() or 2) - 1)
+        self.max_in_flight = self.workers * 2
+        self.pool = None
+        self.generation = 0
+        self.heap = []          # (priority, index, path)
+        self.queued = set()     # indices in the heap
+        self.in_flight = {}     # index -> future
+        self.done = queue.Queue()
+        self.paused = False
+
+    def _ensure_pool(self):
+        if self.pool is None:
+            try:
+                self.pool = ProcessPoolExecutor(max_workers=self.workers)
+            except (OSError, NotImplementedError):
+                # No multiprocessing available (e.g. some frozen builds)
+                self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        return self.pool
+
+    def reset(self):
+        """New folder: forget every outstanding request"""
+        self.generation += 1
+        self.heap.clear()
+        self.queued.clear()
+        for future in self.in_flight.values():
+            future.cancel()
+        self.in_flight.clear()
+
+    def request(self, wanted, prefetch=()):
+        """Replace the queue with wanted [(index, path), ...], most urgent first.
+
+        prefetch items are only decoded into the cache, after everything
+        wanted, so scrolling onto them later is a cache hit.
+        """
+        wanted_indices = {index for index, _ in wanted} | {index for index, _ in prefetch}
+        for index, future in list(self.in_flight.items()):
+            if index not in wanted_indices and future.cancel():
+                del self.in_flight[index]
+        self.heap = []
+        for priority, (index, path) in enumerate(wanted):
+            if index in self.in_flight:
+                continue
+            data = self.cache.get(path, self.size) if self.cache else None
+            if data is not None:
+                metrics.count('thumbnail.cache_hits')
+                self.done.put((self.generation, index, path, (data, None, None)))
+            else:
+                self.heap.append((priority, index, path))
+        if self.cache:
+            for priority, (index, path) in enumerate(prefetch, len(wanted)):
+                if index not in self.in_flight and not self.cache.contains(path, self.size):
+                    self.heap.append((priority, index, path))
+        heapq.heapify(self.heap)
+        self.queued = {index for _, index, _ in self.heap}
+        self.pump()
+
+    def pump(self):
+        """Deliver finished thumbnails and start more work. Call from Tk."""
+        delivered = False
+        while True:
+            try:
+                generation, index, path, decoded = self.done.get_nowait()
+            except queue.Empty:
+                break
+            delivered = True
+            if decoded is None:
+                metrics.count('thumbnail.errors')
+            if decoded and decoded[1] is not None and self.cache:
+                data, file_size, mtime_ns = decoded
+                self.cache.put(path, self.size, file_size, mtime_ns, data)
+            if generation != self.generation:
+                continue
+            self.in_flight.pop(index, None)
+            self.on_ready(index, path, to_image(decoded[0]) if decoded else None)
+        if delivered and self.cache:
+            self.cache.flush()
+
+        while self.heap and len(self.in_flight) < self.max_in_flight and not self.paused:
+            _, index, path = heapq.heappop(self.heap)
+            self.queued.discard(index)
+            future = self._ensure_pool().submit(metrics.wrap(decode_thumbnail), path, self.size)
+            future.add_done_callback(self._finished(self.generation, index, path))
+            self.in_flight[index] = future
+
+    def _finished(self, generation, index, path):
+        def callback(future):
+            # Runs on a pool thread: only hand the result over
+            if future.cancelled():
+                return
+            try:
+                decoded = metrics.unwrap('thumbnail', future.result())
+            except Exception as e:
+                print(f"Error loading {os.path.basename(path)}: {e}")
+                decoded = None
+            self.done.put((generation, index, path, decoded))
+        return callback
+
+    @property
+    def busy(self):
+        return bool(self.in_flight or (self.heap and not self.paused))
+
+    def shutdown(self):
+        self.reset()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+        if self.cache:
+            self.cache.close()
+            self.cache = None
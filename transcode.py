@@ -0,0 +1,291 @@
+"""Output stage: what a sorted file is written as.
+
+keep   the original bytes, copied, moved or linked per the transfer mode,
+       named with the extension of the format they really are
+png    re-encoded as an optimized PNG (pixel-exact)
+webp   WebP, lossless or lossy at a quality
+jpeg   JPEG at a capped quality
+
+Encoding is CPU bound, so it runs in a process pool. Each file is encoded
+into a hidden temp file inside its destination folder and only renamed to
+its numbered name once that worked, so a failed encode never costs a
+number. Animated images are always kept as they are, and with
+only_if_smaller so is any image the encoder can't make smaller.
+
+Metadata is either kept (EXIF, ICC profile, PNG text, DPI), cut down to the
+color profile, or stripped. Both of the latter bake the EXIF orientation
+into the pixels first so photos don't end up sideways.
+"""
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+from PIL import Image, ImageOps, PngImagePlugin
+
+from metrics import metrics
+from scanner import EXTENSION_FORMATS, sniff_format
+
+OUTPUT_FORMATS = ('keep', 'png', 'webp', 'jpeg')
+METADATA_MODES = ('keep', 'color', 'strip')
+
+FORMAT_EXTENSIONS = {'png': '.png', 'jpeg': '.jpg', 'webp': '.webp', 'gif': '.gif', 'bmp': '.bmp',
+                     'tiff': '.tiff'}
+
+# PNG text chunks Pillow writes on its own or that are not text
+PNG_SKIP_KEYS = {'dpi', 'icc_profile', 'exif', 'transparency', 'gamma', 'aspect', 'interlace'}
+
+
+def extension_for(fmt, path=''):
+    """File extension for an image format, falling back to path's own"""
+    if fmt in FORMAT_EXTENSIONS:
+        return FORMAT_EXTENSIONS[fmt]
+    return os.path.splitext(path)[1].lower() or '.png'
+
+
+def format_for(path):
+    """Image format a file name's extension stands for, or None"""
+    return EXTENSION_FORMATS.get(os.path.splitext(path)[1].lower())
+
+
+def _metadata(img, metadata):
+    """Image (transposed unless metadata is kept) plus save() keyword arguments"""
+    info = img.info
+    if metadata == 'keep':
+        params = {'exif': info['exif']} if info.get('exif') else {}
+    else:
+        img = ImageOps.exif_transpose(img)
+        params = {}
+    if metadata != 'strip' and info.get('icc_profile'):
+        params['icc_profile'] = info['icc_profile']
+    if metadata == 'keep':
+        if 'dpi' in info:
+            params['dpi'] = info['dpi']
+        text = {key: value for key, value in info.items()
+                if key not in PNG_SKIP_KEYS and isinstance(value, str)}
+        if text:
+            params['pnginfo'] = PngImagePlugin.PngInfo()
+            for key, value in text.items():
+                params['pnginfo'].add_text(key, value)
+    return img, params
+
+
+def _has_alpha(img):
+    if img.mode in ('RGBA', 'LA', 'PA'):
+        return img.getchannel('A').getextrema()[0] < 255
+    return img.mode == 'P' and 'transparency' in img.info
+
+
+def _lossless_mode(img):
+    """Smallest mode that still holds every pixel exactly (PNG/WebP lossless)"""
+    if img.mode in ('RGBA', 'LA') and not _has_alpha(img):
+        img = img.convert('RGB' if img.mode == 'RGBA' else 'L')
+    colors = img.getcolors(256) if img.mode == 'RGB' else None
+    if colors is not None:
+        # Flat UI screenshots often use few colors: a palette of exactly those is exact
+        palette = Image.new('P', (1, 1))
+        palette.putpalette([channel for _, color in colors for channel in color])
+        img = img.quantize(palette=palette, dither=Image.Dither.NONE)
+    return img
+
+
+def encode_image(src_path, dst_path, fmt, quality=85, lossless=True, metadata='keep', only_if_smaller=True,
+                 effort=4):
+    """Worker side: write src_path re-encoded as fmt to dst_path.
+
+    Returns (format written, original bytes, written bytes). The format is
+    None when nothing was written: the image is animated, or the encode
+    did not come out smaller and only_if_smaller is set.
+    """
+    original_bytes = os.path.getsize(src_path)
+    with Image.open(src_path) as img:
+        if getattr(img, 'n_frames', 1) > 1:
+            return None, original_bytes, original_bytes
+        img.load()
+        img, params = _metadata(img, metadata)
+        if fmt == 'png':
+            if img.mode not in ('1', 'L', 'LA', 'P', 'RGB', 'RGBA', 'I', 'I;16'):
+                img = img.convert('RGBA' if _has_alpha(img) else 'RGB')
+            img = _lossless_mode(img)
+            params.update(optimize=True)
+        elif fmt == 'webp':
+            params.pop('pnginfo', None)
+            if img.mode not in ('RGB', 'RGBA'):
+                img = img.convert('RGBA' if _has_alpha(img) else 'RGB')
+            elif img.mode == 'RGBA' and not _has_alpha(img):
+                img = img.convert('RGB')
+            # For lossless WebP quality is the effort spent compressing
+            params.update(lossless=lossless, quality=100 if lossless else quality, method=effort)
+        elif fmt == 'jpeg':
+            params.pop('pnginfo', None)
+            if _has_alpha(img):
+                flat = Image.new('RGB', img.size, 'white')
+                flat.paste(img.convert('RGBA'), mask=img.convert('RGBA').getchannel('A'))
+                img = flat
+            elif img.mode not in ('RGB', 'L', 'CMYK'):
+                img = img.convert('RGB')
+            params.update(quality=quality, optimize=True)
+        elif fmt in FORMAT_EXTENSIONS:
+            # Only undo writes these, to put a moved original back
+            params = {}
+        else:
+            raise ValueError(f"unknown output format '{fmt}'")
+        img.save(dst_path, fmt.upper(), **params)
+
+    written_bytes = os.path.getsize(dst_path)
+    if only_if_smaller and written_bytes >= original_bytes:
+        os.unlink(dst_path)
+        return None, original_bytes, original_bytes
+    return fmt, original_bytes, written_bytes
+
+
+def _encode_into(src_path, folder, fmt, options):
+    """Worker side: encode_image into a fresh temp file in folder.
+
+    Returns (temp path or None if the original is kept, output extension, encode_image's result).
+    """
+    fd, temp_path = tempfile.mkstemp(prefix='.encoding-', suffix='.tmp', dir=folder)
+    os.close(fd)
+    try:
+        result = encode_image(src_path, temp_path, fmt, **options)
+        if result[0]:
+            shutil.copystat(src_path, temp_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+    if result[0] is None:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        # Kept as it is: it still gets the extension of what it really is
+        return None, extension_for(sniff_format(src_path), src_path), result
+    return temp_path, FORMAT_EXTENSIONS[result[0]], result
+
+
+class Encoded:
+    """A finished output: temp_path is None when the original is to be used as is"""
+    __slots__ = ('src_path', 'temp_path', 'extension', 'original_bytes', 'written_bytes')
+
+    def __init__(self, src_path, temp_path, extension, original_bytes=0, written_bytes=0):
+        self.src_path = src_path
+        self.temp_path = temp_path
+        self.extension = extension
+        self.original_bytes = original_bytes
+        self.written_bytes = written_bytes
+
+    def discard(self):
+        if self.temp_path is not None:
+            try:
+                os.unlink(self.temp_path)
+            except OSError:
+                pass
+            self.temp_path = None
+
+
+class Transcoder:
+    """Produces outputs per the "output" settings, encoding on a process pool"""
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.pool = None
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.encoded = 0
+        self.kept = 0
+        self.original_bytes = 0
+        self.written_bytes = 0
+
+    def summary(self):
+        """One-line report of what encoding saved, e.g. for the end of a sort"""
+        with self.lock:
+            if not self.encoded + self.kept:
+                return "Output: nothing encoded"
+            saved = self.original_bytes - self.written_bytes
+            pct = saved / self.original_bytes if self.original_bytes else 0.0
+            return (f"Output: {self.encoded} re-encoded as {self.settings['format']}, {self.kept} kept as they were; "
+                    f"{self.original_bytes / 1e6:.1f} MB → {self.written_bytes / 1e6:.1f} MB ({pct:.0%} saved)")
+
+    @property
+    def active(self):
+        """True if files are re-encoded rather than passed through"""
+        return self.settings['format'] != 'keep'
+
+    @property
+    def workers(self):
+        return self.settings['workers'] or os.cpu_count() or 1
+
+    def options(self):
+        settings = self.settings
+        return {'quality': settings['quality'], 'lossless': settings['lossless'],
+                'metadata': settings['metadata'], 'only_if_smaller': settings['only_if_smaller'],
+                'effort': settings['effort']}
+
+    def _ensure_pool(self):
+        if self.pool is None:
+            try:
+                self.pool = ProcessPoolExecutor(max_workers=self.workers)
+            except (OSError, NotImplementedError):
+                # No multiprocessing available (e.g. some frozen builds)
+                self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        return self.pool
+
+    def start(self, src_path, folder):
+        """Begin producing the output for src_path in folder; a Future of an Encoded.
+
+        Passing through only needs the real format, which is read right away.
+        """
+        if not self.active:
+            future = Future()
+            future.set_result(Encoded(src_path, None, extension_for(sniff_format(src_path), src_path)))
+            return future
+        outer = Future()
+        inner = self._ensure_pool().submit(metrics.wrap(_encode_into), src_path, folder,
+                                           self.settings['format'], self.options())
+
+        def done(inner):
+            if inner.cancelled():
+                outer.cancel()
+                outer.set_running_or_notify_cancel()
+                return
+            try:
+                temp_path, extension, (fmt, original_bytes, written_bytes) = metrics.unwrap('encode', inner.result())
+            except Exception as e:
+                outer.set_exception(e)
+                return
+            with self.lock:
+                self.original_bytes += original_bytes
+                self.written_bytes += written_bytes
+                if fmt:
+                    self.encoded += 1
+                else:
+                    self.kept += 1
+            metrics.count('output.original_bytes', original_bytes)
+            metrics.count('output.written_bytes', written_bytes)
+            metrics.count('output.encoded' if fmt else 'output.kept')
+            outer.set_result(Encoded(src_path, temp_path, extension, original_bytes, written_bytes))
+
+        inner.add_done_callback(done)
+        return outer
+
+    @staticmethod
+    def discard(pending):
+        """Remove the temp file of a started output that won't be placed, once it exists"""
+        def done(future):
+            if not future.cancelled() and future.exception() is None:
+                future.result().discard()
+        pending.add_done_callback(done)
+
+    def encode(self, src_path, dst_path, fmt=None, **overrides):
+        """Encode one file in this process (undo/redo), with the settings' options"""
+        options = self.options()
+        options.update(overrides)
+        with metrics.timer('encode'):
+            return encode_image(src_path, dst_path, fmt or self.settings['format'], **options)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
@@ -0,0 +1,118 @@
+"""Ways of getting a screenshot from the source into its sorted location.
+
+copy      duplicate the bytes (the original behaviour)
+move      os.replace on the same device, copy + delete across devices
+hardlink  a second name for the same inode, copy across devices
+reflink   copy-on-write clone where the filesystem supports it, else copy
+
+Cross-device copies go through copy_file, which lets the OS do the copy
+(sendfile/fcopyfile) or, when verification is requested, streams through
+large buffers while hashing so the destination can be checked.
+"""
+import errno
+import hashlib
+import os
+import shutil
+import sys
+
+MODES = ('copy', 'move', 'hardlink', 'reflink')
+
+BUFFER_SIZE = 8 * 1024 * 1024
+
+# ioctl request number for FICLONE on Linux (btrfs, xfs, bcachefs, ...)
+FICLONE = 0x40049409
+
+
+def same_device(src, dest_dir):
+    try:
+        return os.stat(src).st_dev == os.stat(dest_dir).st_dev
+    except OSError:
+        return False
+
+
+def reflink(src, dst):
+    """Clone src to dst sharing blocks; raises OSError if unsupported"""
+    if sys.platform.startswith('linux'):
+        import fcntl
+
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            except OSError:
+                fdst.close()
+                os.unlink(dst)
+                raise
+        shutil.copystat(src, dst)
+        return
+    if sys.platform == 'darwin':
+        import ctypes
+
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.clonefile(os.fsencode(src), os.fsencode(dst), 0) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), src)
+        return
+    raise OSError(errno.EOPNOTSUPP, "reflink not supported on this platform", src)
+
+
+def file_digest(path, buffer_size=BUFFER_SIZE):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(buffer_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def copy_file(src, dst, verify=False, buffer_size=BUFFER_SIZE):
+    """Copy data and metadata; with verify, compare SHA-256 of both sides"""
+    if not verify:
+        shutil.copy2(src, dst)
+        return None
+
+    digest = hashlib.sha256()
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        for chunk in iter(lambda: fsrc.read(buffer_size), b''):
+            digest.update(chunk)
+            fdst.write(chunk)
+    shutil.copystat(src, dst)
+    checksum = digest.hexdigest()
+    if file_digest(dst, buffer_size) != checksum:
+        os.unlink(dst)
+        raise OSError(errno.EIO, "checksum mismatch after copy", dst)
+    return checksum
+
+
+def transfer_file(src, dst, mode='copy', verify=False, buffer_size=BUFFER_SIZE):
+    """Put src at dst using mode; returns (method actually used, sha256).
+
+    sha256 is only known when a verified copy computed it, else None.
+
+    Modes that can't work here (different device, unsupported filesystem)
+    quietly fall back to a copy, plus deleting the source for 'move'.
+    """
+    if mode not in MODES:
+        raise ValueError(f"unknown transfer mode '{mode}'")
+    local = mode != 'copy' and same_device(src, os.path.dirname(dst) or '.')
+
+    if mode == 'move' and local:
+        os.replace(src, dst)
+        return 'move', None
+    if mode == 'hardlink' and local:
+        try:
+            if os.path.lexists(dst):
+                os.unlink(dst)
+            os.link(src, dst)
+            return 'hardlink', None
+        except OSError:
+            pass
+    if mode == 'reflink' and local:
+        try:
+            reflink(src, dst)
+            return 'reflink', None
+        except OSError:
+            pass
+
+    checksum = copy_file(src, dst, verify, buffer_size)
+    if mode == 'move':
+        os.unlink(src)
+    return 'copy', checksum
@@ -0,0 +1,200 @@
+"""Watch a source folder and sort new screenshots as they appear.
+
+Each poll takes a cheap os.scandir snapshot (inode, size, mtime) and diffs
+it against the previous one, so only entries that changed are looked at.
+A file is handed to the engine once it has stopped changing for `settle`
+seconds. A persistent ledger remembers what was already sorted, so a
+restart or a cron re-run only costs the new files.
+
+Files are picked like scan_tree picks them: with sniff, by their first
+bytes (only once they have settled, so each file is read once), else by
+extension; with recursive, subfolders are watched too.
+"""
+import itertools
+import os
+import sqlite3
+import threading
+import time
+
+from scanner import EXTENSION_FORMATS, IMAGE_EXTENSIONS, ScanEntry, ScanFilter, sniff_format
+
+
+def take_snapshot(folder, scan_filter=None, recursive=False, sniff=False, skip=()):
+    """{relative name: (inode, size, mtime_ns)} for every candidate file in folder.
+
+    Without sniff only image extensions are candidates; with it every file
+    is, and FolderWatcher sniffs the ones that settle. Subfolders in skip
+    (relative, with /) are not entered.
+    """
+    scan_filter = scan_filter or ScanFilter()
+    snapshot = {}
+    folders = ['']
+    while folders:
+        relative = folders.pop()
+        try:
+            entries = list(os.scandir(os.path.join(folder, relative) if relative else folder))
+        except OSError as e:
+            if not relative:
+                raise
+            print(f"⚠️ Can't read folder {relative}: {e}")
+            continue
+        for entry in entries:
+            name = entry.name
+            if name.startswith('.') and not scan_filter.include_hidden:
+                continue
+            child = f"{relative}/{name}" if relative else name
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive and child not in skip and scan_filter.wants_dir(child, name):
+                        folders.append(child)
+                    continue
+                if not sniff and not name.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                if not entry.is_file() or not scan_filter.wants_name(child, name):
+                    continue
+                st = entry.stat()
+            except OSError:
+                continue
+            if scan_filter.wants_stat(st.st_size, st.st_mtime):
+                snapshot[child.replace('/', os.sep)] = (st.st_ino, st.st_size, st.st_mtime_ns)
+    return snapshot
+
+
+def diff_snapshots(old, new):
+    """Names that are new in `new` or whose stat changed"""
+    return [name for name, stat in new.items() if old.get(name) != stat]
+
+
+class ProcessedLedger:
+    """SQLite record of files that were already sorted"""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS processed (
+                               folder TEXT NOT NULL,
+                               name TEXT NOT NULL,
+                               size INTEGER NOT NULL,
+                               mtime_ns INTEGER NOT NULL,
+                               processed REAL NOT NULL,
+                               PRIMARY KEY (folder, name, size, mtime_ns))''')
+        self.db.commit()
+        self.lock = threading.Lock()
+
+    def known(self, folder):
+        """Set of (name, size, mtime_ns) already processed from folder"""
+        with self.lock:
+            rows = self.db.execute('SELECT name, size, mtime_ns FROM processed WHERE folder=?',
+                                   (os.path.abspath(folder),))
+            return set(rows)
+
+    def mark(self, folder, entries):
+        """Record [(name, size, mtime_ns), ...] as processed"""
+        folder = os.path.abspath(folder)
+        now = time.time()
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO processed VALUES (?, ?, ?, ?, ?)',
+                                [(folder, name, size, mtime_ns, now) for name, size, mtime_ns in entries])
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class FolderWatcher:
+    """Incremental snapshot differ with a settle-time debounce"""
+
+    def __init__(self, folder, ledger, settle=3.0, scan_filter=None, recursive=False, sniff=False, skip=()):
+        self.folder = folder
+        self.ledger = ledger
+        self.settle = settle
+        self.scan_filter = scan_filter
+        self.recursive = recursive
+        self.sniff = sniff
+        self.skip = skip
+        # Image format of each file last returned by poll()
+        self.formats = {}
+        self.snapshot = {}
+        self.pending = {}     # name -> (inode, size, mtime_ns) waiting to settle
+        self.known = ledger.known(folder)
+
+    def poll(self):
+        """Return [(name, (inode, size, mtime_ns))] ready to be sorted"""
+        snapshot = take_snapshot(self.folder, self.scan_filter, self.recursive, self.sniff, self.skip)
+        self.formats = {}
+        for name in diff_snapshots(self.snapshot, snapshot):
+            _, size, mtime_ns = snapshot[name]
+            if (name, size, mtime_ns) not in self.known:
+                self.pending[name] = snapshot[name]
+        self.snapshot = snapshot
+
+        now_ns = time.time_ns()
+        settle_ns = int(self.settle * 1e9)
+        ready = []
+        for name, stat in list(self.pending.items()):
+            current = snapshot.get(name)
+            if current is None:
+                # Deleted or renamed before it settled
+                del self.pending[name]
+            elif current != stat:
+                # Still being written: wait for it to settle again
+                self.pending[name] = current
+            elif now_ns - stat[2] >= settle_ns:
+                del self.pending[name]
+                if self.sniff:
+                    fmt = sniff_format(os.path.join(self.folder, name))
+                else:
+                    fmt = EXTENSION_FORMATS.get(os.path.splitext(name)[1].lower())
+                # Not an image: unchanged, it stays out of the diff and is never read again
+                if fmt is not None:
+                    ready.append((name, stat))
+                    self.formats[name] = fmt
+        ready.sort()
+        return ready
+
+    def mark_processed(self, entries):
+        """entries: [(name, (inode, size, mtime_ns))] that were sorted"""
+        rows = [(name, stat[1], stat[2]) for name, stat in entries]
+        self.known.update(rows)
+        self.ledger.mark(self.folder, rows)
+
+
+def watch(engine, ledger, source, dest, category=None, prompt=None, interval=5.0,
+          settle=3.0, once=False, stop_event=None, on_result=None, scan_filter=None, router=None,
+          rules_only=False, recursive=False, sniff=False):
+    """Poll source forever (or once) and sort whatever is new and settled.
+
+    With recursive its subfolders are watched too, with sniff files are
+    told apart by content. scan_filter's name, size and date limits
+    apply; dimension limits don't, as they would mean opening every file.
+    With a router, its rules get first pick of each poll's files, as in
+    SortEngine.run.
+    """
+    stop_event = stop_event or threading.Event()
+    # Sorting into folders inside source must not feed the sorted files back in
+    watcher = FolderWatcher(source, ledger, settle, scan_filter, recursive, sniff,
+                            engine.output_folders(source, dest))
+
+    while not stop_event.is_set():
+        ready = watcher.poll()
+        if ready:
+            stats = dict(ready)
+            names = [name for name, _ in ready]
+            results = ()
+            if router:
+                entries = [ScanEntry(name, os.path.join(source, name), stat[1], stat[2], watcher.formats[name])
+                           for name, stat in ready]
+                results, names = engine.route(source, dest, entries, router)
+            if not rules_only:
+                results = itertools.chain(results, engine.sort_rest(source, dest, names, category, prompt,
+                                                                    stop_event))
+            for result in results:
+                if on_result:
+                    on_result(result)
+                if result.ok:
+                    watcher.mark_processed([(result.filename, stats[result.filename])])
+        if once:
+            break
+        stop_event.wait(interval)